@@ -0,0 +1,137 @@
+import argparse
+import sys
+
+# single command line entry point for the audit stages
+#
+#   python3 asaudit.py fetch          # Jamf + AssetSonar checked out assets into the store
+#   python3 asaudit.py reconcile      # join them and sort assets by assignment
+#   python3 asaudit.py retire | reassign | autocheckout | report
+#   python3 asaudit.py checkin C02ABC123 C02DEF456
+#   python3 asaudit.py history trend | delta | asset C02ABC123
+#   python3 asaudit.py shards start --workers 4 | work | status
+#
+# each subcommand imports only the modules it needs when it runs, so --help or
+# a single help-desk checkin doesn't pay for loading the rest of the audit
+# pipeline.py still runs every stage in one go
+
+# ==========================================================================
+
+def in_stage(name, run):
+  """Run a subcommand as a metrics stage
+
+  Args:
+    name (str): stage name
+    run (callable): subcommand body
+
+  Returns:
+    int: exit status
+  """
+  from metrics import METRICS
+  with METRICS.stage(name):
+    run()
+  return 0
+
+
+def fetch_jamf(results, options):
+  # always write the response files, reconcile reads them in a later process
+  import query_jamf
+  return query_jamf.main(write_files=True)
+
+def cmd_fetch(options):
+  import pipeline
+  if options.artifacts:
+    import store
+    store.EXPORT_JSON = True
+  stages = {'query_jamf': ((), fetch_jamf), 'query_assetsonar': pipeline.STAGES['query_assetsonar']}
+  _, _, failed = pipeline.run(stages, options)
+  return 1 if failed else 0
+
+def cmd_reconcile(options):
+  import parse_responses
+  return in_stage('parse_responses', parse_responses.main)
+
+def cmd_retire(options):
+  import retire_assets
+  return in_stage('retire_assets', lambda: retire_assets.main(resume=options.resume))
+
+def cmd_reassign(options):
+  import audit_users
+  return in_stage('audit_users', lambda: audit_users.main(resume=options.resume))
+
+def cmd_autocheckout(options):
+  import auto_checkout
+  return in_stage('auto_checkout', auto_checkout.main)
+
+def cmd_checkin(options):
+  import quick_checkin
+  return in_stage('quick_checkin', lambda: quick_checkin.main(options.file, options.serials or None, options.results))
+
+def cmd_report(options):
+  import os
+  import generate_report
+  os.makedirs('reports', exist_ok=True)
+  return in_stage('generate_report', generate_report.main)
+
+def cmd_history(options):
+  import history
+  return history.main([options.query] + ([options.serial] if options.serial else []))
+
+def cmd_shards(options):
+  import shards
+  return shards.main(options.args)
+
+# ==========================================================================
+
+def build_parser():
+  """Build the argument parser with one subparser per subcommand
+
+  Returns:
+    argparse.ArgumentParser: parser
+  """
+  parser = argparse.ArgumentParser(prog='asaudit', description='AssetSonar / Jamf asset assignment audit')
+  commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+  fetch = commands.add_parser('fetch', help='fetch Jamf devices and checked out AssetSonar assets into the store')
+  fetch.add_argument('--artifacts', action='store_true', help='also write the legacy response_assetsonar.json')
+  fetch.set_defaults(run=cmd_fetch)
+
+  commands.add_parser('reconcile', help='join assets to Jamf and sort them by assignment').set_defaults(run=cmd_reconcile)
+
+  retire = commands.add_parser('retire', help='check in and retire Apple assets that are not in Jamf')
+  retire.add_argument('--resume', action='store_true', help='continue an interrupted run, skipping assets it finished')
+  retire.set_defaults(run=cmd_retire)
+
+  reassign = commands.add_parser('reassign', help='check out wrong user and unassigned assets to their Jamf user')
+  reassign.add_argument('--resume', action='store_true', help='continue an interrupted run, skipping assets it finished')
+  reassign.set_defaults(run=cmd_reassign)
+
+  commands.add_parser('autocheckout', help='check out available assets to their candidate user').set_defaults(run=cmd_autocheckout)
+
+  checkin = commands.add_parser('checkin', help='check in assets by serial number')
+  checkin.add_argument('serials', nargs='*', help='serial numbers, read from --file if none are given')
+  checkin.add_argument('--file', default='to_checkin.csv', help='CSV file with a serial number per row')
+  checkin.add_argument('--results', default='assets_quick_checkin.csv', help='CSV file to write each serial number\'s result to')
+  checkin.set_defaults(run=cmd_checkin)
+
+  commands.add_parser('report', help='write the audit report CSV to reports/').set_defaults(run=cmd_report)
+
+  history = commands.add_parser('history', help='query the audit history: trend, delta or asset SERIAL')
+  history.add_argument('query', choices=('trend', 'delta', 'asset'))
+  history.add_argument('serial', nargs='?', help='serial number for the asset query')
+  history.set_defaults(run=cmd_history)
+
+  sharded = commands.add_parser('shards', help='run the mutation stages sharded over worker processes, see shards.py',
+                                add_help=False)
+  sharded.add_argument('args', nargs=argparse.REMAINDER, help='start, work or status and their options')
+  sharded.set_defaults(run=cmd_shards)
+  return parser
+
+
+def main(argv=None):
+  options = build_parser().parse_args(argv)
+  return options.run(options)
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())
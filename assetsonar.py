@@ -0,0 +1,444 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+from dotenv import load_dotenv
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+import urllib3
+from datetime import datetime
+from concurrency import CONCURRENCY_MAX, AdaptiveLimit, retry_after_seconds
+from httpcache import cached_get, get_cache
+from metrics import METRICS, endpoint_label
+
+# shared AssetSonar API client
+# one keep-alive requests.Session per process with a sized connection pool
+# retries 429 / 5xx / timeouts with exponential backoff and jitter
+# requests in flight are capped by an adaptive limit shared by every stage, see concurrency.py
+
+# ==========================================================================
+
+load_dotenv()
+ASSETSONAR_TOKEN = os.getenv('COMPANY_TOKEN')
+ASSETSONAR_SUBDOMAIN = os.getenv('COMPANY_SUBDOMAIN')
+BASE_URL = os.getenv('ASSETSONAR_URL') or f'https://{ASSETSONAR_SUBDOMAIN}.assetsonar.com' # override e.g. for fake_api.py
+
+POOL_SIZE = int(os.getenv('ASSETSONAR_POOL_SIZE', CONCURRENCY_MAX))
+CONNECT_TIMEOUT = float(os.getenv('ASSETSONAR_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.getenv('ASSETSONAR_READ_TIMEOUT', 60))
+MAX_RETRIES = int(os.getenv('ASSETSONAR_MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.getenv('ASSETSONAR_BACKOFF_BASE', 1)) # seconds, doubled per attempt
+BACKOFF_MAX = float(os.getenv('ASSETSONAR_BACKOFF_MAX', 60))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503, 504} # the server asking us to slow down, shrinks the adaptive limit
+PAGE_WORKERS = int(os.getenv('ASSETSONAR_PAGE_WORKERS', CONCURRENCY_MAX)) # threads, requests in flight are capped by the adaptive limit
+UPDATED_SINCE_PARAM = os.getenv('ASSETSONAR_UPDATED_SINCE_PARAM', 'updated_since') # filter.api delta filter
+RATE_LIMIT = float(os.getenv('ASSETSONAR_RATE_LIMIT', 5)) # requests per second across all threads, 0 disables
+RATE_BURST = int(os.getenv('ASSETSONAR_RATE_BURST', 10))
+ASSET_FILTERS = dict(parse_qsl(os.getenv('ASSETSONAR_ASSET_FILTERS', ''))) # extra filter.api params for the checked out fetch, e.g. manufacturer=Apple
+PAGE_SIZE = int(os.getenv('ASSETSONAR_PAGE_SIZE', 0)) # records per list page, 0 keeps the API default
+PAGE_SIZE_PARAM = os.getenv('ASSETSONAR_PAGE_SIZE_PARAM', 'per_page')
+
+# the only fields any stage reads, see records.py; list pages are cut down to these as they arrive
+ASSET_FIELDS = ('sequence_num', 'bios_serial_number', 'name', 'assigned_to_user_email', 'candidate_email', 'manufacturer')
+MEMBER_FIELDS = ('id', 'email', 'full_name', 'role_name', 'EGY')
+
+CHECKIN_LOCATION_ID = 30681 # location == society office
+RETIRE_REASON_ID = 101650   # reason == deleted from jamf
+CHECKOUT_COMMENT = 'Auto checkout by AAA: https://github.com/azuda/asset_assign_audit'
+
+# ==========================================================================
+
+class AssetSonarError(Exception):
+  """Raised when an AssetSonar request still fails after all retries"""
+
+
+class TokenBucket:
+  """Thread-safe token bucket keeping request rate under the API quota"""
+
+  def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+    self.rate = rate
+    self.capacity = max(1, burst)
+    self.tokens = float(self.capacity)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Block until a token is available, then take it
+
+    Returns:
+      None
+    """
+    if self.rate <= 0:
+      return None
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return None
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class AssetSonarClient:
+  """Pooled AssetSonar API client with retry, backoff, a shared rate limit and an adaptive concurrency limit"""
+
+  def __init__(self, base_url=BASE_URL, token=ASSETSONAR_TOKEN, pool_size=POOL_SIZE,
+               timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES, bucket=None, cache=None,
+               limit=None):
+    self.base_url = base_url.rstrip('/')
+    self.cache = cache
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.bucket = bucket or TokenBucket()
+    self.limit = limit or AdaptiveLimit()
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.verify = False
+    self.session.headers.update({
+      'token': token,
+      'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
+    })
+
+  def backoff(self, attempt, response=None):
+    """Get seconds to wait before the next attempt
+
+    Args:
+      attempt (int): zero-based attempt that just failed
+      response (requests.Response): failed response, may carry Retry-After
+
+    Returns:
+      float: delay in seconds
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay) # jitter so parallel callers don't retry in lockstep
+    return max(delay, retry_after_seconds(response))
+
+  def request(self, method, endpoint, params=None, headers=None):
+    """Send a request, retrying 429 / 5xx / timeouts / connection errors
+
+    Args:
+      method (str): HTTP method
+      endpoint (str): path relative to the AssetSonar base url
+      params (dict): query parameters
+      headers (dict): extra request headers, e.g. conditional request validators
+
+    Returns:
+      requests.Response: final response (may be a non-retryable 4xx)
+    """
+    url = f'{self.base_url}/{endpoint.lstrip("/")}'
+    for attempt in range(self.max_retries + 1):
+      response = None
+      sent = self.limit.acquire()
+      self.bucket.acquire() # retries count against the quota too
+      start = time.perf_counter()
+      try:
+        response = self.session.request(method, url, params=params, headers=headers, timeout=self.timeout)
+        status = response.status_code
+        overloaded = status in OVERLOAD_STATUSES
+        error = f'HTTP {status}'
+      except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        status = type(e).__name__
+        overloaded = isinstance(e, requests.exceptions.Timeout)
+        error = str(e)
+      seconds = time.perf_counter() - start
+      self.limit.release(sent, overloaded, seconds, retry_after_seconds(response) if overloaded else 0)
+      if status not in RETRY_STATUSES and response is not None:
+        METRICS.request('assetsonar', method, endpoint, status, seconds)
+        METRICS.count('api_response_bytes_total', len(response.content), service='assetsonar',
+                      endpoint=endpoint_label(endpoint))
+        return response
+      METRICS.request('assetsonar', method, endpoint, status, seconds, retry=attempt < self.max_retries)
+
+      if attempt == self.max_retries:
+        break
+      delay = self.backoff(attempt, response)
+      print(f'{method} {endpoint} failed ({error}), retrying in {delay:.1f}s', file=sys.stderr)
+      time.sleep(delay)
+
+    raise AssetSonarError(f'{method} {endpoint} failed after {self.max_retries + 1} attempts: {error}')
+
+  def get_json(self, endpoint, params=None):
+    """GET an endpoint and decode the JSON body, revalidating cached copies, see httpcache.py
+
+    Args:
+      endpoint (str): path relative to the AssetSonar base url
+      params (dict): query parameters
+
+    Returns:
+      dict: decoded response body
+    """
+    url = f'{self.base_url}/{endpoint.lstrip("/")}'
+    response, cached = cached_get(self.cache, 'assetsonar', url, params,
+                                  lambda headers: self.request('GET', endpoint, params, headers))
+    if response is None:
+      return cached
+    try:
+      response.raise_for_status()
+      return response.json()
+    except requests.exceptions.HTTPError as e:
+      raise AssetSonarError(f'GET {endpoint}: {e} - {response.text}') from e
+    except json.JSONDecodeError as e:
+      raise AssetSonarError(f'GET {endpoint}: invalid JSON - {response.text}') from e
+
+  def put(self, endpoint, params=None):
+    """PUT an endpoint, never raising so mutation results can be recorded
+
+    Args:
+      endpoint (str): path relative to the AssetSonar base url
+      params (dict): query parameters
+
+    Returns:
+      tuple: (status code or None, decoded body or {'error': ...})
+    """
+    endpoint_name = endpoint.rsplit('/', 1)[-1]
+    try:
+      response = self.request('PUT', endpoint, params)
+    except AssetSonarError as e:
+      print(e, file=sys.stderr)
+      METRICS.count('mutations_total', endpoint=endpoint_name, result='error')
+      return None, {'error': str(e)}
+    METRICS.count('mutations_total', endpoint=endpoint_name,
+                  result='ok' if 200 <= response.status_code < 300 else 'failed')
+    try:
+      return response.status_code, response.json()
+    except json.JSONDecodeError:
+      return response.status_code, {'error': response.text}
+
+  # --- read endpoints ---
+
+  def fetch_all_pages(self, fetch_page, workers=PAGE_WORKERS):
+    """Fetch page 1, then fan the remaining pages out over a bounded worker pool
+
+    Args:
+      fetch_page (callable): takes a page number and returns that page's JSON
+      workers (int): max pages in flight at once, the adaptive limit may allow fewer
+
+    Returns:
+      list: page JSON dicts in page order; raises if any page fails after retries
+    """
+    first = fetch_page(1)
+    total_pages = int(first.get('total_pages') or 1)
+    pages = [first]
+    if total_pages < 2:
+      METRICS.count('pages_fetched_total', service='assetsonar')
+      return pages
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, total_pages - 1)))
+    futures = [pool.submit(fetch_page, page_num) for page_num in range(2, total_pages + 1)]
+    try:
+      for future in futures: # in submission order, so page order is preserved
+        pages.append(future.result())
+    except BaseException:
+      # one failed page fails the whole fetch, don't wait on the rest
+      pool.shutdown(wait=False, cancel_futures=True)
+      raise
+    pool.shutdown()
+    METRICS.count('pages_fetched_total', len(pages), service='assetsonar')
+    return pages
+
+  def list_params(self, page_num, custom_fields=False):
+    """Get the query parameters every list endpoint page shares
+
+    Args:
+      page_num (int): page number to fetch
+      custom_fields (bool): ask for custom fields, which most callers never read
+
+    Returns:
+      dict: query parameters
+    """
+    params = {'page': page_num}
+    if custom_fields:
+      params['include_custom_fields'] = 'true'
+    if PAGE_SIZE:
+      params[PAGE_SIZE_PARAM] = PAGE_SIZE
+    return params
+
+  def fetch_assets_page(self, status, page_num, updated_since=None, custom_fields=False, filters=None):
+    """Fetch a single page of assets with the given status from assets/filter.api
+
+    Args:
+      status (str): AS asset status, e.g. checked_out or available, None for any
+      page_num (int): page number to fetch
+      updated_since (str): ISO-8601 time, only return assets updated after it
+      custom_fields (bool): include custom fields
+      filters (dict): extra filter.api params, e.g. ASSET_FILTERS
+
+    Returns:
+      dict: JSON response data for the page
+    """
+    params = {**self.list_params(page_num, custom_fields), **(filters or {})}
+    if status:
+      params['status'] = status
+    if updated_since:
+      params[UPDATED_SINCE_PARAM] = updated_since
+    return self.get_json('assets/filter.api', params)
+
+  def fetch_assets(self, status, updated_since=None, custom_fields=False, fields=ASSET_FIELDS, filters=None):
+    """Fetch every page of assets with the given status
+
+    Args:
+      status (str): AS asset status, e.g. checked_out or available, None for any
+      updated_since (str): ISO-8601 time, only return assets updated after it
+      custom_fields (bool): include custom fields
+      fields (tuple): asset fields to keep, None keeps everything
+      filters (dict): extra filter.api params, e.g. ASSET_FILTERS
+
+    Returns:
+      list: raw asset dicts in page order
+    """
+    pages = self.fetch_all_pages(lambda page_num: project(
+      self.fetch_assets_page(status, page_num, updated_since, custom_fields, filters), 'assets', fields))
+    return collect(pages, 'assets')
+
+  def find_asset(self, serial):
+    """Look an asset up by serial number with search.api
+
+    Args:
+      serial (str): serial number
+
+    Returns:
+      dict: raw asset whose serial number matches exactly, None if there is none
+    """
+    found = self.get_json('search.api', {'search': serial, 'facet': 'FixedAsset', 'page': 1})
+    for asset in found.get('assets', []):
+      # search matches any field, e.g. a name containing the serial
+      if (asset.get('bios_serial_number') or '').strip().upper() == serial.upper():
+        return asset
+    return None
+
+  def fetch_members_page(self, page_num, custom_fields=False):
+    """Fetch a single page of members from members.api
+
+    Args:
+      page_num (int): page number to fetch
+      custom_fields (bool): include custom fields
+
+    Returns:
+      dict: JSON response data for the page
+    """
+    return self.get_json('members.api', self.list_params(page_num, custom_fields))
+
+  def fetch_members(self, custom_fields=False, fields=MEMBER_FIELDS):
+    """Fetch every page of members
+
+    Args:
+      custom_fields (bool): include custom fields, e.g. for Member.EGY
+      fields (tuple): member fields to keep, None keeps everything
+
+    Returns:
+      list: raw member dicts in page order
+    """
+    pages = self.fetch_all_pages(lambda page_num: project(self.fetch_members_page(page_num, custom_fields), 'members', fields))
+    return collect(pages, 'members')
+
+  # --- mutations ---
+
+  def checkin_asset(self, asset_id):
+    """Check in an asset
+
+    Args:
+      asset_id (int): AS id of the asset to check in
+
+    Returns:
+      tuple: (status code, API response)
+    """
+    params = {
+      'checkin_values[location_id]': CHECKIN_LOCATION_ID,
+    }
+    return self.put(f'assets/{asset_id}/checkin.api', params)
+
+  def checkout_asset(self, asset_id, user_id):
+    """Checkout asset to a user
+
+    Args:
+      asset_id (int): AS id of the asset to checkout
+      user_id (int): AS member id to check the asset out to
+
+    Returns:
+      tuple: (status code, API response)
+    """
+    params = {
+      'user_id': user_id,
+      'checkout_values[comments]': CHECKOUT_COMMENT,
+    }
+    return self.put(f'assets/{asset_id}/checkout.api', params)
+
+  def retire_asset(self, asset_id):
+    """Retire an asset
+
+    Args:
+      asset_id (int): AS id of the asset to retire
+
+    Returns:
+      tuple: (status code, API response)
+    """
+    params = {
+      'fixed_asset[retired_on]': datetime.today().strftime('%m/%d/%Y'),
+      'fixed_asset[retire_reason_id]': RETIRE_REASON_ID,
+    }
+    return self.put(f'assets/{asset_id}/retire.api', params)
+
+# ==========================================================================
+
+def project(page, key, fields):
+  """Cut a list page's items down to the fields the caller reads
+
+  Args:
+    page (dict): page JSON
+    key (str): list key, e.g. assets or members
+    fields (tuple): fields to keep, None keeps everything
+
+  Returns:
+    dict: the page, items projected in place
+  """
+  items = page.get(key)
+  if fields and isinstance(items, list): # anything else is left for collect() to reject
+    page[key] = [{f: item[f] for f in fields if f in item} if isinstance(item, dict) else item for item in items]
+  return page
+
+
+def collect(pages, key):
+  """Concatenate the item lists of fetched pages
+
+  Args:
+    pages (list): page JSON dicts
+    key (str): list key in each page, e.g. assets or members
+
+  Returns:
+    list: items from every page in page order
+  """
+  items = []
+  for page_num, page_data in enumerate(pages, start=1):
+    page_items = page_data.get(key, [])
+    if not isinstance(page_items, list):
+      raise AssetSonarError(f"Unexpected response format: '{key}' is not a list on page {page_num}.")
+    items.extend(page_items)
+  return items
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock() # page and mutation workers can all ask for the client first
+
+def get_client():
+  """Get the process-wide AssetSonar client, creating it on first use
+
+  Returns:
+    AssetSonarClient: shared client
+  """
+  global _CLIENT
+  if _CLIENT is None:
+    with _CLIENT_LOCK:
+      if _CLIENT is None:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        _CLIENT = AssetSonarClient(cache=get_cache())
+  return _CLIENT
@@ -1,8 +1,13 @@
+import argparse
 import json
-from dotenv import load_dotenv
-import os
-import requests
-import sys
+from assetsonar import get_client
+from checkpoint import Checkpoint
+import journal
+from members import DIRECTORY
+from metrics import METRICS
+import planner
+from records import Asset, AuditOutcome
+from store import export_json, get_store
 import urllib3
 
 # audit AS assigned user against Jamf assigned user
@@ -11,50 +16,6 @@ import urllib3
 
 # ==========================================================================
 
-with open('assets_assigned.json', 'r') as f:
-  ASSETS = json.load(f)
-
-load_dotenv()
-ASSETSONAR_TOKEN = os.getenv('COMPANY_TOKEN')
-ASSETSONAR_SUBDOMAIN = os.getenv('COMPANY_SUBDOMAIN')
-BASE_URL = f'https://{ASSETSONAR_SUBDOMAIN}.assetsonar.com'
-API_ENDPOINT = 'members.api'
-
-# ==========================================================================
-
-def get_as_users(page_num):
-  """Fetch a single page of members from AssetSonar API
-
-  Args:
-    page_num (int): Page number to fetch
-
-  Returns:
-    dict: API response or None if error occurs
-  """
-  url = f'{BASE_URL}/{API_ENDPOINT}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'include_custom_fields': 'true',
-    'page': page_num
-  }
-
-  try:
-    # curl  -H "token:<COMPANY_TOKEN>" -X GET -d "include_custom_fields=true" "https://<SUBDOMAIN>.assetsonar.com/members.api?page=<PAGE_NUM | DEFAULT = 1>"
-    response = requests.get(url, headers=headers, params=params, timeout=30, verify=False)
-  except requests.exceptions.RequestException as e:
-    print(f'Error fetching page {page_num}: {e}', file=sys.stderr)
-    if response is not None:
-      print(f'Response content: {response.text}', file=sys.stderr)
-    return None
-  except json.JSONDecodeError:
-    print(f'Error decoding JSON from response for page {page_num}: {response.text}', file=sys.stderr)
-    return None
-  return response.json()
-
-
 def checkin_asset(asset_id):
   """Check in an asset in AssetSonar
 
@@ -62,20 +23,9 @@ def checkin_asset(asset_id):
     id (str): AS id of the asset to check in
 
   Returns:
-    dict: API response
+    tuple: (status code, API response)
   """
-  endpoint = f'assets/{asset_id}/checkin.api'
-  url = f'{BASE_URL}/{endpoint}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'checkin_values[location_id]': 30681, # location == society office
-  }
-  # curl -X PUT
-  response = requests.put(url, headers=headers, params=params, timeout=30, verify=False)
-  return response.json()
+  return get_client().checkin_asset(asset_id)
 
 
 def checkout_asset(id, user):
@@ -86,139 +36,135 @@ def checkout_asset(id, user):
     user (int): ID of user to check the asset out to
 
   Returns:
-    dict: API response
+    tuple: (status code, API response)
   """
-  endpoint = f'assets/{id}/checkout.api?user_id={user}'
-  url = f'{BASE_URL}/{endpoint}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'checkout_values[comments]': 'Auto checkout by AAA: https://github.com/azuda/asset_assign_audit',
-  }
-  # curl -X PUT
-  response = requests.put(url, headers=headers, params=params, timeout=30, verify=False)
-  return response.json()
-
-
-def get_user_id(email):
-  """Get user's AS member id from email
+  return get_client().checkout_asset(id, user)
+
+# ==========================================================================
+
+def reassign_asset(asset, status=None):
+  """Checkout a wrong_user asset to its jamf-assigned user, checking it in first if needed
 
   Args:
-    email (str): User email address
+    asset (Asset): wrong_user asset from parse_responses.sort_assignments()
+    status (str): asset status in the snapshot, see planner.plan_reassign()
 
   Returns:
-    int: User id if found else None
+    dict: reassignment record
   """
-  with open('response_members.json', 'r') as f:
-    MEMBERS = json.load(f)
-
-  # verify if MEMBERS list is valid
-  if not isinstance(MEMBERS, list):
-    print('Error: response_members.json does not contain a list of members.', file=sys.stderr)
-    return None
-
-  for user in MEMBERS:
-    if user['email'] == email:
-      return user['id']
-  print(f'User {email} not found in members list.', file=sys.stderr)
-  return None
+  user_id = DIRECTORY.get_user_id(asset.jamf_email())
+  steps = planner.plan_reassign(status, user_id)
+  record = {'serial_no': asset.serial_no, 'checkin': planner.NOT_NEEDED, 'checkout': planner.NO_USER, 'ok': False}
+  if not steps:
+    record['checkin'] = planner.NOT_ATTEMPTED # don't leave the asset checked in with nobody to check it out to
+    return record
+
+  codes = []
+  if 'checkin' in steps:
+    code, record['checkin'] = checkin_asset(asset.asset_id)
+    codes.append(code)
+    if not journal.succeeded(code):
+      record['checkout'] = planner.NOT_ATTEMPTED
+      return record
+  print(f'trying to checkout {asset.serial_no} with email {asset.jamf_email()}')
+  code, record['checkout'] = checkout_asset(asset.asset_id, user_id)
+  codes.append(code)
+  record['ok'] = journal.succeeded(*codes)
+  return record
+
+
+def assign_unassigned(asset):
+  """Try to checkout an unassigned asset to its jamf-assigned user
 
-
-def get_all_assetsonar_users():
-  """Fetch all AS members, handle pagination
+  Args:
+    asset (Asset): unassigned asset from parse_responses.sort_assignments()
 
   Returns:
-    None
+    dict: reassignment record
   """
-  print('Getting AssetSonar user data...')
-
-  all_users = []
-  current_page = 1
-  total_pages = 1  # initialize to 1
-  while current_page <= total_pages:
-    # print(f'Fetching page {current_page}...')
-    page_data = get_as_users(current_page)
-
-    if page_data is None:
-      print('Failed to retrieve page data. Aborting.', file=sys.stderr)
-      break
-
-    for user in page_data.get('members', []):
-      if not isinstance(user, dict):
-        print(f"Unexpected response format: 'members' contains non-dict item on page {current_page}.", file=sys.stderr)
-        continue
-      # get relevant member info
-      this_user = {}
-      this_user['id'] = user['id']
-      this_user['name'] = user['full_name']
-      this_user['email'] = user['email']
-      this_user['EGY'] = user.get('EGY', None)
-      this_user['role'] = user['role_name']
-      all_users.append(this_user)
-
-    # update total pages from response
-    total_pages = page_data.get('total_pages', current_page)
-    current_page += 1
-
-    # check if we're on last page
-    if not page_data and current_page > 1:
-    # if current_page > 5:
-      print('No more users found on subsequent pages.')
-      break
-
-  if all_users:
-    with open('response_members.json', 'w') as f:
-      json.dump(all_users, f, indent=2, sort_keys=True)
-    print(f'All AssetSonar members saved to response_members.json - total: {len(all_users)}')
-  else:
-    print('No members retrieved or an error occurred')
-  return None
+  jamf_email = asset.jamf_email()
+  if jamf_email is None:
+    return {'serial_no': asset.serial_no, 'checkin': 'UNASSIGNED', 'checkout': 'NO_EMAIL'}
+  user_id = DIRECTORY.get_user_id(jamf_email)
+  if not planner.plan_checkout(None, user_id):
+    return {'serial_no': asset.serial_no, 'checkin': 'UNASSIGNED', 'checkout': planner.NO_USER, 'ok': False}
+  checkout_status, checkout_response = checkout_asset(asset.asset_id, user_id)
+  return {'serial_no': asset.serial_no, 'checkin': 'UNASSIGNED', 'checkout': checkout_response,
+          'ok': journal.succeeded(checkout_status)}
 
 # ==========================================================================
 
-def main():
+def main(assigned=None, resume=False, shard=None):
+  """Reassign wrong_user assets and checkout unassigned ones to their Jamf user
+
+  Args:
+    assigned (dict): assets sorted by parse_responses.sort_assignments(), read from the store if None
+    resume (bool): skip assets an interrupted run already finished, see checkpoint.py
+    shard (shards.Shard): only handle this shard's assets, see shards.py
+
+  Returns:
+    dict: {'reassigned': reassignment records, 'no_jamf_user': serial numbers}
+  """
   # start
-  get_all_assetsonar_users()
+  store = get_store()
+  DIRECTORY.load()
 
-  all_reassigned = []
   # checkin assets in wrong_user and checkout to their jamf-assigned user
-  for asset in ASSETS['wrong_user']:
-    checkin_response = checkin_asset(asset['asset_id'])
-    print(f'trying to checkout {asset["serial_no"]} with email {asset["jamf_user_data"]["email"]}')
-    checkout_response = checkout_asset(asset['asset_id'], get_user_id(asset['jamf_user_data']['email']))
-    # print(f'\n{checkin_response}\n{checkout_response}')
-    all_reassigned.append({'serial_no': asset['serial_no'], 'checkin': checkin_response, 'checkout': checkout_response})
-  
+  # skipping ones whose AS / Jamf emails haven't changed since the last attempt
+  wrong_user = assigned['wrong_user'] if assigned is not None else list(map(Asset.from_dict, store.outcomes('reconcile', 'wrong_user')))
+  if shard is not None:
+    wrong_user = shard.select(wrong_user)
+  to_reassign, skipped = journal.split_settled('reassign', wrong_user, store)
+  statuses = store.asset_statuses()
+  checkpoint = Checkpoint(shard.name('audit_users') if shard else 'audit_users', resume)
+  reassign = lambda asset: reassign_asset(asset, statuses.get(asset.asset_id))
+  to_reassign, all_reassigned = checkpoint.run('reassign', to_reassign, shard.guard(reassign) if shard else reassign)
+  journal.record('reassign', to_reassign, all_reassigned, store)
+
   # try to checkout unassigned assets to their jamf-assigned user
-  no_jamf_user = []
-  for asset in ASSETS['unassigned']:
-    jamf_user_data = asset.get('jamf_user_data')
-    jamf_email = jamf_user_data.get('email') if jamf_user_data else None
-    if jamf_email is None:
-      all_reassigned.append({'serial_no': asset['serial_no'], 'checkin': 'UNASSIGNED', 'checkout': 'NO_EMAIL'})
-      no_jamf_user.append(asset['serial_no'])
-    else:
-      checkout_response = checkout_asset(asset['asset_id'], get_user_id(jamf_email))
-      all_reassigned.append({'serial_no': asset['serial_no'], 'checkin': 'UNASSIGNED', 'checkout': checkout_response})
+  unassigned_assets = assigned['unassigned'] if assigned is not None else list(map(Asset.from_dict, store.outcomes('reconcile', 'unassigned')))
+  if shard is not None:
+    unassigned_assets = shard.select(unassigned_assets)
+  to_assign, skipped_unassigned = journal.split_settled('assign', unassigned_assets, store)
+  to_assign, unassigned = checkpoint.run('assign', to_assign, shard.guard(assign_unassigned) if shard else assign_unassigned)
+  # no API call is made without a Jamf email, so there is nothing to journal
+  attempted = [(asset, r) for asset, r in zip(to_assign, unassigned) if r['checkout'] != 'NO_EMAIL']
+  journal.record('assign', [a for a, _ in attempted], [r for _, r in attempted], store)
+  all_reassigned.extend(unassigned)
+  no_jamf_user = [r['serial_no'] for r in unassigned if r['checkout'] == 'NO_EMAIL']
+
+  outcomes = [AuditOutcome.of(asset, 'reassigned', record) for asset, record in zip(to_reassign, all_reassigned)]
+  for asset, record in zip(to_assign, unassigned):
+    category = 'no_jamf_user' if record['checkout'] == 'NO_EMAIL' else 'assigned'
+    outcomes.append(AuditOutcome.of(asset, category, record))
+  outcomes.extend(AuditOutcome.of(asset, 'skipped', record) for asset, record in skipped + skipped_unassigned)
+  if shard is not None:
+    # every shard would overwrite the same JSON files, the store has the merged outcomes
+    store.merge_outcomes('reassign', outcomes)
+    checkpoint.finish()
+    print(f'Shard {shard}: {len(all_reassigned)} assets reassigned / assigned, {len(no_jamf_user)} with no Jamf user')
+    return {'reassigned': all_reassigned, 'no_jamf_user': no_jamf_user}
+  store.replace_outcomes('reassign', outcomes)
 
   with open('assets_reassigned.json', 'w') as f:
     json.dump(all_reassigned, f, indent=2, sort_keys=True)
   print(f'Assets correctly assigned saved to assets_reassigned.json')
 
   # list of only serial numbers of unassigned assets
-  with open('assets_no_jamf_user.json', 'w') as f:
-    json.dump(no_jamf_user, f, indent=2, sort_keys=True)
-  print(f'Assets with no assigned user saved to assets_no_jamf_user.json')
+  print(f'Assets with no assigned user saved to {store.path} - total: {len(no_jamf_user)}')
+  export_json('assets_no_jamf_user.json', no_jamf_user, indent=2, sort_keys=True)
+  checkpoint.finish()
 
   print('Done')
-
-  # end
+  return {'reassigned': all_reassigned, 'no_jamf_user': no_jamf_user}
 
 # ==========================================================================
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Reassign assets checked out to the wrong user in AssetSonar')
+  parser.add_argument('--resume', action='store_true', help='continue an interrupted run, skipping assets it finished')
+  options = parser.parse_args()
   print(f'\n\n--- audit_users.py ---')
   urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-  main()
+  with METRICS.stage('audit_users'):
+    main(resume=options.resume)
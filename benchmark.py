@@ -0,0 +1,162 @@
+import argparse
+import contextlib
+from datetime import datetime, timezone
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import fleet
+
+# benchmark the offline stages against synthetic fleets
+# times and memory-profiles Jamf loading, indexing, the join, sorting and the
+# report for each fleet size and appends one JSON line per stage to the
+# results file so runs on different commits can be compared
+
+# ==========================================================================
+
+DEFAULT_SIZES = '1000,10000,50000'
+RESULTS_FILE = os.path.join('benchmarks', 'results.jsonl')
+
+# ==========================================================================
+
+def measure(run, setup):
+  """Time a stage, then run it again under tracemalloc for its peak allocation
+
+  Args:
+    run (callable): stage, takes setup()'s result
+    setup (callable): builds fresh inputs for each run
+
+  Returns:
+    tuple: (seconds, peak bytes allocated, stage result)
+  """
+  inputs = setup()
+  gc.collect()
+  start = time.perf_counter()
+  result = run(inputs)
+  seconds = time.perf_counter() - start
+
+  inputs = setup()
+  result = None
+  gc.collect()
+  tracemalloc.start()
+  try:
+    result = run(inputs)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return seconds, peak, result
+
+
+def bench_fleet(devices, options):
+  """Benchmark every offline stage on one synthetic fleet
+
+  Args:
+    devices (int): devices in Jamf
+    options (argparse.Namespace): fleet ratios
+
+  Returns:
+    list: result dicts, one per stage
+  """
+  # imported here so the store opens inside the scratch directory
+  import generate_report
+  import parse_responses
+  import store
+  from records import Asset
+
+  data = fleet.generate(devices, options.mobile_ratio, options.mismatch, options.unassigned,
+                        options.not_in_jamf, seed=options.seed)
+  fleet.write_jamf_files(data)
+  store._STORE = store.Store(os.path.abspath('bench.db'))
+  os.makedirs('reports', exist_ok=True)
+
+  def assets():
+    return [Asset.from_api(a, 'assigned_to_user_email') for a in data['checked_out']]
+
+  joined = {}
+  def join(inputs):
+    joined.update(parse_responses.main(*inputs))
+    return joined
+
+  stages = [
+    ('load_jamf', lambda _: parse_responses.load_jamf(), lambda: None),
+    ('build_jamf_index', parse_responses.build_jamf_index, parse_responses.load_jamf),
+    ('parse_responses', join, lambda: (assets(), parse_responses.load_jamf())),
+    ('sort_assignments', parse_responses.sort_assignments, lambda: joined['assets']),
+    ('generate_report', lambda inputs: generate_report.main(*inputs),
+     lambda: (joined['assets']['assets_in_jamf'], [a.serial_no for a in joined['assigned']['unassigned']])),
+  ]
+
+  results = []
+  for name, run, setup in stages:
+    # stages print per asset; keep the benchmark output readable
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      seconds, peak, _ = measure(run, setup)
+    results.append({'stage': name, 'seconds': round(seconds, 4), 'peak_kib': peak // 1024,
+                    'devices': devices, 'assets': len(data['checked_out'])})
+    print(f'{devices:>8} {name:<18} {seconds:>9.3f}s {peak / 2**20:>9.1f} MiB')
+  store._STORE.close()
+  store._STORE = None
+  return results
+
+
+def git_commit():
+  """Get the commit being benchmarked
+
+  Returns:
+    str: short commit hash or None outside a git checkout
+  """
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                          check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# ==========================================================================
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the offline audit stages on synthetic fleets')
+  parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated device counts, e.g. 1000,200000')
+  parser.add_argument('--mobile-ratio', type=float, default=0.3)
+  parser.add_argument('--mismatch', type=float, default=0.1, help='share of devices checked out to the wrong user')
+  parser.add_argument('--unassigned', type=float, default=0.05, help='share of devices with no Jamf email')
+  parser.add_argument('--not-in-jamf', type=float, default=0.05, help='extra assets missing from Jamf, share of devices')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=RESULTS_FILE, help='JSON lines file results are appended to')
+  options = parser.parse_args(argv)
+
+  output = os.path.abspath(options.output)
+  os.makedirs(os.path.dirname(output), exist_ok=True)
+  run = {
+    'run_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'mobile_ratio': options.mobile_ratio,
+    'mismatch': options.mismatch,
+    'unassigned': options.unassigned,
+    'not_in_jamf': options.not_in_jamf,
+    'seed': options.seed,
+  }
+
+  print(f'{"devices":>8} {"stage":<18} {"time":>10} {"peak":>13}')
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as scratch:
+    os.chdir(scratch)
+    try:
+      with open(output, 'a') as f:
+        for devices in (int(s) for s in options.sizes.split(',')):
+          for result in bench_fleet(devices, options):
+            f.write(json.dumps({**run, **result}) + '\n')
+    finally:
+      os.chdir(cwd)
+  print(f'Results appended to {options.output}')
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())
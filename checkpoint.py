@@ -0,0 +1,144 @@
+from dotenv import load_dotenv
+import json
+import os
+import threading
+import time
+import journal
+from mutations import run_mutations
+
+# append-only checkpoint log for the mutation stages
+# every asset is written to checkpoints/<stage>.jsonl the moment its calls
+# finish, so a run that dies halfway (timeout, sleep, API outage) can be
+# continued with --resume: finished assets are skipped and their recorded
+# results reused, and only the rest is attempted
+# the file is removed once the stage completes; a run without --resume
+# discards whatever an interrupted run left behind
+
+# ==========================================================================
+
+load_dotenv()
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', 'checkpoints')
+
+# ==========================================================================
+
+def read_entries(path):
+  """Read a checkpoint file, ignoring a line cut short by a crash
+
+  Args:
+    path (str): checkpoint file
+
+  Returns:
+    dict: (action, serial number) -> checkpoint entry, latest wins
+  """
+  entries = {}
+  if not os.path.exists(path):
+    return entries
+  with open(path) as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      entries[(entry['action'], entry['serial_no'])] = entry
+  return entries
+
+
+class Checkpoint:
+  """Per-stage log of finished assets, shared by the stage's mutation workers"""
+
+  def __init__(self, stage, resume=False, directory=CHECKPOINT_DIR):
+    self.stage = stage
+    self.path = os.path.join(directory, f'{stage}.jsonl')
+    self.lock = threading.Lock()
+    os.makedirs(directory, exist_ok=True)
+    self.entries = read_entries(self.path) if resume else {}
+    if resume:
+      print(f'{stage}: resuming, {len(self.entries)} assets already done in {self.path}')
+    elif os.path.exists(self.path):
+      print(f'{stage}: discarding checkpoint of an interrupted run, pass --resume to continue it')
+    self.file = open(self.path, 'a' if resume else 'w')
+
+  def split_done(self, action, assets):
+    """Split assets into ones still to do and ones finished before the interruption
+
+    An entry only counts if it was made for the asset's current AssetSonar /
+    Jamf emails, see journal.email_pair().
+
+    Args:
+      action (str): mutation, e.g. retire, reassign, assign
+      assets (list): assets the stage is about to mutate
+
+    Returns:
+      tuple: (assets to do, (asset, recorded result) for every finished one)
+    """
+    todo = []
+    done = []
+    for asset in assets:
+      entry = self.entries.get((action, asset.serial_no))
+      if entry is not None and tuple(entry['emails']) == journal.email_pair(asset):
+        done.append((asset, entry['result']))
+      else:
+        todo.append(asset)
+    if done:
+      print(f'{action}: {len(done)} assets finished by the interrupted run, {len(todo)} left')
+    return todo, done
+
+  def add(self, action, asset, result):
+    """Append one finished asset and flush it straight to disk
+
+    Args:
+      action (str): mutation
+      asset (Asset): mutated asset
+      result (dict): the task's result record
+
+    Returns:
+      None
+    """
+    line = json.dumps({'action': action, 'serial_no': asset.serial_no, 'asset_id': asset.asset_id,
+                       'emails': journal.email_pair(asset), 'result': result, 'at': round(time.time(), 3)})
+    with self.lock:
+      self.file.write(line + '\n')
+      self.file.flush()
+    return None
+
+  def wrap(self, action, task):
+    """Make a run_mutations() task checkpoint each asset it finishes
+
+    Args:
+      action (str): mutation
+      task (callable): takes one asset, returns its result record
+
+    Returns:
+      callable: the checkpointing task
+    """
+    def checkpointed(asset):
+      result = task(asset)
+      self.add(action, asset, result)
+      return result
+    return checkpointed
+
+  def run(self, action, assets, task):
+    """Run a mutation over the assets not finished yet, checkpointing as it goes
+
+    Args:
+      action (str): mutation
+      assets (list): assets to mutate
+      task (callable): takes one asset, returns its result record
+
+    Returns:
+      tuple: (assets, result records) in matching order, finished ones first
+    """
+    todo, done = self.split_done(action, assets)
+    results = run_mutations(todo, self.wrap(action, task))
+    return [a for a, _ in done] + todo, [r for _, r in done] + results
+
+  def finish(self):
+    """Remove the checkpoint once the stage has completed and saved its results
+
+    Returns:
+      None
+    """
+    with self.lock:
+      self.file.close()
+    os.remove(self.path)
+    return None
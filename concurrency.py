@@ -0,0 +1,114 @@
+from dotenv import load_dotenv
+from email.utils import parsedate_to_datetime
+import os
+import threading
+import time
+from metrics import METRICS
+
+# adaptive limit on AssetSonar requests in flight (AIMD, like TCP congestion control)
+# every successful, fast response raises the limit by 1/limit, so it grows by
+# about one per round of requests; a 429, 503, 504, timeout or response slower
+# than LATENCY_TARGET halves it. Only requests sent after the last decrease can
+# decrease it again, so one burst of 429s counts once. A Retry-After pauses every
+# thread, not just the one that got it.
+# the client owns one limit, so the fetch and mutation stages (and the daemon)
+# all draw on the same budget and each stage starts where the last one left off
+
+# ==========================================================================
+
+load_dotenv()
+CONCURRENCY_MIN = int(os.getenv('ASSETSONAR_CONCURRENCY_MIN', 1))
+CONCURRENCY_MAX = int(os.getenv('ASSETSONAR_CONCURRENCY_MAX', 16))
+CONCURRENCY_START = int(os.getenv('ASSETSONAR_CONCURRENCY_START', 4))
+LATENCY_TARGET = float(os.getenv('ASSETSONAR_LATENCY_TARGET', 5)) # seconds, slower responses count as overload, 0 disables
+DECREASE_FACTOR = 0.5
+
+# ==========================================================================
+
+def retry_after_seconds(response):
+  """Get a response's Retry-After in seconds
+
+  Args:
+    response (requests.Response): response, may be None
+
+  Returns:
+    float: seconds to wait, 0 if absent or unparseable
+  """
+  value = response.headers.get('Retry-After') if response is not None else None
+  if not value:
+    return 0
+  value = value.strip()
+  if value.isdigit():
+    return float(value)
+  try:
+    return max(0, parsedate_to_datetime(value).timestamp() - time.time()) # HTTP-date form
+  except (TypeError, ValueError):
+    return 0
+
+
+class AdaptiveLimit:
+  """Thread-safe AIMD limit on requests in flight"""
+
+  def __init__(self, start=CONCURRENCY_START, minimum=CONCURRENCY_MIN, maximum=CONCURRENCY_MAX,
+               latency_target=LATENCY_TARGET, service='assetsonar'):
+    self.minimum = max(1, minimum)
+    self.maximum = max(self.minimum, maximum)
+    self.limit = float(min(self.maximum, max(self.minimum, start)))
+    self.latency_target = latency_target
+    self.service = service
+    self.in_flight = 0
+    self.paused_until = 0
+    self.decreased_at = 0
+    self.condition = threading.Condition()
+    self.report()
+
+  def acquire(self):
+    """Block until a request may be sent, then count it as in flight
+
+    Returns:
+      float: monotonic send time, pass it back to release()
+    """
+    with self.condition:
+      while True:
+        wait = self.paused_until - time.monotonic()
+        if wait > 0:
+          self.condition.wait(wait)
+        elif self.in_flight >= int(self.limit):
+          self.condition.wait()
+        else:
+          break
+      self.in_flight += 1
+      return time.monotonic()
+
+  def release(self, sent, overloaded=False, seconds=0, retry_after=0):
+    """Count a request as finished and adjust the limit
+
+    Args:
+      sent (float): value returned by acquire()
+      overloaded (bool): the server pushed back (429, 503, 504, timeout)
+      seconds (float): response latency
+      retry_after (float): seconds the server asked every client to wait
+
+    Returns:
+      None
+    """
+    with self.condition:
+      saturated = self.in_flight >= int(self.limit)
+      self.in_flight -= 1
+      now = time.monotonic()
+      if overloaded or (self.latency_target and seconds > self.latency_target):
+        if sent >= self.decreased_at:
+          self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+          self.decreased_at = now
+          METRICS.count('concurrency_decreases_total', service=self.service)
+      elif saturated:
+        # only grow a limit that is actually being used
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      if retry_after:
+        self.paused_until = max(self.paused_until, now + retry_after)
+      self.report()
+      self.condition.notify_all()
+    return None
+
+  def report(self):
+    METRICS.gauge('concurrency_limit', int(self.limit), service=self.service)
@@ -0,0 +1,373 @@
+import argparse
+from dotenv import load_dotenv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import audit_users
+from jamf import JamfClient
+import journal
+from metrics import METRICS
+import parse_responses
+from query_jamf import COMPUTERS_INVENTORY, MOBILE_DEVICES_DETAIL
+from records import JamfUser
+import retire_assets
+from runlock import RunLock
+from store import get_store
+
+# event-driven mode: listen for Jamf webhooks and reconcile just the device
+# each event is about, within seconds instead of at the next daily run
+# the AssetSonar / Jamf sessions, the Jamf token, the member directory and an
+# in-memory serial -> checked out asset index stay warm between events
+# events are queued and handled one at a time while holding the same lockfile
+# as pipeline.py, so the daemon and a scheduled full audit never mutate at once;
+# every full audit bumps a generation in the store, and the index is reloaded
+# whenever the daemon takes the lock and finds it changed
+#
+#   python3 daemon.py --port 8765
+#   python3 webhook_sim.py --url http://127.0.0.1:8765/webhook C02ABC123
+#
+# point a Jamf Pro webhook (JSON) for each event in DAEMON_EVENTS at /webhook
+
+# ==========================================================================
+
+load_dotenv()
+DAEMON_HOST = os.getenv('DAEMON_HOST', '127.0.0.1')
+DAEMON_PORT = int(os.getenv('DAEMON_PORT', 8765))
+DAEMON_AUTH = os.getenv('DAEMON_AUTH', '') # required Authorization header, as set on the Jamf webhook
+DAEMON_EVENTS = set(os.getenv('DAEMON_EVENTS', 'ComputerAdded,ComputerInventoryCompleted,MobileDeviceEnrolled,'
+                                               'MobileDeviceUnEnrolled').split(','))
+DAEMON_TEXTFILE = os.getenv('DAEMON_TEXTFILE', 'asaudit_daemon.prom') # kept apart from the audit run's METRICS_TEXTFILE, '' disables
+DAEMON_CONFIRM_SECONDS = float(os.getenv('DAEMON_CONFIRM_SECONDS', 5)) # wait before the lookup that confirms a retire
+
+# ==========================================================================
+
+def event_serial(payload):
+  """Get the event name and device serial number from a Jamf webhook payload
+
+  Args:
+    payload (dict): webhook JSON that passed well_formed(), {'webhook': {'webhookEvent': ...}, 'event': {...}}
+
+  Returns:
+    tuple: (event name or None, serial number or None)
+  """
+  name = (payload.get('webhook') or {}).get('webhookEvent')
+  event = payload.get('event') or {}
+  # computer events nest the device under 'computer' for some event types
+  computer = event.get('computer')
+  serial = event.get('serialNumber') or (computer.get('serialNumber') if isinstance(computer, dict) else None)
+  # anything but strings is treated as missing, so odd payloads are ignored rather than crashing
+  return (name if isinstance(name, str) else None,
+          serial.strip().upper() if isinstance(serial, str) and serial.strip() else None)
+
+
+def same_serial(record, serial):
+  # a filter Jamf didn't apply returns some other device first
+  found = (record.get('hardware') or {}).get('serialNumber') or ''
+  return found.strip().upper() == serial.upper()
+
+
+def well_formed(payload):
+  """Check a webhook body has the shape event_serial() reads
+
+  Args:
+    payload: decoded webhook JSON
+
+  Returns:
+    bool: True if payload, its webhook and its event are objects
+  """
+  if not isinstance(payload, dict):
+    return False
+  return all(isinstance(payload.get(part) or {}, dict) for part in ('webhook', 'event'))
+
+
+def lookup_jamf(client, serial):
+  """Get a device's Jamf id and user straight from Jamf
+
+  Args:
+    client (JamfClient): Jamf client
+    serial (str): device serial number
+
+  Returns:
+    tuple: (Jamf id, JamfUser or None), (None, None) if Jamf has no such device
+  """
+  computers = client.get_json(COMPUTERS_INVENTORY, {'section': ['HARDWARE', 'USER_AND_LOCATION'],
+                                                    'filter': f'hardware.serialNumber=="{serial}"', 'page-size': 1})
+  for computer in computers.get('results', []):
+    if same_serial(computer, serial):
+      return str(computer['id']), JamfUser.from_api(computer.get('userAndLocation') or {})
+  devices = client.get_json(MOBILE_DEVICES_DETAIL, {'section': ['HARDWARE', 'USER_AND_LOCATION'],
+                                                    'filter': f'serialNumber=="{serial}"', 'page-size': 1})
+  for device in devices.get('results', []):
+    if same_serial(device, serial):
+      return str(device['mobileDeviceId']), JamfUser.from_api(device.get('userAndLocation') or {})
+  return None, None
+
+
+class Daemon:
+  """Queue of serials from webhooks, reconciled one at a time by a worker thread"""
+
+  def __init__(self, jamf=None, lock=None):
+    self.jamf = jamf or JamfClient() # no response cache, lookups must see the device as it is now
+    self.lock = lock or RunLock()
+    self.store = get_store()
+    self.queue = queue.Queue()
+    self.queued = set() # serials waiting, so a burst of events for one device is handled once
+    self.queued_lock = threading.Lock()
+    self.assets = {}
+    self.generation = None # store's audit generation the index was loaded at
+    self.stats = {'received': 0, 'ignored': 0, 'reconciled': 0, 'failed': 0, 'last': None}
+    self.stats_lock = threading.Lock() # submit() runs on the HTTP handler threads
+
+  def load_index(self):
+    """Index the store's checked out assets by serial number
+
+    Returns:
+      None
+    """
+    self.generation = self.store.audit_generation()
+    self.assets = {a.serial_no: a for a in self.store.assets('checked_out')}
+    print(f'Indexed {len(self.assets)} checked out assets from {self.store.path}')
+    return None
+
+  def count(self, key, value=1):
+    with self.stats_lock:
+      self.stats[key] += value
+
+  def health(self):
+    with self.stats_lock:
+      stats = dict(self.stats)
+    return {**stats, 'queued': self.queue.qsize(), 'indexed': len(self.assets)}
+
+  def submit(self, payload):
+    """Queue the device a webhook is about
+
+    Args:
+      payload (dict): webhook JSON
+
+    Returns:
+      tuple: (HTTP status, response body)
+    """
+    name, serial = event_serial(payload)
+    self.count('received')
+    METRICS.count('daemon_events_total', event=name or 'unknown')
+    if name not in DAEMON_EVENTS or not serial:
+      self.count('ignored')
+      return 200, {'ignored': name}
+    with self.queued_lock:
+      if serial not in self.queued:
+        self.queued.add(serial)
+        self.queue.put((serial, name, time.time()))
+    return 202, {'queued': serial}
+
+  def reconcile(self, serial):
+    """Audit one serial against Jamf and fix it in AssetSonar like the full audit would
+
+    Args:
+      serial (str): device serial number
+
+    Returns:
+      dict: what was done, e.g. {'serial_no', 'category', 'record'}
+    """
+    asset = self.assets.get(serial)
+    if asset is None:
+      return {'serial_no': serial, 'category': 'not_checked_out'}
+
+    jamf_id, user = lookup_jamf(self.jamf, serial)
+    if jamf_id is None:
+      if asset.manufacturer != 'Apple':
+        return {'serial_no': serial, 'category': 'not_in_jamf', 'record': 'non-Apple, skipped'}
+      if not self.confirm_missing(serial):
+        return {'serial_no': serial, 'category': 'not_in_jamf', 'record': 'unconfirmed, left to the full audit'}
+      return {'serial_no': serial, 'category': 'not_in_jamf', 'record': self.mutate('retire', asset)}
+
+    asset.jamf_id = jamf_id
+    asset.jamf_user_data = user
+    assigned = parse_responses.sort_assignments({'assets_in_jamf': [asset]})
+    category = next(c for c in ('correct_user', 'wrong_user', 'unassigned') if assigned[c])
+    if category == 'wrong_user':
+      return {'serial_no': serial, 'category': category, 'record': self.mutate('reassign', asset)}
+    if category == 'unassigned':
+      return {'serial_no': serial, 'category': category, 'record': self.mutate('assign', asset)}
+    return {'serial_no': serial, 'category': category}
+
+  def confirm_missing(self, serial):
+    """Check that a device one lookup didn't find is really gone before retiring it
+
+    Retiring is the one mutation a flaky Jamf response can do real damage
+    with, so the device must also be missing from the last full audit's Jamf
+    snapshot and from a second lookup a little later.
+
+    Args:
+      serial (str): device serial number
+
+    Returns:
+      bool: True if the device is not in Jamf
+    """
+    if self.store.jamf_device(serial) is not None:
+      return False
+    time.sleep(DAEMON_CONFIRM_SECONDS)
+    jamf_id, _ = lookup_jamf(self.jamf, serial)
+    return jamf_id is None
+
+  def mutate(self, action, asset):
+    """Run one mutation through the journal and keep the index / store snapshot current
+
+    Args:
+      action (str): retire, reassign or assign
+      asset (Asset): joined asset
+
+    Returns:
+      dict: mutation record, or the journal's skip record
+    """
+    _, skipped = journal.split_settled(action, [asset], self.store)
+    if skipped:
+      return skipped[0][1]
+    status = 'checked_out'
+    if action == 'retire':
+      record = retire_assets.checkin_and_retire(asset, status)
+    elif action == 'reassign':
+      record = audit_users.reassign_asset(asset, status)
+    else:
+      record = audit_users.assign_unassigned(asset)
+    if record.get('checkout') != 'NO_EMAIL':
+      journal.record(action, [asset], [record], self.store)
+
+    if record.get('ok') and action == 'retire':
+      self.store.merge_assets('checked_out', [], removed=[asset.asset_id])
+      self.assets.pop(asset.serial_no, None)
+    elif record.get('ok'):
+      asset.assigned_email = asset.jamf_email()
+      self.store.merge_assets('checked_out', [asset])
+    return record
+
+  def take_lock(self):
+    # a full audit rewrites the snapshot, so reindex if one finished since the last load,
+    # whether it ran while events were waiting or while the daemon was idle
+    if not self.lock.acquire(blocking=False):
+      print(f'Full audit running (pid {self.lock.holder()}), holding events until it finishes')
+      self.lock.acquire()
+    if self.store.audit_generation() != self.generation:
+      self.load_index()
+    return None
+
+  def next_event(self, timeout=None):
+    serial, name, received = self.queue.get(timeout=timeout)
+    with self.queued_lock:
+      self.queued.discard(serial)
+    return serial, name, received
+
+  def work(self):
+    """Handle queued events forever, holding the lockfile only while there are events
+
+    Returns:
+      None
+    """
+    while True:
+      event = self.next_event()
+      self.take_lock()
+      try:
+        while event is not None:
+          self.handle(*event)
+          try:
+            event = self.next_event(timeout=0)
+          except queue.Empty:
+            event = None
+      finally:
+        self.lock.release()
+      METRICS.write_textfile() # a long-running process never reaches the atexit write
+
+  def handle(self, serial, name, received):
+    start = time.perf_counter()
+    try:
+      result = self.reconcile(serial)
+      self.count('reconciled')
+      outcome = 'ok'
+    except Exception:
+      print(f'{name} {serial} failed:\n{traceback.format_exc()}', file=sys.stderr)
+      result = {'serial_no': serial, 'error': traceback.format_exc(limit=1)}
+      self.count('failed')
+      outcome = 'error'
+    METRICS.count('daemon_reconciled_total', result=outcome)
+    METRICS.stage_done('daemon_event', time.perf_counter() - start, outcome == 'ok')
+    with self.stats_lock:
+      self.stats['last'] = {**result, 'event': name, 'seconds': round(time.time() - received, 3)}
+    print(f'{name} {serial}: {json.dumps(result)} ({time.time() - received:.2f}s after receipt)')
+    return result
+
+
+def make_handler(daemon):
+  """Build a request handler class bound to a Daemon
+
+  Args:
+    daemon (Daemon): event queue
+
+  Returns:
+    type: BaseHTTPRequestHandler subclass
+  """
+  class Handler(BaseHTTPRequestHandler):
+    def reply(self, status, body):
+      payload = json.dumps(body).encode()
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def do_GET(self):
+      if self.path != '/health':
+        return self.reply(404, {'error': 'not found'})
+      return self.reply(200, daemon.health())
+
+    def do_POST(self):
+      if self.path != '/webhook':
+        return self.reply(404, {'error': 'not found'})
+      if DAEMON_AUTH and self.headers.get('Authorization') != DAEMON_AUTH:
+        return self.reply(401, {'error': 'unauthorized'})
+      try:
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+      except ValueError: # bad Content-Length, or JSONDecodeError
+        return self.reply(400, {'error': 'invalid JSON'})
+      if not well_formed(payload):
+        return self.reply(400, {'error': 'expected a Jamf webhook object'})
+      return self.reply(*daemon.submit(payload))
+
+    def log_message(self, format, *args):
+      pass # every event is printed once it's handled
+
+  return Handler
+
+# ==========================================================================
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Reconcile devices as Jamf webhooks arrive')
+  parser.add_argument('--host', default=DAEMON_HOST)
+  parser.add_argument('--port', type=int, default=DAEMON_PORT)
+  options = parser.parse_args(argv)
+
+  METRICS.claim_textfile(DAEMON_TEXTFILE)
+  daemon = Daemon()
+  with daemon.lock:
+    daemon.load_index()
+  threading.Thread(target=daemon.work, name='reconcile', daemon=True).start()
+  server = ThreadingHTTPServer((options.host, options.port), make_handler(daemon))
+  server.daemon_threads = True
+  print(f'Listening for Jamf webhooks on http://{options.host}:{server.server_port}/webhook')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    daemon.jamf.invalidate_token()
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  print('\n\n--- daemon.py ---')
+  sys.exit(main())
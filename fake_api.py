@@ -0,0 +1,320 @@
+import argparse
+from collections import Counter
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import fleet
+
+# local stand-in for the AssetSonar and Jamf Pro APIs, for load testing
+# serves a synthetic fleet (fleet.py) on every endpoint the pipeline uses, with
+# configurable latency, page sizes, 429 rate limiting, a concurrency capacity
+# (503 beyond it) and injected faults
+#
+#   python3 fake_api.py --devices 20000 --latency 50 --rate-limit 20
+#   ASSETSONAR_URL=http://127.0.0.1:8080 JAMF_URL=http://127.0.0.1:8080 python3 pipeline.py
+#
+# GET /_stats returns request counters as JSON
+# GET responses carry an ETag and If-None-Match is answered with a 304
+# AssetSonar list endpoints honour per_page (up to --as-max-page-size) and exact-match
+# field filters such as manufacturer=Apple, and only carry custom fields with
+# include_custom_fields=true;
+# delta filters (updated_since, RSQL filter) are ignored, so deltas get every record;
+# a serialNumber=="..." filter, as daemon.py sends, returns that one device with its user
+
+# ==========================================================================
+
+MUTATION_PATH = re.compile(r'^/assets/(\d+)/(checkin|checkout|retire)\.api$')
+LIST_PARAMS = {'page', 'per_page', 'status', 'include_custom_fields', 'updated_since'}
+# stands in for the custom fields a real tenant carries on every record
+CUSTOM_FIELDS = {'custom_attributes': {f'Custom Field {i}': f'value {i}' * 4 for i in range(12)}}
+SERIAL_FILTER = re.compile(r'serialNumber=="([^"]+)"')
+
+# ==========================================================================
+
+class RateLimiter:
+  """Fixed-window request counter answering 429 once a second's quota is used"""
+
+  def __init__(self, rate):
+    self.rate = rate
+    self.window = 0
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def allow(self):
+    """Count a request
+
+    Returns:
+      bool: False if the request should get a 429
+    """
+    if self.rate <= 0:
+      return True
+    with self.lock:
+      now = int(time.time())
+      if now != self.window:
+        self.window = now
+        self.count = 0
+      self.count += 1
+      return self.count <= self.rate
+
+
+class FakeAPI:
+  """In-memory AssetSonar + Jamf state shared by the request handlers"""
+
+  def __init__(self, data, options):
+    self.options = options
+    self.lock = threading.Lock()
+    self.stats = Counter()
+    self.limiter = RateLimiter(options.rate_limit)
+    self.in_flight = 0
+    self.tokens = {} # Jamf bearer token -> expiry
+    self.members = data['members']
+    self.member_emails = {m['id']: m['email'] for m in self.members}
+    self.jamf = {name: data[name] for name in ('computers', 'computer_users', 'devices', 'device_users')}
+    self.assets = {}
+    for status in ('checked_out', 'available'):
+      for asset in data[status]:
+        self.assets[asset['sequence_num']] = {**asset, 'status': status}
+
+  # --- AssetSonar ---
+
+  def filter_assets(self, query):
+    status = query.get('status')
+    filters = {k: v for k, v in query.items() if k not in LIST_PARAMS}
+    with self.lock:
+      assets = [a for a in self.assets.values() if (status is None or a['status'] == status)
+                and all(str(a.get(k)) == v for k, v in filters.items())]
+    return self.as_page(assets, 'assets', query)
+
+  def search_assets(self, query):
+    term = query.get('search', '').upper()
+    with self.lock:
+      assets = [a for a in self.assets.values() if term and term in a['bios_serial_number'].upper()]
+    return self.as_page(assets, 'assets', query)
+
+  def as_page(self, items, key, query):
+    size = min(int(query.get('per_page') or self.options.as_page_size), self.options.as_max_page_size)
+    page = int(query.get('page', 1))
+    total_pages = max(1, -(-len(items) // size))
+    items = items[(page - 1) * size:page * size]
+    if query.get('include_custom_fields') == 'true':
+      items = [{**item, **CUSTOM_FIELDS} for item in items]
+    return 200, {key: items, 'page': page, 'total_pages': total_pages}
+
+  def mutate(self, asset_id, action, query):
+    with self.lock:
+      asset = self.assets.get(asset_id)
+      if asset is None:
+        return 404, {'error': f'asset {asset_id} not found'}
+      if action == 'checkin':
+        asset['status'] = 'available'
+        asset.pop('assigned_to_user_email', None)
+      elif action == 'checkout':
+        email = self.member_emails.get(int(query['user_id'])) if query.get('user_id', '').isdigit() else None
+        if email is None:
+          return 422, {'error': 'user not found'}
+        asset['status'] = 'checked_out'
+        asset['assigned_to_user_email'] = email
+      else:
+        asset['status'] = 'retired'
+      return 200, dict(asset)
+
+  # --- Jamf ---
+
+  def issue_token(self):
+    token = secrets.token_hex(16)
+    with self.lock:
+      self.tokens[token] = time.time() + self.options.token_ttl
+    return 200, {'access_token': token, 'token_type': 'Bearer', 'expires_in': self.options.token_ttl}
+
+  def authorized(self, header):
+    token = (header or '').removeprefix('Bearer ')
+    with self.lock:
+      return self.tokens.get(token, 0) > time.time()
+
+  def jamf_page(self, name, query):
+    results = self.jamf[name]['results']
+    size = int(query.get('page-size', 100))
+    page = int(query.get('page', 0))
+    return 200, {'totalCount': len(results), 'results': results[page * size:(page + 1) * size]}
+
+  def jamf_lookup(self, serial, mobile):
+    # one device by serial, hardware and user sections merged like a multi-section request
+    if mobile:
+      device = next((d for d in self.jamf['devices']['mobile_devices'] if d['serial_number'] == serial), None)
+      users = {u['mobileDeviceId']: u for u in self.jamf['device_users']['results']}
+      results = [] if device is None else [{**users.get(str(device['id']), {}), 'mobileDeviceId': str(device['id']),
+                                            'hardware': {'serialNumber': serial}}]
+    else:
+      computer = next((c for c in self.jamf['computers']['results'] if c['hardware']['serialNumber'] == serial), None)
+      users = {u['id']: u for u in self.jamf['computer_users']['results']}
+      results = [] if computer is None else [{**users.get(computer['id'], {}), **computer}]
+    return 200, {'totalCount': len(results), 'results': results}
+
+  # --- routing ---
+
+  def route(self, method, path, query, headers):
+    """Answer one request
+
+    Returns:
+      tuple: (status code, JSON body)
+    """
+    if path == '/_stats':
+      with self.lock:
+        return 200, dict(self.stats)
+    if not self.limiter.allow():
+      return 429, {'error': 'rate limited'}
+    if random.random() < self.options.fault_rate:
+      return random.choice((500, 502, 503)), {'error': 'injected fault'}
+
+    if path.endswith('.api'):
+      if not headers.get('token'):
+        return 401, {'error': 'missing token'}
+      match = MUTATION_PATH.match(path)
+      if method == 'PUT' and match:
+        return self.mutate(int(match.group(1)), match.group(2), query)
+      if method == 'GET' and path == '/assets/filter.api':
+        return self.filter_assets(query)
+      if method == 'GET' and path == '/search.api':
+        return self.search_assets(query)
+      if method == 'GET' and path == '/members.api':
+        return self.as_page(self.members, 'members', query)
+      return 404, {'error': f'{method} {path} not found'}
+
+    if method == 'POST' and path == '/api/oauth/token':
+      return self.issue_token()
+    if not self.authorized(headers.get('Authorization')):
+      return 401, {'error': 'invalid token'}
+    if method == 'POST' and path == '/api/v1/auth/invalidate-token':
+      with self.lock:
+        self.tokens.pop(headers['Authorization'].removeprefix('Bearer '), None)
+      return 204, None
+    if method == 'GET' and path == '/api/v1/jamf-pro-version':
+      return 200, {'version': '11.0.0-fake'}
+    lookup = SERIAL_FILTER.search(query.get('filter', ''))
+    if method == 'GET' and lookup and path in ('/api/v1/computers-inventory', '/api/v2/mobile-devices/detail'):
+      return self.jamf_lookup(lookup.group(1), mobile='mobile' in path)
+    if method == 'GET' and path == '/api/v1/computers-inventory':
+      section = query.get('section', 'GENERAL')
+      return self.jamf_page('computer_users' if section == 'USER_AND_LOCATION' else 'computers', query)
+    if method == 'GET' and path == '/api/v2/mobile-devices/detail':
+      return self.jamf_page('device_users', query)
+    if method == 'GET' and path == '/JSSResource/mobiledevices':
+      return 200, self.jamf['devices']
+    return 404, {'error': f'{method} {path} not found'}
+
+
+def make_handler(api):
+  """Build a request handler class bound to a FakeAPI
+
+  Args:
+    api (FakeAPI): shared state
+
+  Returns:
+    type: BaseHTTPRequestHandler subclass
+  """
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real APIs
+
+    def handle_request(self, method):
+      url = urlparse(self.path)
+      query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+      length = int(self.headers.get('Content-Length') or 0)
+      if length:
+        # form bodies (oauth) are read and ignored
+        self.rfile.read(length)
+      with api.lock:
+        api.in_flight += 1
+        overloaded = 0 < api.options.capacity < api.in_flight
+      try:
+        if api.options.latency:
+          time.sleep(max(0, random.gauss(api.options.latency, api.options.jitter)) / 1000)
+        if overloaded:
+          status, body = 503, {'error': 'over capacity'}
+        else:
+          status, body = api.route(method, url.path, query, self.headers)
+      finally:
+        with api.lock:
+          api.in_flight -= 1
+      payload = json.dumps(body).encode() if body is not None else b''
+      etag = None
+      if method == 'GET' and status == 200:
+        etag = '"' + hashlib.sha1(payload).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+          status, payload = 304, b''
+      with api.lock:
+        api.stats[f'{method} {url.path if not MUTATION_PATH.match(url.path) else url.path.split("/")[-1]}'] += 1
+        api.stats[str(status)] += 1
+
+      self.send_response(status)
+      if etag:
+        self.send_header('ETag', etag)
+      if status == 429:
+        self.send_header('Retry-After', '1')
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def do_GET(self):
+      self.handle_request('GET')
+
+    def do_PUT(self):
+      self.handle_request('PUT')
+
+    def do_POST(self):
+      self.handle_request('POST')
+
+    def log_message(self, format, *args):
+      if api.options.verbose:
+        super().log_message(format, *args)
+
+  return Handler
+
+# ==========================================================================
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Fake AssetSonar + Jamf Pro API for load testing')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--devices', type=int, default=5000, help='synthetic fleet size, see fleet.py')
+  parser.add_argument('--mismatch', type=float, default=0.1)
+  parser.add_argument('--unassigned', type=float, default=0.05)
+  parser.add_argument('--not-in-jamf', type=float, default=0.05)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--latency', type=float, default=0, help='mean response latency in ms')
+  parser.add_argument('--jitter', type=float, default=0, help='latency standard deviation in ms')
+  parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before answering 429, 0 disables')
+  parser.add_argument('--capacity', type=int, default=0, help='concurrent requests before answering 503, 0 disables')
+  parser.add_argument('--fault-rate', type=float, default=0, help='share of requests answered with a 5xx')
+  parser.add_argument('--as-page-size', type=int, default=25, help='AssetSonar records per page')
+  parser.add_argument('--as-max-page-size', type=int, default=100, help='largest per_page AssetSonar accepts')
+  parser.add_argument('--token-ttl', type=int, default=1200, help='Jamf token lifetime in seconds')
+  parser.add_argument('--verbose', action='store_true', help='log every request')
+  options = parser.parse_args(argv)
+
+  data = fleet.generate(options.devices, mismatch=options.mismatch, unassigned=options.unassigned,
+                        not_in_jamf=options.not_in_jamf, seed=options.seed)
+  api = FakeAPI(data, options)
+  server = ThreadingHTTPServer((options.host, options.port), make_handler(api))
+  server.daemon_threads = True
+  print(f'Fake AssetSonar + Jamf API on http://{options.host}:{server.server_port} - {options.devices} devices')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    print(json.dumps(dict(api.stats), indent=2, sort_keys=True))
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,137 @@
+import json
+import os
+import random
+
+# synthetic fleet generator for benchmarks and load tests
+# builds AssetSonar and Jamf payloads in the same shape the APIs return, with
+# configurable size and share of wrong-user, unassigned and not-in-Jamf assets
+
+# ==========================================================================
+
+DOMAIN = 'example.com'
+MODELS = ['MacBook Pro', 'MacBook Air', 'iMac', 'Mac mini', 'iPad', 'iPad Air', 'iPhone']
+
+# ==========================================================================
+
+def serial_number(i):
+  """Get a deterministic 12 character Apple-style serial number
+
+  Args:
+    i (int): device index
+
+  Returns:
+    str: serial number
+  """
+  return f'C02{i:09d}'
+
+
+def generate(devices, mobile_ratio=0.3, mismatch=0.1, unassigned=0.05, not_in_jamf=0.05,
+             available=0.05, members=None, seed=0):
+  """Generate a synthetic fleet
+
+  Every Jamf device gets a checked out AssetSonar asset. Of those, `mismatch`
+  are checked out to a different member than Jamf has, and `unassigned` have
+  no email in Jamf. `not_in_jamf` * devices extra checked out Apple assets have
+  no Jamf record, and `available` * devices extra assets are checked in with a
+  candidate email.
+
+  Args:
+    devices (int): devices in Jamf
+    mobile_ratio (float): share of devices that are mobile devices rather than computers
+    mismatch (float): share of devices whose AS email differs from Jamf
+    unassigned (float): share of devices with no Jamf email
+    not_in_jamf (float): extra checked out assets missing from Jamf, as a share of devices
+    available (float): extra available assets, as a share of devices
+    members (int): AS members, defaults to one per device
+    seed (int): random seed, the same arguments always give the same fleet
+
+  Returns:
+    dict: computers, computer_users, devices, device_users (Jamf responses),
+      checked_out and available (filter.api assets) and members (members.api members)
+  """
+  rng = random.Random(seed)
+  members = members or max(1, devices)
+  emails = [f'user{i}@{DOMAIN}' for i in range(members)]
+
+  fleet = {
+    'computers': {'results': [], 'totalCount': 0},
+    'computer_users': {'results': [], 'totalCount': 0},
+    'devices': {'mobile_devices': []},
+    'device_users': {'results': [], 'totalCount': 0},
+    'checked_out': [],
+    'available': [],
+    'members': [],
+  }
+  for i, email in enumerate(emails):
+    fleet['members'].append({'id': i + 1, 'full_name': f'User {i}', 'email': email, 'EGY': None,
+                             'role_name': 'Staff'})
+
+  asset_id = 0
+  for i in range(devices):
+    sn = serial_number(i)
+    email = emails[i % members]
+    roll = rng.random()
+    jamf_email = None if roll < unassigned else email
+    as_email = emails[(i + 1) % members] if unassigned <= roll < unassigned + mismatch else email
+    jamf_id = str(i + 1)
+    user = {'username': email.split('@')[0], 'realname': f'User {i % members}', 'email': jamf_email,
+            'position': 'Staff', 'phone': '', 'departmentId': '-1', 'buildingId': '-1', 'room': ''}
+
+    if rng.random() < mobile_ratio:
+      model = rng.choice(MODELS[4:])
+      fleet['devices']['mobile_devices'].append({
+        'id': int(jamf_id), 'name': f'{model} {i}', 'device_name': f'{model} {i}', 'udid': f'{i:032x}',
+        'serial_number': sn, 'phone_number': '', 'wifi_mac_address': '00:00:00:00:00:00',
+        'managed': True, 'supervised': True, 'model': model, 'model_identifier': 'iPad13,1',
+        'model_display': model, 'username': user['username']})
+      fleet['device_users']['results'].append({
+        'mobileDeviceId': jamf_id, 'deviceType': 'iOS',
+        'userAndLocation': {'username': user['username'], 'realName': user['realname'],
+                            'emailAddress': jamf_email, 'position': 'Staff', 'phoneNumber': '',
+                            'departmentId': '-1', 'buildingId': '-1', 'room': ''}})
+    else:
+      model = rng.choice(MODELS[:4])
+      fleet['computers']['results'].append({
+        'id': jamf_id, 'udid': f'{i:032x}',
+        'hardware': {'make': 'Apple', 'model': model, 'modelIdentifier': 'Mac14,2', 'serialNumber': sn,
+                     'processorType': 'Apple M2', 'processorArchitecture': 'arm64', 'coreCount': 8,
+                     'totalRamMegabytes': 16384, 'macAddress': '00:00:00:00:00:00',
+                     'extensionAttributes': [{'definitionId': '1', 'name': 'Warranty', 'values': ['2027-01-01']}]}})
+      fleet['computer_users']['results'].append({'id': jamf_id, 'udid': f'{i:032x}', 'userAndLocation': user})
+
+    asset_id += 1
+    fleet['checked_out'].append({'sequence_num': asset_id, 'bios_serial_number': sn, 'name': f'{model} {i}',
+                                 'assigned_to_user_email': as_email, 'manufacturer': 'Apple'})
+
+  for j in range(int(devices * not_in_jamf)):
+    asset_id += 1
+    fleet['checked_out'].append({'sequence_num': asset_id, 'bios_serial_number': serial_number(devices + j),
+                                 'name': f'Retired Mac {j}', 'assigned_to_user_email': emails[j % members],
+                                 'manufacturer': 'Apple'})
+
+  offset = devices + int(devices * not_in_jamf)
+  for j in range(int(devices * available)):
+    asset_id += 1
+    fleet['available'].append({'sequence_num': asset_id, 'bios_serial_number': serial_number(offset + j),
+                               'name': f'Spare Mac {j}', 'candidate_email': emails[j % members],
+                               'manufacturer': 'Apple'})
+
+  for name in ('computers', 'computer_users', 'device_users'):
+    fleet[name]['totalCount'] = len(fleet[name]['results'])
+  return fleet
+
+
+def write_jamf_files(fleet, directory='.'):
+  """Write a fleet's Jamf responses as the response_jamf_*.json files query_jamf.py saves
+
+  Args:
+    fleet (dict): fleet from generate()
+    directory (str): where to write the files
+
+  Returns:
+    None
+  """
+  for name in ('computers', 'computer_users', 'devices', 'device_users'):
+    with open(os.path.join(directory, f'response_jamf_{name}.json'), 'w') as f:
+      json.dump(fleet[name], f)
+  return None
@@ -1,16 +1,13 @@
-import json
 from datetime import datetime
 import csv
+from history import get_history
+from metrics import METRICS
+from records import Asset
+from store import get_store
 
 # ==========================================================================
 
-def read(filename):
-  with open(filename, 'r') as f:
-    return json.load(f)
-
-ALL_ASSETS = read('assets.json')
-NO_JAMF_USER = read('assets_no_jamf_user.json')
-RETIRED = read('assets_retired.json')
+IN_JAMF_CATEGORIES = ('correct_user', 'wrong_user', 'unassigned')
 
 # ==========================================================================
 
@@ -26,39 +23,92 @@ def get_asset_status(asset):
 
 # ==========================================================================
 
-def main():
+def assignment_state(asset, no_jamf_user):
+  """Get an in-Jamf asset's history state, see history.STATES
+
+  Args:
+    asset (Asset): reconciled asset
+    no_jamf_user (set): serial numbers with no Jamf user
+
+  Returns:
+    str: state
+  """
+  if asset.serial_no in no_jamf_user:
+    return 'no_jamf_user'
+  jamf_email = asset.jamf_email()
+  if jamf_email is None:
+    return 'unassigned'
+  return 'correct_user' if asset.assigned_email == jamf_email else 'wrong_user'
+
+
+def write_delta(delta_file, history):
+  """Write the issues new or resolved since the previous run
+
+  Args:
+    delta_file (str): CSV file to write
+    history (History): audit history, the run to report was appended last
+
+  Returns:
+    int: number of changes written
+  """
+  changes = 0
+  with open(delta_file, 'w') as f:
+    writer = csv.writer(f)
+    writer.writerow(['Change', 'Serial Number', 'Status', 'Previous Status', 'AssetSonar Email', 'Jamf Email'])
+    for change, serial, state, was, as_email, jamf_email in history.delta():
+      writer.writerow([change, serial, state or 'Gone', was or 'New', as_email, jamf_email or 'N/A'])
+      changes += 1
+  return changes
+
+
+def main(assets_in_jamf=None, no_jamf_user=None):
+  """Write the audit report CSV to reports/ and append the run to the audit history
+
+  Args:
+    assets_in_jamf (list): reconciled Asset records found in Jamf, read from the store if None
+    no_jamf_user (iterable): serial numbers with no Jamf user, read from the store if None
+
+  Returns:
+    str: report file path
+  """
   # start
-  report = []
-  for asset in ALL_ASSETS.get('assets_in_jamf', []):
-    this = {}
-    if asset['serial_no'] in NO_JAMF_USER:
-      this['status'] = 'No Jamf User'
-    else:
-      this['status'] = 'Good'
-
-    this['Serial Number'] = asset['serial_no']
-    this['Device Name'] = asset['name']
-    this['AssetSonar Email'] = asset.get('assigned_email')
-    try:
-      this['Jamf Email'] = asset['jamf_user_data']['email']
-    except KeyError:
-      this['Jamf Email'] = "N/A"
-    # print(this)
-    report.append(this)
+  store = get_store()
+  if no_jamf_user is None:
+    no_jamf_user = store.outcome_serials('reassign', 'no_jamf_user')
+  no_jamf_user = set(no_jamf_user)
+  if assets_in_jamf is None:
+    # one category at a time, never the whole reconcile in memory
+    assets_in_jamf = (Asset.from_dict(a) for category in IN_JAMF_CATEGORIES for a in store.outcomes('reconcile', category))
 
+  # rows are written as they're built; only the compact history columns are kept
+  history_rows = []
   timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-  with open(f'reports/{timestamp}.csv', 'w') as f:
+  report_file = f'reports/{timestamp}.csv'
+  with open(report_file, 'w') as f:
     writer = csv.writer(f)
     writer.writerow(['Status', 'Serial Number', 'Device Name', 'AssetSonar Email', 'Jamf Email'])
-    for row in report:
-      writer.writerow(row.values())
+    for asset in assets_in_jamf:
+      state = assignment_state(asset, no_jamf_user)
+      writer.writerow(['No Jamf User' if state == 'no_jamf_user' else 'Good', asset.serial_no, asset.name,
+                       asset.assigned_email, asset.jamf_email() or "N/A"])
+      history_rows.append((asset.serial_no, state, asset.assigned_email, asset.jamf_email()))
   print(f'Created AssetSonar audit report {timestamp}.csv')
 
+  history = get_history()
+  if history is not None:
+    for asset in map(Asset.from_dict, store.outcomes('reconcile', 'not_in_jamf')):
+      history_rows.append((asset.serial_no, 'not_in_jamf', asset.assigned_email, None))
+    history.append_run(history_rows)
+    changes = write_delta(f'reports/{timestamp}_delta.csv', history)
+    print(f'Created delta report {timestamp}_delta.csv - {changes} issues new or resolved since the last run')
+
   #done
   print("Done")
+  return report_file
 
 # ==========================================================================
 
 if __name__ == '__main__':
   print(f'\n\n--- generate_report.py ---')
-  main()
+  with METRICS.stage('generate_report'):
+    main()
@@ -0,0 +1,301 @@
+from array import array
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+# long-term audit history, kept apart from the working store so it survives
+# store resets and report pruning
+# every run appends one segment: its serials, states and emails stored column
+# by column, each column zlib-compressed, so a year of daily runs stays small.
+# alongside, each asset's states are run-length encoded into spans
+# (serial, state, first run, last run); time-in-state and trend queries read
+# the spans and run totals and never decompress a segment, and delta reports
+# decompress only the two runs they compare
+#
+#   python3 history.py trend
+#   python3 history.py delta
+#   python3 history.py asset C02ABC123
+
+# ==========================================================================
+
+load_dotenv()
+HISTORY_FILE = os.getenv('HISTORY_FILE', 'history.db') # '' disables
+
+STATES = ('correct_user', 'wrong_user', 'unassigned', 'no_jamf_user', 'not_in_jamf')
+ISSUE_STATES = frozenset(STATES[1:])
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  run_id INTEGER PRIMARY KEY,
+  run_at REAL NOT NULL,
+  counts TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS serials (
+  id INTEGER PRIMARY KEY,
+  serial_no TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS segments (
+  run_id INTEGER PRIMARY KEY,
+  serial_ids BLOB NOT NULL,
+  states BLOB NOT NULL,
+  as_emails BLOB NOT NULL,
+  jamf_emails BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS spans (
+  serial_id INTEGER NOT NULL,
+  state INTEGER NOT NULL,
+  first_run INTEGER NOT NULL,
+  last_run INTEGER NOT NULL,
+  PRIMARY KEY (serial_id, first_run)
+);
+CREATE INDEX IF NOT EXISTS idx_spans_last_run ON spans (last_run);
+'''
+
+# ==========================================================================
+
+def pack_ints(values):
+  return zlib.compress(array('I', values).tobytes())
+
+def unpack_ints(blob):
+  values = array('I')
+  values.frombytes(zlib.decompress(blob))
+  return values
+
+def pack_strings(values):
+  return zlib.compress('\n'.join(v or '' for v in values).encode())
+
+def unpack_strings(blob):
+  return [v or None for v in zlib.decompress(blob).decode().split('\n')]
+
+
+def format_time(epoch):
+  return datetime.fromtimestamp(epoch).isoformat(sep=' ', timespec='seconds')
+
+
+class History:
+  """Append-only per-run audit history with run-length encoded state spans"""
+
+  def __init__(self, path=HISTORY_FILE):
+    self.path = path
+    self.conn = sqlite3.connect(path)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.executescript(SCHEMA)
+
+  def close(self):
+    self.conn.close()
+
+  def serial_ids(self, serials):
+    """Get the dictionary id of each serial number, adding new ones
+
+    Args:
+      serials (list): serial numbers
+
+    Returns:
+      dict: serial number -> id
+    """
+    self.conn.executemany('INSERT OR IGNORE INTO serials (serial_no) VALUES (?)', [(s,) for s in serials])
+    return dict(self.conn.execute('SELECT serial_no, id FROM serials'))
+
+  def append_run(self, rows, run_at=None):
+    """Append one run's reconciled outcomes
+
+    Args:
+      rows (iterable): (serial number, state, AssetSonar email, Jamf email), state one of STATES
+      run_at (float): epoch seconds, defaults to now
+
+    Returns:
+      int: run id
+    """
+    latest = {}
+    for serial, state, as_email, jamf_email in rows:
+      latest[serial] = (STATE_CODES[state], as_email, jamf_email) # one row per serial, last wins
+    run_at = run_at or time.time()
+
+    with self.conn:
+      ids = self.serial_ids(list(latest))
+      # every column of the segment is in serial id order
+      ordered = sorted((ids[serial], values) for serial, values in latest.items())
+      counts = {state: 0 for state in STATES}
+      for _, (code, _, _) in ordered:
+        counts[STATES[code]] += 1
+
+      previous = self.conn.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+      run_id = self.conn.execute('INSERT INTO runs (run_at, counts) VALUES (?, ?)',
+                                 (run_at, json.dumps(counts))).lastrowid
+      self.conn.execute(
+        'INSERT INTO segments (run_id, serial_ids, states, as_emails, jamf_emails) VALUES (?, ?, ?, ?, ?)',
+        (run_id, pack_ints(i for i, _ in ordered), zlib.compress(bytes(code for _, (code, _, _) in ordered)),
+         pack_strings(v[1] for _, v in ordered), pack_strings(v[2] for _, v in ordered)))
+
+      # extend spans still in the same state, open new ones for everything else
+      open_spans = {}
+      if previous is not None:
+        for serial_id, state, first_run in self.conn.execute(
+            'SELECT serial_id, state, first_run FROM spans WHERE last_run = ?', (previous,)):
+          open_spans[serial_id] = (state, first_run)
+      extend = []
+      start = []
+      for serial_id, (code, _, _) in ordered:
+        span = open_spans.get(serial_id)
+        if span is not None and span[0] == code:
+          extend.append((run_id, serial_id, span[1]))
+        else:
+          start.append((serial_id, code, run_id, run_id))
+      self.conn.executemany('UPDATE spans SET last_run = ? WHERE serial_id = ? AND first_run = ?', extend)
+      self.conn.executemany('INSERT INTO spans (serial_id, state, first_run, last_run) VALUES (?, ?, ?, ?)', start)
+    return run_id
+
+  def runs(self):
+    """Get every run with its per-state totals
+
+    Returns:
+      list: dicts with run_id, run_at and counts, oldest first
+    """
+    rows = self.conn.execute('SELECT run_id, run_at, counts FROM runs ORDER BY run_id').fetchall()
+    return [{'run_id': r[0], 'run_at': r[1], 'counts': json.loads(r[2])} for r in rows]
+
+  def serial_names(self):
+    return dict(self.conn.execute('SELECT id, serial_no FROM serials'))
+
+  def segment(self, run_id, names=None):
+    """Decompress one run's outcomes
+
+    Args:
+      run_id (int): run id
+      names (dict): serial id -> serial number, see serial_names()
+
+    Returns:
+      dict: serial number -> (state, AssetSonar email, Jamf email)
+    """
+    row = self.conn.execute('SELECT serial_ids, states, as_emails, jamf_emails FROM segments WHERE run_id = ?',
+                            (run_id,)).fetchone()
+    if row is None:
+      return {}
+    names = names or self.serial_names()
+    return {names[i]: (STATES[code], as_email, jamf_email)
+            for i, code, as_email, jamf_email in zip(unpack_ints(row[0]), zlib.decompress(row[1]),
+                                                     unpack_strings(row[2]), unpack_strings(row[3]))}
+
+  def delta(self, run_id=None):
+    """Compare a run with the one before it
+
+    Args:
+      run_id (int): run id, defaults to the latest
+
+    Yields:
+      tuple: ('new' or 'resolved', serial number, state now or None, state before or None, AS email, Jamf email)
+        for every asset that entered or left an issue state
+    """
+    if run_id is None:
+      run_id = self.conn.execute('SELECT MAX(run_id) FROM runs').fetchone()[0]
+    previous = self.conn.execute('SELECT MAX(run_id) FROM runs WHERE run_id < ?', (run_id,)).fetchone()[0]
+    names = self.serial_names()
+    current = self.segment(run_id, names) if run_id is not None else {}
+    before = self.segment(previous, names) if previous is not None else {}
+    for serial, (state, as_email, jamf_email) in current.items():
+      was = before.get(serial, (None,))[0]
+      if state in ISSUE_STATES and state != was:
+        yield 'new', serial, state, was, as_email, jamf_email
+    for serial, (was, as_email, jamf_email) in before.items():
+      state = current.get(serial, (None,))[0]
+      if was in ISSUE_STATES and state != was:
+        yield 'resolved', serial, state, was, as_email, jamf_email
+
+  def time_in_state(self, serial):
+    """Get an asset's state history from its spans
+
+    Args:
+      serial (str): serial number
+
+    Returns:
+      list: dicts with state, since, until (run times) and runs, newest first; empty if never seen
+    """
+    rows = self.conn.execute(
+      'SELECT s.state, f.run_at, l.run_at, s.last_run - s.first_run + 1 FROM spans s '
+      'JOIN serials ON serials.id = s.serial_id '
+      'JOIN runs f ON f.run_id = s.first_run JOIN runs l ON l.run_id = s.last_run '
+      'WHERE serials.serial_no = ? ORDER BY s.first_run DESC', (serial,)).fetchall()
+    return [{'state': STATES[r[0]], 'since': r[1], 'until': r[2], 'runs': r[3]} for r in rows]
+
+
+_HISTORY = None
+_HISTORY_LOCK = threading.Lock()
+
+def get_history():
+  """Get the process-wide history, opening it on first use
+
+  Returns:
+    History: shared history, None if HISTORY_FILE is empty
+  """
+  global _HISTORY
+  if not HISTORY_FILE:
+    return None
+  if _HISTORY is None:
+    with _HISTORY_LOCK:
+      if _HISTORY is None:
+        _HISTORY = History()
+  return _HISTORY
+
+# ==========================================================================
+
+def print_trend(history):
+  print(f'{"run at":<20} ' + ' '.join(f'{s:>13}' for s in STATES))
+  for run in history.runs():
+    print(f'{format_time(run["run_at"]):<20} ' + ' '.join(f'{run["counts"].get(s, 0):>13}' for s in STATES))
+
+
+def print_delta(history):
+  changes = list(history.delta())
+  for change, serial, state, was, as_email, jamf_email in changes:
+    print(f'{change:<9} {serial:<16} {was or "-":>13} -> {state or "-":<13} {as_email or ""} {jamf_email or ""}')
+  print(f'{sum(c[0] == "new" for c in changes)} new, {sum(c[0] == "resolved" for c in changes)} resolved')
+
+
+def print_asset(history, serial):
+  spans = history.time_in_state(serial.upper())
+  if not spans:
+    print(f'{serial} has never been audited', file=sys.stderr)
+    return 1
+  for span in spans:
+    days = (span['until'] - span['since']) / 86400
+    print(f'{span["state"]:<13} {format_time(span["since"])} -> {format_time(span["until"])} '
+          f'({days:.1f} days, {span["runs"]} runs)')
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Query the audit history')
+  commands = parser.add_subparsers(dest='query', required=True)
+  commands.add_parser('trend', help='per-state totals of every run')
+  commands.add_parser('delta', help='issues new or resolved since the previous run')
+  asset = commands.add_parser('asset', help="an asset's states and how long it has been in each")
+  asset.add_argument('serial')
+  options = parser.parse_args(argv)
+
+  history = get_history()
+  if history is None:
+    print('HISTORY_FILE is empty, no history is kept', file=sys.stderr)
+    return 1
+  if options.query == 'trend':
+    print_trend(history)
+  elif options.query == 'delta':
+    print_delta(history)
+  else:
+    return print_asset(history, options.serial)
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())
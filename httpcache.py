@@ -0,0 +1,228 @@
+from dotenv import load_dotenv
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+import zlib
+from metrics import METRICS
+
+# on-disk cache for the read endpoints of the AssetSonar and Jamf clients
+# GET responses that carry an ETag or Last-Modified validator are kept
+# (zlib-compressed) in a small SQLite file; the next request for the same URL
+# sends If-None-Match / If-Modified-Since, and a 304 is answered from the cache
+# instead of downloading the page again
+# entries younger than HTTP_CACHE_MAX_AGE are served without asking at all,
+# and the least recently used entries are evicted past HTTP_CACHE_MAX_MB
+
+# ==========================================================================
+
+load_dotenv()
+HTTP_CACHE_FILE = os.getenv('HTTP_CACHE_FILE', 'http_cache.db') # '' disables
+HTTP_CACHE_MAX_AGE = float(os.getenv('HTTP_CACHE_MAX_AGE', 0))    # seconds served without revalidating
+HTTP_CACHE_MAX_MB = float(os.getenv('HTTP_CACHE_MAX_MB', 256))    # compressed size before LRU eviction
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+  key TEXT PRIMARY KEY,
+  etag TEXT,
+  last_modified TEXT,
+  body BLOB NOT NULL,
+  size INTEGER NOT NULL,
+  stored_at REAL NOT NULL,
+  used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_used ON responses (used_at);
+'''
+
+# ==========================================================================
+
+def cache_key(url, params=None):
+  """Build the cache key for a GET, independent of parameter order
+
+  Args:
+    url (str): absolute URL
+    params (dict): query parameters
+
+  Returns:
+    str: url with sorted query string
+  """
+  if not params:
+    return url
+  return f'{url}?{urlencode(sorted((k, str(v)) for k, v in params.items()))}'
+
+
+class CachedResponse:
+  """One cached response body with its validators"""
+
+  __slots__ = ('key', 'etag', 'last_modified', 'body', 'stored_at')
+
+  def __init__(self, key, etag, last_modified, body, stored_at):
+    self.key = key
+    self.etag = etag
+    self.last_modified = last_modified
+    self.body = body
+    self.stored_at = stored_at
+
+  def is_fresh(self, max_age, now=None):
+    return (now or time.time()) - self.stored_at < max_age
+
+  def validators(self):
+    """Get the conditional request headers for this entry
+
+    Returns:
+      dict: If-None-Match / If-Modified-Since headers
+    """
+    headers = {}
+    if self.etag:
+      headers['If-None-Match'] = self.etag
+    if self.last_modified:
+      headers['If-Modified-Since'] = self.last_modified
+    return headers
+
+  def json(self):
+    return json.loads(zlib.decompress(self.body))
+
+
+class HTTPCache:
+  """Thread-safe SQLite-backed response cache with max-age and size-bounded LRU eviction"""
+
+  def __init__(self, path=HTTP_CACHE_FILE, max_age=HTTP_CACHE_MAX_AGE, max_bytes=HTTP_CACHE_MAX_MB * 2**20):
+    self.path = path
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+    # page fetches run on worker threads, so serialise access ourselves
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock:
+      self.conn.execute('PRAGMA journal_mode=WAL')
+      self.conn.executescript(SCHEMA)
+      self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
+
+  def get(self, key):
+    """Look up a cached response, marking it recently used
+
+    Args:
+      key (str): see cache_key()
+
+    Returns:
+      CachedResponse: cached entry or None
+    """
+    with self.lock, self.conn:
+      row = self.conn.execute('SELECT etag, last_modified, body, stored_at FROM responses WHERE key = ?',
+                              (key,)).fetchone()
+      if row is None:
+        return None
+      self.conn.execute('UPDATE responses SET used_at = ? WHERE key = ?', (time.time(), key))
+    return CachedResponse(key, *row)
+
+  def put(self, key, response):
+    """Cache a 200 response if it can be revalidated or max-age is in use
+
+    Args:
+      key (str): see cache_key()
+      response (requests.Response): response to cache
+
+    Returns:
+      None
+    """
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not (etag or last_modified or self.max_age > 0):
+      return None # nothing to revalidate with, storing it would only cost disk
+    body = zlib.compress(response.content)
+    if len(body) > self.max_bytes:
+      return None
+    now = time.time()
+    with self.lock, self.conn:
+      old = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+      self.conn.execute(
+        'INSERT OR REPLACE INTO responses (key, etag, last_modified, body, size, stored_at, used_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, etag, last_modified, body, len(body), now, now))
+      self.size += len(body) - (old[0] if old else 0)
+      self.evict()
+    return None
+
+  def revalidated(self, entry):
+    """Restart an entry's max-age after the server answered 304
+
+    Args:
+      entry (CachedResponse): revalidated entry
+
+    Returns:
+      None
+    """
+    entry.stored_at = time.time()
+    with self.lock, self.conn:
+      self.conn.execute('UPDATE responses SET stored_at = ? WHERE key = ?', (entry.stored_at, entry.key))
+    return None
+
+  def evict(self):
+    # drop least recently used entries until the cache fits; call with the lock held
+    if self.size <= self.max_bytes:
+      return None
+    rows = self.conn.execute('SELECT key, size FROM responses ORDER BY used_at').fetchall()
+    evicted = []
+    for key, size in rows:
+      if self.size <= self.max_bytes:
+        break
+      evicted.append((key,))
+      self.size -= size
+    self.conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+    METRICS.count('http_cache_evictions_total', len(evicted))
+    return None
+
+
+def cached_get(cache, service, url, params, send):
+  """GET through the cache: serve fresh entries, revalidate stale ones, store new ones
+
+  Args:
+    cache (HTTPCache): response cache, None to always send the request
+    service (str): assetsonar or jamf, for metrics
+    url (str): absolute URL
+    params (dict): query parameters
+    send (callable): takes conditional headers, sends the GET and returns the requests.Response
+
+  Returns:
+    tuple: (requests.Response or None if served from cache, decoded body or None if not a cache hit)
+  """
+  if cache is None:
+    return send({}), None
+  key = cache_key(url, params)
+  entry = cache.get(key)
+  if entry is not None and entry.is_fresh(cache.max_age):
+    METRICS.count('http_cache_total', service=service, result='fresh')
+    return None, entry.json()
+
+  response = send(entry.validators() if entry is not None else {})
+  if response.status_code == 304 and entry is not None:
+    cache.revalidated(entry)
+    METRICS.count('http_cache_total', service=service, result='not_modified')
+    return None, entry.json()
+  if response.status_code == 200:
+    cache.put(key, response)
+  METRICS.count('http_cache_total', service=service, result='miss')
+  return response, None
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_cache():
+  """Get the process-wide response cache, opening it on first use
+
+  Returns:
+    HTTPCache: shared cache, None if HTTP_CACHE_FILE is empty
+  """
+  global _CACHE
+  if not HTTP_CACHE_FILE:
+    return None
+  with _CACHE_LOCK:
+    if _CACHE is None:
+      _CACHE = HTTPCache()
+  return _CACHE
@@ -0,0 +1,262 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+from dotenv import load_dotenv
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
+import time
+from httpcache import cached_get
+from jsonstream import project
+from metrics import METRICS
+
+# shared Jamf Pro API client
+# reuses one OAuth client-credentials token until it expires
+# https://developer.jamf.com/jamf-pro/docs/client-credentials
+
+# ==========================================================================
+
+load_dotenv()
+JAMF_URL = os.getenv('JAMF_URL')
+CLIENT_ID = os.getenv('CLIENT_ID')
+CLIENT_SECRET = os.getenv('CLIENT_SECRET')
+
+JAMF_POOL_SIZE = int(os.getenv('JAMF_POOL_SIZE', 8))
+JAMF_TIMEOUT = float(os.getenv('JAMF_TIMEOUT', 120))
+JAMF_MAX_RETRIES = int(os.getenv('JAMF_MAX_RETRIES', 5))
+JAMF_PAGE_SIZE = int(os.getenv('JAMF_PAGE_SIZE', 2000))
+JAMF_PAGE_WORKERS = int(os.getenv('JAMF_PAGE_WORKERS', 4))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+TOKEN_SKEW = 60 # refresh the token this many seconds before it actually expires
+
+# ==========================================================================
+
+class JamfError(Exception):
+  """Raised when a Jamf request still fails after all retries"""
+
+
+class JamfClient:
+  """Pooled Jamf Pro API client with token reuse and retry"""
+
+  def __init__(self, base_url=JAMF_URL, client_id=CLIENT_ID, client_secret=CLIENT_SECRET,
+               pool_size=JAMF_POOL_SIZE, timeout=JAMF_TIMEOUT, max_retries=JAMF_MAX_RETRIES, cache=None):
+    if not base_url:
+      raise JamfError('JAMF_URL is not set')
+    self.base_url = base_url.rstrip('/')
+    self.client_id = client_id
+    self.client_secret = client_secret
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.cache = cache
+    self.access_token = None
+    self.token_expiration = 0
+    self.token_lock = threading.Lock()
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.headers.update({'accept': 'application/json'})
+
+  def token(self, force=False):
+    """Get a bearer token, requesting a new one only when the current one expires
+
+    Args:
+      force (bool): discard the cached token, e.g. after a 401
+
+    Returns:
+      str: access token
+    """
+    with self.token_lock:
+      if force or self.access_token is None or time.time() >= self.token_expiration:
+        start = time.perf_counter()
+        response = self.session.post(f'{self.base_url}/api/oauth/token', data={
+          'client_id': self.client_id,
+          'grant_type': 'client_credentials',
+          'client_secret': self.client_secret,
+        }, timeout=self.timeout)
+        METRICS.request('jamf', 'POST', 'api/oauth/token', response.status_code, time.perf_counter() - start)
+        if response.status_code != 200:
+          raise JamfError(f'Could not get Jamf access token: HTTP {response.status_code} - {response.text}')
+        data = response.json()
+        self.access_token = data['access_token']
+        self.token_expiration = time.time() + int(data.get('expires_in', 0)) - TOKEN_SKEW
+      return self.access_token
+
+  def invalidate_token(self):
+    """Kill the API access token
+
+    Returns:
+      None
+    """
+    if self.access_token is None:
+      return None
+    response = self.session.post(f'{self.base_url}/api/v1/auth/invalidate-token',
+                                 headers={'Authorization': f'Bearer {self.access_token}'}, timeout=self.timeout)
+    if response.status_code == 204:
+      print('Token successfully invalidated')
+    elif response.status_code == 401:
+      print('Token already invalid')
+    else:
+      print('An unknown error occurred invalidating the token')
+    self.access_token = None
+    self.token_expiration = 0
+    return None
+
+  def get_json(self, path, params=None):
+    """GET a Jamf endpoint and decode the JSON body, revalidating cached copies, see httpcache.py
+
+    Args:
+      path (str): path relative to the Jamf base url
+      params (dict): query parameters
+
+    Returns:
+      dict: decoded response body
+    """
+    url = f'{self.base_url}/{path.lstrip("/")}'
+    response, cached = cached_get(self.cache, 'jamf', url, params, lambda headers: self.get(path, params, headers))
+    if response is None:
+      return cached
+    return response.json()
+
+  def get(self, path, params=None, headers=None):
+    """GET a Jamf endpoint, retrying 429 / 5xx / timeouts and refreshing the token on 401
+
+    Args:
+      path (str): path relative to the Jamf base url
+      params (dict): query parameters
+      headers (dict): extra request headers, e.g. conditional request validators
+
+    Returns:
+      requests.Response: 200 or 304 response
+    """
+    url = f'{self.base_url}/{path.lstrip("/")}'
+    force_token = False
+    for attempt in range(self.max_retries + 1):
+      try:
+        start = time.perf_counter()
+        auth = {'Authorization': f'Bearer {self.token(force=force_token)}'}
+        response = self.session.get(url, params=params, headers={**(headers or {}), **auth}, timeout=self.timeout)
+        status = response.status_code
+        retry = status in RETRY_STATUSES and attempt < self.max_retries or status == 401 and not force_token
+        METRICS.request('jamf', 'GET', path, status, time.perf_counter() - start, retry)
+        if status in (200, 304):
+          return response
+        error = f'HTTP {status}'
+        if status == 401 and not force_token:
+          force_token = True # token revoked or expired early, retry straight away
+          continue
+        if status not in RETRY_STATUSES:
+          raise JamfError(f'GET {path}: {error} - {response.text}')
+      except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        METRICS.request('jamf', 'GET', path, type(e).__name__, time.perf_counter() - start, attempt < self.max_retries)
+        error = str(e)
+
+      if attempt == self.max_retries:
+        break
+      delay = random.uniform(0.5, 1) * min(60, 2 ** attempt)
+      print(f'GET {path} failed ({error}), retrying in {delay:.1f}s', file=sys.stderr)
+      time.sleep(delay)
+
+    raise JamfError(f'GET {path} failed after {self.max_retries + 1} attempts: {error}')
+
+  def iter_pages(self, path, params=None, page_size=JAMF_PAGE_SIZE, workers=JAMF_PAGE_WORKERS):
+    """Fetch every page of a paginated Jamf Pro API endpoint
+
+    Page 0 gives totalCount; the remaining pages are fetched concurrently
+    with at most `workers` pages in flight, and yielded in page order so a
+    caller can stream them to disk without holding the whole inventory.
+
+    Args:
+      path (str): path relative to the Jamf base url
+      params (dict): query parameters other than page / page-size
+      page_size (int): records per page
+      workers (int): max pages in flight at once
+
+    Yields:
+      tuple: (totalCount, list of results for one page)
+    """
+    def fetch(page):
+      return self.get_json(path, {**(params or {}), 'page': page, 'page-size': page_size})
+
+    first = fetch(0)
+    total = int(first.get('totalCount', 0))
+    METRICS.count('pages_fetched_total', service='jamf')
+    yield total, first.get('results', [])
+
+    total_pages = -(-total // page_size) # ceil
+    if total_pages < 2:
+      return
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, total_pages - 1)))
+    pending = deque()
+    next_page = 1
+    try:
+      while next_page < total_pages or pending:
+        while next_page < total_pages and len(pending) < workers:
+          pending.append(pool.submit(fetch, next_page))
+          next_page += 1
+        results = pending.popleft().result().get('results', [])
+        METRICS.count('pages_fetched_total', service='jamf')
+        yield total, results
+    finally:
+      pool.shutdown(wait=False, cancel_futures=True)
+
+# ==========================================================================
+
+def write_json_atomic(filename, write):
+  """Write a file via a temp file so a failed fetch never leaves a truncated response behind
+
+  Args:
+    filename (str): destination file
+    write (callable): takes an open text file and writes the content
+
+  Returns:
+    None
+  """
+  tmp = f'{filename}.tmp'
+  try:
+    with open(tmp, 'w') as f:
+      write(f)
+    os.replace(tmp, filename)
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+  return None
+
+
+def stream_pages(client, path, params, filename, collect=None, fields=None):
+  """Stream every page of a Jamf Pro API endpoint to a {totalCount, results} JSON file
+
+  Args:
+    client (JamfClient): Jamf client
+    path (str): path relative to the Jamf base url
+    params (dict): query parameters other than page / page-size
+    filename (str): destination file
+    collect (list): if given, records are also appended here for in-memory handoff
+    fields (dict): fields to keep in collect, see jsonstream.project(); the file gets whole records
+
+  Returns:
+    int: number of records written
+  """
+  written = 0
+  total = 0
+  def write(f):
+    nonlocal written, total
+    f.write('{"results": [')
+    for total, results in client.iter_pages(path, params):
+      if collect is not None:
+        collect.extend(results if fields is None else [project(record, fields) for record in results])
+      for record in results:
+        if written:
+          f.write(',\n')
+        json.dump(record, f)
+        written += 1
+    f.write(f'],\n"totalCount": {json.dumps(total)}}}\n')
+
+  write_json_atomic(filename, write)
+  if written != total:
+    print(f'Warning: {filename} has {written} records but Jamf reported totalCount {total}', file=sys.stderr)
+  return written
@@ -0,0 +1,114 @@
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+import time
+from members import normalize_email
+from store import get_store
+
+# per-asset outcome journal for AssetSonar mutations
+# remembers the last attempt for every serial number together with the
+# (AssetSonar email, Jamf email) pair it was made for, so a run can skip
+# mutations whose inputs haven't changed since the last attempt:
+#   - a success that shows up again with the same emails was undone by hand,
+#     leave it alone until either email changes
+#   - a failure is retried once MUTATION_RETRY_AFTER has passed
+
+# ==========================================================================
+
+load_dotenv()
+MUTATION_RETRY_AFTER = float(os.getenv('MUTATION_RETRY_AFTER', 72)) # hours before a failed mutation is retried
+FORCE_MUTATIONS = os.getenv('FORCE_MUTATIONS', '0') == '1'          # ignore the journal, attempt everything
+
+# ==========================================================================
+
+def succeeded(*status_codes):
+  """Check whether every call of a mutation succeeded
+
+  Args:
+    status_codes (int): HTTP status of each call, None if the request never completed
+
+  Returns:
+    bool: True if all were 2xx
+  """
+  return all(code is not None and 200 <= code < 300 for code in status_codes)
+
+
+def email_pair(asset):
+  """Get the inputs a mutation depends on
+
+  Args:
+    asset (Asset): asset, optionally joined to its Jamf user
+
+  Returns:
+    tuple: (normalised AssetSonar email, normalised Jamf email)
+  """
+  return normalize_email(asset.assigned_email), normalize_email(asset.jamf_email())
+
+
+def is_settled(entry, pair, now=None):
+  """Check whether a journal entry means the mutation can be skipped
+
+  Args:
+    entry (dict): journal row for the serial number, None if never attempted
+    pair (tuple): current (AssetSonar email, Jamf email)
+    now (float): epoch seconds, defaults to time.time()
+
+  Returns:
+    bool: True if the mutation should be skipped this run
+  """
+  if entry is None or (entry['as_email'], entry['jamf_email']) != pair:
+    return False
+  if entry['ok']:
+    return True
+  return (now or time.time()) - entry['attempted_at'] < MUTATION_RETRY_AFTER * 3600
+
+
+def split_settled(action, assets, store=None):
+  """Split assets into ones to mutate and ones unchanged since their last attempt
+
+  Args:
+    action (str): mutation, e.g. reassign, autocheckout, retire
+    assets (list): candidate assets
+    store (Store): state store, defaults to the shared one
+
+  Returns:
+    tuple: (assets to mutate, (asset, record) for every skipped asset)
+  """
+  if FORCE_MUTATIONS:
+    return list(assets), []
+  entries = (store or get_store()).journal_entries(action)
+  now = time.time()
+  todo = []
+  skipped = []
+  for asset in assets:
+    entry = entries.get(asset.serial_no)
+    if is_settled(entry, email_pair(asset), now):
+      last = datetime.fromtimestamp(entry['attempted_at']).isoformat(timespec='seconds')
+      skipped.append((asset, {'serial_no': asset.serial_no, 'skipped': f'unchanged since {last}', 'ok': bool(entry['ok'])}))
+    else:
+      todo.append(asset)
+  if skipped:
+    print(f'{action}: skipping {len(skipped)} assets unchanged since their last attempt')
+  return todo, skipped
+
+
+def record(action, assets, records, store=None):
+  """Journal the outcome of each attempted mutation
+
+  Args:
+    action (str): mutation
+    assets (list): attempted assets
+    records (list): result record per asset, each with an ok flag
+    store (Store): state store, defaults to the shared one
+
+  Returns:
+    None
+  """
+  attempts = []
+  for asset, result in zip(assets, records):
+    as_email, jamf_email = email_pair(asset)
+    attempts.append({'serial_no': asset.serial_no, 'asset_id': asset.asset_id, 'as_email': as_email,
+                     'jamf_email': jamf_email, 'ok': result['ok'], 'result': result})
+  (store or get_store()).record_attempts(action, attempts)
+  return None
+
@@ -0,0 +1,161 @@
+import json
+
+# incremental JSON reader for the large Jamf / AssetSonar response files
+# walks the top-level object and decodes one array element at a time, so only
+# the current record (plus a read buffer) is ever held as a dict tree; callers
+# project each record down to the few fields they need before keeping it
+
+# ==========================================================================
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\n\r'
+
+# ==========================================================================
+
+class JSONStreamError(ValueError):
+  """Raised when a response file is not the expected {key: [...]} shape"""
+
+
+class Reader:
+  """Buffered character reader over a text file that decodes one JSON value at a time"""
+
+  def __init__(self, f, chunk_size=CHUNK_SIZE):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def fill(self):
+    """Read another chunk, dropping what has already been consumed
+
+    Returns:
+      bool: False at end of file
+    """
+    if self.eof:
+      return False
+    chunk = self.f.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self):
+    """Skip whitespace and get the next character without consuming it
+
+    Returns:
+      str: next character, '' at end of file
+    """
+    while True:
+      while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+        self.pos += 1
+      if self.pos < len(self.buf) or not self.fill():
+        return self.buf[self.pos:self.pos + 1]
+
+  def expect(self, chars):
+    """Consume the next character, which must be one of chars
+
+    Args:
+      chars (str): allowed characters
+
+    Returns:
+      str: the character consumed
+    """
+    c = self.peek()
+    if not c or c not in chars:
+      raise JSONStreamError(f'expected one of {chars!r} but found {c!r}')
+    self.pos += 1
+    return c
+
+  def value(self):
+    """Decode the next complete JSON value
+
+    Returns:
+      decoded value
+    """
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # a number or literal that ends exactly at the buffer edge may continue in the next chunk
+        if end < len(self.buf) or self.eof:
+          self.pos = end
+          return value
+      except json.JSONDecodeError:
+        if self.eof:
+          raise
+      if not self.fill():
+        continue # retry once more now that eof is known
+
+# ==========================================================================
+
+def iter_array(f, key, chunk_size=CHUNK_SIZE):
+  """Yield the elements of one top-level array without loading the whole file
+
+  Args:
+    f (file): open text file containing a JSON object
+    key (str): top-level key holding the array, e.g. results or mobile_devices
+    chunk_size (int): characters read at a time
+
+  Yields:
+    element of f[key], one at a time
+  """
+  reader = Reader(f, chunk_size)
+  reader.expect('{')
+  if reader.peek() == '}':
+    return
+  while True:
+    name = reader.value()
+    reader.expect(':')
+    if name == key:
+      reader.expect('[')
+      if reader.peek() == ']':
+        reader.pos += 1
+      else:
+        while True:
+          yield reader.value()
+          if reader.expect(',]') == ']':
+            break
+    else:
+      reader.value() # other top-level values (totalCount, ...) are small
+    if reader.expect(',}') == '}':
+      return
+
+
+def project(record, fields):
+  """Keep only the wanted fields of a record
+
+  Args:
+    record (dict): decoded JSON record
+    fields (dict): field name -> None to keep the value, or a nested fields dict
+
+  Returns:
+    dict: record with the same shape holding only the wanted fields
+  """
+  compact = {}
+  for name, sub in fields.items():
+    if name not in record:
+      continue
+    value = record[name]
+    compact[name] = project(value, sub) if sub and isinstance(value, dict) else value
+  return compact
+
+
+def load_array(filename, key, fields=None):
+  """Stream one top-level array out of a JSON file, projecting each element
+
+  Args:
+    filename (str): JSON file
+    key (str): top-level key holding the array
+    fields (dict): fields to keep per element, see project(); None keeps everything
+
+  Returns:
+    list: compact elements
+  """
+  with open(filename, 'r') as f:
+    if fields is None:
+      return list(iter_array(f, key))
+    return [project(record, fields) for record in iter_array(f, key)]
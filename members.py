@@ -0,0 +1,166 @@
+from dotenv import load_dotenv
+import os
+import sys
+import threading
+import time
+from assetsonar import AssetSonarError, get_client
+from records import Member
+from store import export_json, get_store
+
+# AssetSonar member directory shared by audit_users.py and auto_checkout.py
+# loads the store's members table once, indexes members by lower-cased email
+# and only re-pulls members.api when the cache is stale or a lookup misses
+
+# ==========================================================================
+
+load_dotenv()
+MEMBERS_FILE = 'response_members.json' # legacy JSON export
+MEMBERS_TTL = int(os.getenv('MEMBERS_TTL', 43200)) # seconds before the members table is re-pulled
+MEMBER_CUSTOM_FIELDS = os.getenv('ASSETSONAR_MEMBER_CUSTOM_FIELDS', '0') == '1' # only needed to fill Member.EGY
+
+# ==========================================================================
+
+def fetch_all_members():
+  """Fetch all AS members, handle pagination
+
+  Returns:
+    list: Member records, or None if any page fails
+  """
+  print('Getting AssetSonar user data...')
+
+  all_users = []
+  try:
+    # pages 2..N are fetched concurrently
+    members = get_client().fetch_members(custom_fields=MEMBER_CUSTOM_FIELDS)
+  except AssetSonarError as e:
+    print(f'Failed to retrieve page data. Aborting: {e}', file=sys.stderr)
+    return None # never cache a partial member list
+
+  for user in members:
+    if not isinstance(user, dict):
+      print("Unexpected response format: 'members' contains non-dict item.", file=sys.stderr)
+      continue
+    # get relevant member info
+    all_users.append(Member.from_api(user))
+
+  return all_users
+
+
+def normalize_email(email):
+  """Normalise an email address for directory lookups
+
+  Args:
+    email (str): email address, may be None
+
+  Returns:
+    str: stripped lower-case email or None
+  """
+  if not email:
+    return None
+  return email.strip().lower()
+
+# ==========================================================================
+
+class MemberDirectory:
+  """AS members keyed by lower-cased email, cached in the store with a TTL"""
+
+  def __init__(self, store=None, ttl=MEMBERS_TTL, fetch=fetch_all_members):
+    self.store = store
+    self.ttl = ttl
+    self.fetch = fetch
+    self.by_email = None
+    self.refreshed = False # only re-pull members.api once per run
+    self.lock = threading.RLock() # lookups come from concurrent mutation workers
+
+  def get_store(self):
+    if self.store is None:
+      self.store = get_store()
+    return self.store
+
+  def is_stale(self):
+    """Check whether the cached members are missing or older than the TTL
+
+    Returns:
+      bool: True if members.api should be re-pulled
+    """
+    return time.time() - self.get_store().members_refreshed_at() > self.ttl
+
+  def load(self):
+    """Load the cached members into the email index, refreshing them if stale
+
+    Returns:
+      None
+    """
+    with self.lock:
+      if self.by_email is not None:
+        return None
+      if self.is_stale():
+        self.refresh()
+        return None
+      self.index(self.get_store().members())
+    return None
+
+  def refresh(self):
+    """Re-pull members.api, rebuild the index and save to the store
+
+    Returns:
+      None
+    """
+    self.refreshed = True
+    members = self.fetch()
+    if not members:
+      print('No members retrieved or an error occurred', file=sys.stderr)
+      if self.by_email is None:
+        self.by_email = {}
+      return None
+
+    self.index(members)
+    self.get_store().replace_members(members)
+    print(f'All AssetSonar members saved to {self.get_store().path} - total: {len(members)}')
+    export_json(MEMBERS_FILE, members, indent=2, sort_keys=True)
+    return None
+
+  def index(self, members):
+    """Build the email -> member index
+
+    Args:
+      members (list): Member records
+
+    Returns:
+      None
+    """
+    by_email = {}
+    for user in members:
+      email = normalize_email(user.email)
+      if email:
+        by_email.setdefault(email, user)
+    self.by_email = by_email
+    return None
+
+  def get_user_id(self, email):
+    """Get user's AS member id from email
+
+    Args:
+      email (str): User email address
+
+    Returns:
+      int: User id if found else None
+    """
+    key = normalize_email(email)
+    if key is None:
+      return None
+    self.load()
+    user = self.by_email.get(key)
+    if user is None:
+      with self.lock:
+        if not self.refreshed:
+          # member may have been added since the cache was written
+          self.refresh()
+        user = self.by_email.get(key)
+    if user is None:
+      print(f'User {email} not found in members list.', file=sys.stderr)
+      return None
+    return user.id
+
+
+DIRECTORY = MemberDirectory()
@@ -0,0 +1,264 @@
+import atexit
+from collections import defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# run telemetry: stage durations, page and mutation counts, and per-endpoint
+# request latency / status / retry counts for AssetSonar and Jamf
+# every observation is appended to a JSON-lines event log as it happens, and a
+# Prometheus textfile-collector file with the run's totals is written on exit by
+# the processes that claim it: pipeline.py and shards.py start for the audit run,
+# daemon.py for its own file. Ad-hoc commands (checkin, history, the stage
+# scripts run by hand, shard helpers) only log events, so they never replace a
+# run's totals with their own
+
+# ==========================================================================
+
+load_dotenv()
+METRICS_EVENTS = os.getenv('METRICS_EVENTS', os.path.join('logs', 'metrics.jsonl')) # '' disables
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE', 'asaudit.prom')                    # audit run totals, '' disables
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+# ==========================================================================
+
+def endpoint_label(path):
+  """Collapse ids in a request path so each endpoint is one label value
+
+  Args:
+    path (str): e.g. assets/123/checkin.api
+
+  Returns:
+    str: e.g. assets/{id}/checkin.api
+  """
+  return ID_SEGMENT.sub('/{id}', '/' + path.lstrip('/'))[1:]
+
+
+def label_string(labels):
+  return ','.join(f'{k}="{v}"' for k, v in labels)
+
+
+class Metrics:
+  """Thread-safe collector shared by every stage and API client"""
+
+  def __init__(self, events_file=METRICS_EVENTS, textfile=METRICS_TEXTFILE):
+    self.events_file = events_file
+    self.textfile = textfile
+    self.lock = threading.Lock()
+    self.events = None
+    self.registered = False
+    self.claimed = False
+    self.started = time.time()
+    self.counters = defaultdict(float)  # (name, labels) -> value
+    self.gauges = {}                    # (name, labels) -> value
+    self.histograms = {}                # labels -> [bucket counts..., count, sum]
+
+  def register(self):
+    # close the event log (and write a claimed textfile) at exit; call with the lock held
+    if not self.registered:
+      atexit.register(self.close)
+      self.registered = True
+
+  def claim_textfile(self, textfile=None):
+    """Make this process the one that writes the Prometheus textfile
+
+    Args:
+      textfile (str): file to write instead of METRICS_TEXTFILE
+
+    Returns:
+      None
+    """
+    with self.lock:
+      if textfile is not None:
+        self.textfile = textfile
+      self.claimed = True
+      self.register()
+    return None
+
+  def event(self, kind, **fields):
+    """Append one event to the JSON-lines log
+
+    Args:
+      kind (str): event type, e.g. request or stage
+      fields: event data
+
+    Returns:
+      None
+    """
+    with self.lock:
+      self.register()
+      if not self.events_file:
+        return None
+      if self.events is None:
+        directory = os.path.dirname(self.events_file)
+        if directory:
+          os.makedirs(directory, exist_ok=True)
+        self.events = open(self.events_file, 'a')
+      self.events.write(json.dumps({'ts': round(time.time(), 3), 'event': kind, **fields}) + '\n')
+    return None
+
+  def count(self, name, value=1, **labels):
+    """Increment a counter
+
+    Args:
+      name (str): metric name without the asaudit_ prefix
+      value (float): increment
+      labels: metric labels
+
+    Returns:
+      None
+    """
+    with self.lock:
+      self.register()
+      self.counters[(name, tuple(sorted(labels.items())))] += value
+    return None
+
+  def gauge(self, name, value, **labels):
+    """Set a gauge
+
+    Args:
+      name (str): metric name without the asaudit_ prefix
+      value (float): current value
+      labels: metric labels
+
+    Returns:
+      None
+    """
+    with self.lock:
+      self.register()
+      self.gauges[(name, tuple(sorted(labels.items())))] = value
+    return None
+
+  def request(self, service, method, path, status, seconds, retry=False):
+    """Record one HTTP attempt against AssetSonar or Jamf
+
+    Args:
+      service (str): assetsonar or jamf
+      method (str): HTTP method
+      path (str): request path, ids are collapsed
+      status (int | str): HTTP status, or the exception name if none came back
+      seconds (float): attempt latency
+      retry (bool): whether the attempt is going to be retried
+
+    Returns:
+      None
+    """
+    endpoint = endpoint_label(path)
+    labels = (('endpoint', endpoint), ('method', method), ('service', service))
+    with self.lock:
+      histogram = self.histograms.setdefault(labels, [0] * (len(LATENCY_BUCKETS) + 2))
+      for i, bound in enumerate(LATENCY_BUCKETS):
+        if seconds <= bound:
+          histogram[i] += 1
+      histogram[-2] += 1
+      histogram[-1] += seconds
+      self.counters[('api_requests_total', labels + (('status', str(status)),))] += 1
+      if retry:
+        self.counters[('api_retries_total', labels)] += 1
+    self.event('request', service=service, method=method, endpoint=endpoint, status=status,
+               seconds=round(seconds, 4), retry=retry)
+    return None
+
+  def stage_done(self, stage, seconds, ok=True):
+    """Record a stage's wall time
+
+    Args:
+      stage (str): stage name
+      seconds (float): wall time
+      ok (bool): whether the stage finished without raising
+
+    Returns:
+      None
+    """
+    with self.lock:
+      self.gauges[('stage_duration_seconds', (('stage', stage),))] = seconds
+      self.gauges[('stage_success', (('stage', stage),))] = int(ok)
+    self.event('stage', stage=stage, seconds=round(seconds, 3), ok=ok)
+    return None
+
+  @contextmanager
+  def stage(self, stage):
+    """Time a block as a stage
+
+    Args:
+      stage (str): stage name
+    """
+    start = time.perf_counter()
+    ok = False
+    try:
+      yield
+      ok = True
+    finally:
+      self.stage_done(stage, time.perf_counter() - start, ok)
+
+  def prometheus(self):
+    """Render everything collected as Prometheus text exposition format
+
+    Returns:
+      str: textfile content
+    """
+    lines = []
+    with self.lock:
+      counters = sorted(self.counters.items())
+      gauges = sorted(self.gauges.items())
+      histograms = sorted(self.histograms.items())
+
+    typed = set()
+    for kind, items in (('counter', counters), ('gauge', gauges)):
+      for (name, labels), value in items:
+        if name not in typed:
+          lines.append(f'# TYPE asaudit_{name} {kind}')
+          typed.add(name)
+        lines.append(f'asaudit_{name}{{{label_string(labels)}}} {value:g}')
+
+    if histograms:
+      lines.append('# TYPE asaudit_api_request_duration_seconds histogram')
+    for labels, histogram in histograms:
+      for bound, n in zip(LATENCY_BUCKETS, histogram):
+        lines.append(f'asaudit_api_request_duration_seconds_bucket{{{label_string(labels)},le="{bound}"}} {n}')
+      lines.append(f'asaudit_api_request_duration_seconds_bucket{{{label_string(labels)},le="+Inf"}} {histogram[-2]}')
+      lines.append(f'asaudit_api_request_duration_seconds_count{{{label_string(labels)}}} {histogram[-2]}')
+      lines.append(f'asaudit_api_request_duration_seconds_sum{{{label_string(labels)}}} {histogram[-1]:.6f}')
+
+    lines.append('# TYPE asaudit_last_run_timestamp_seconds gauge')
+    lines.append(f'asaudit_last_run_timestamp_seconds {self.started:.0f}')
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self):
+    """Write the Prometheus textfile atomically so the collector never reads half a file
+
+    Returns:
+      None
+    """
+    if not self.claimed or not self.textfile:
+      return None
+    tmp = f'{self.textfile}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+      f.write(self.prometheus())
+    os.replace(tmp, self.textfile)
+    return None
+
+  def close(self):
+    """Write the textfile if this process claimed it and close the event log
+
+    Returns:
+      None
+    """
+    try:
+      self.write_textfile()
+    except OSError as e:
+      print(f'Could not write {self.textfile}: {e}', file=sys.stderr)
+    with self.lock:
+      if self.events is not None:
+        self.events.close()
+        self.events = None
+    return None
+
+
+METRICS = Metrics()
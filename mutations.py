@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import os
+from concurrency import CONCURRENCY_MAX
+
+# shared executor for AssetSonar checkin / checkout / retire mutations
+# runs one task per asset concurrently; the client's token bucket keeps the
+# overall request rate under the API quota and its adaptive limit decides how
+# many requests are really in flight
+
+# ==========================================================================
+
+load_dotenv()
+MUTATION_WORKERS = int(os.getenv('ASSETSONAR_MUTATION_WORKERS', CONCURRENCY_MAX))
+
+# ==========================================================================
+
+def run_mutations(items, task, key=lambda item: item.asset_id, workers=MUTATION_WORKERS):
+  """Run task(item) for every item concurrently
+
+  task should issue all of one asset's calls itself (e.g. checkin then
+  checkout) so they stay in order. Items sharing the same key are also run
+  one after another on the same worker, never concurrently.
+
+  Args:
+    items (list): assets to process
+    task (callable): takes one item, returns its result record
+    key (callable): groups items that must not run concurrently
+    workers (int): max assets in flight at once, the adaptive limit may allow fewer
+
+  Returns:
+    list: task results in the same order as items
+  """
+  groups = {}
+  for i, item in enumerate(items):
+    groups.setdefault(key(item), []).append(i)
+
+  results = [None] * len(items)
+  def run_group(indexes):
+    for i in indexes:
+      results[i] = task(items[i])
+
+  if workers <= 1 or len(groups) <= 1:
+    for indexes in groups.values():
+      run_group(indexes)
+    return results
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    # list() so an exception in any task is raised here
+    list(pool.map(run_group, groups.values()))
+  return results
@@ -1,144 +1,166 @@
-import json
+from jsonstream import load_array
+from metrics import METRICS
+from records import AuditOutcome, JamfComputer, JamfMobileDevice, JamfUser
 import urllib3
+from store import export_json, get_store
 
 # aggregate responses obtained from AssetSonar and Jamf
 # sort assets by good / need reassign / need to retire
 
 # ==========================================================================
 
-with open('response_assetsonar.json', 'r') as f:
-  ASSETSONAR_DATA = json.load(f)
-
-with open('response_jamf_computers.json', 'r') as f:
-  JAMF_COMPUTERS = json.load(f)
-
-with open('response_jamf_computer_users.json', 'r') as f:
-  JAMF_COMPUTER_USERS = json.load(f)
-
-with open('response_jamf_devices.json', 'r') as f:
-  JAMF_DEVICES = json.load(f)
-
-with open('response_jamf_device_users.json', 'r') as f:
-  JAMF_DEVICE_USERS = json.load(f)
+JAMF_FILES = {
+  'computers': 'response_jamf_computers.json',
+  'computer_users': 'response_jamf_computer_users.json',
+  'devices': 'response_jamf_devices.json',
+  'device_users': 'response_jamf_device_users.json',
+}
+
+# the only fields the join needs; everything else in the HARDWARE /
+# USER_AND_LOCATION payloads is dropped while the files are streamed in
+USER_FIELDS = {'username': None, 'realName': None, 'realname': None, 'email': None, 'emailAddress': None}
+JAMF_FIELDS = {
+  'computers': ('results', {'id': None, 'general': {'name': None}, 'hardware': {'serialNumber': None, 'make': None}}),
+  'computer_users': ('results', {'id': None, 'userAndLocation': USER_FIELDS}),
+  'devices': ('mobile_devices', {'id': None, 'name': None, 'serial_number': None, 'username': None}),
+  'device_users': ('results', {'mobileDeviceId': None, 'userAndLocation': USER_FIELDS}),
+}
 
 # ==========================================================================
 
-def add_jamf_ids():
-  """Get Jamf id from JAMF_COMPUTERS and JAMF_DEVICES and add to ASSETSONAR_DATA
+def load_jamf():
+  """Stream the Jamf responses saved by query_jamf.py, keeping only JAMF_FIELDS
+
+  Peak memory tracks the number of devices rather than the size of the
+  response files, since only one full record is decoded at a time.
 
   Returns:
-    None
+    dict: computers, computer_users, devices and device_users responses
   """
-  for asset in ASSETSONAR_DATA:
-    computer = get_jamf_computer(asset['serial_no'])
-    if computer:
-      asset['jamf_id'] = computer['id']
-    else:
-      device = get_jamf_device(asset['serial_no'])
-      if device:
-        asset['jamf_id'] = device['id']
-  return None
+  jamf = {}
+  for name, filename in JAMF_FILES.items():
+    key, fields = JAMF_FIELDS[name]
+    jamf[name] = {key: load_array(filename, key, fields)}
+  return jamf
 
 
-def add_jamf_users():
-  """Get Jamf user and location info and add to ASSETSONAR_DATA
+def build_jamf_index(jamf):
+  """Index Jamf responses once so every asset lookup is a dict hit
+
+  Args:
+    jamf (dict): Jamf responses from load_jamf() or query_jamf.main()
 
   Returns:
-    None
+    dict: serial -> JamfComputer / JamfMobileDevice and Jamf id -> JamfUser for computers and mobile devices
   """
-  for asset in ASSETSONAR_DATA:
-    # user_data = get_jamf_user(asset['jamf_id']) if 'jamf_id' in asset else None
-    user_data = get_jamf_user(asset['serial_no'])
-    # print(user_data)
-    if user_data:
-      real_name = user_data.get('realName') or user_data.get('realname') or ''
-      email = user_data.get('email') or user_data.get('emailAddress') or ''
-      asset['jamf_user_data'] = {
-        'username': user_data.get('username', ''),
-        'real_name': real_name,
-        'email': email
-      }
-  return None
-
-
-def get_jamf_user(serial):
-  """Get Jamf user info by device serial number
+  index = {
+    'computers': {},
+    'devices': {},
+    'computer_users': {},
+    'device_users': {},
+  }
+  for computer in jamf['computers']['results']:
+    record = JamfComputer.from_api(computer)
+    index['computers'].setdefault(record.serial_no, record)
+  for device in jamf['devices']['mobile_devices']:
+    record = JamfMobileDevice.from_api(device)
+    index['devices'].setdefault(record.serial_no, record)
+  for a in jamf['computer_users']['results']:
+    index['computer_users'].setdefault(str(a['id']), JamfUser.from_api(a['userAndLocation'] or {}))
+  for b in jamf['device_users']['results']:
+    index['device_users'].setdefault(str(b['mobileDeviceId']), JamfUser.from_api(b['userAndLocation'] or {}))
+  return index
+
+
+def jamf_device_rows(index):
+  """Flatten the Jamf index into rows for the store's jamf_devices table
 
   Args:
-    serial (str): Jamf device serial number
+    index (dict): Jamf index from build_jamf_index()
 
   Returns:
-    dict: Jamf user info if found else None
+    list: dicts with serial_no, jamf_id, kind, username, real_name, email
   """
-  computer = get_jamf_computer(serial)
-  if computer is None:
-    device = get_jamf_device(serial)
-
-  jamf_id = computer['id'] if computer else device['id'] if device else None
-  if jamf_id is None:
-    print(f'sn {serial} not found in Jamf')
-    return None
+  rows = []
+  no_user = JamfUser()
+  for kind, devices, users in (('computer', 'computers', 'computer_users'), ('mobile', 'devices', 'device_users')):
+    for serial, record in index[devices].items():
+      user = index[users].get(record.id) or no_user
+      rows.append({'serial_no': serial, 'jamf_id': record.id, 'kind': kind,
+                   'username': user.username, 'real_name': user.real_name, 'email': user.email})
+  return rows
 
-  for a in JAMF_COMPUTER_USERS['results']:
-    if a['id'] == str(jamf_id):
-      return a['userAndLocation']
-  for b in JAMF_DEVICE_USERS['results']:
-    if b['mobileDeviceId'] == str(jamf_id):
-      return b['userAndLocation']
 
-  print(f'User data for device {serial} not found')
-  return None
+def get_jamf_user(serial, index):
+  """Get Jamf user info by device serial number
 
+  Args:
+    serial (str): Jamf device serial number
+    index (dict): Jamf index from build_jamf_index()
 
-def get_jamf_computer(sn):
+  Returns:
+    JamfUser: Jamf user info if found else None
+  """
+  computer = get_jamf_computer(serial, index)
+  if computer:
+    user_data = index['computer_users'].get(computer.id)
+  else:
+    device = get_jamf_device(serial, index)
+    if device is None:
+      print(f'sn {serial} not found in Jamf')
+      return None
+    user_data = index['device_users'].get(device.id)
+
+  if user_data is None:
+    print(f'User data for device {serial} not found')
+  return user_data
+
+
+def get_jamf_computer(sn, index):
   """Get Jamf computer info by serial number
 
   Args:
     sn (str): serial number of computer
+    index (dict): Jamf index from build_jamf_index()
 
   Returns:
-    dict: Jamf computer info if found else None
+    JamfComputer: Jamf computer info if found else None
   """
-  for computer in JAMF_COMPUTERS['results']:
-    if computer['hardware']['serialNumber'] == sn:
-      return computer
-  return None
+  return index['computers'].get(sn)
 
 
-def get_jamf_device(sn):
+def get_jamf_device(sn, index):
   """Get Jamf mobile device info by serial number
 
   Args:
     sn (str): serial number of mobile device
+    index (dict): Jamf index from build_jamf_index()
 
   Returns:
-    dict: Jamf mobile device info if found else None
+    JamfMobileDevice: Jamf mobile device info if found else None
   """
-  for device in JAMF_DEVICES['mobile_devices']:
-    if device['serial_number'] == sn:
-      return device
-  return None
+  return index['devices'].get(sn)
 
 
 def sort_assignments(assets):
-  """Sort assets to different lists based on AS vs Jamf assigned user and save to file
+  """Sort assets to different lists based on AS vs Jamf assigned user
 
   Args:
     data (dict): parsed and combined AS / Jamf asset data
 
   Returns:
-    None
+    dict: assets_assigned.json content
   """
   good = []
   bad = []
   unassigned = []
   for asset in assets['assets_in_jamf']:
-    if asset.get('jamf_user_data'):
-      if asset['assigned_email'] == asset['jamf_user_data']['email']: # AS and Jamf emails match
+    if asset.jamf_user_data:
+      if asset.assigned_email == asset.jamf_user_data.email: # AS and Jamf emails match
         good.append(asset)
-      elif asset['jamf_user_data']['email'] is None:                  # no email assigned in Jamf
+      elif asset.jamf_user_data.email is None:               # no email assigned in Jamf
         unassigned.append(asset)
-      else:                                                           # asset assigned to incorrect email
+      else:                                                  # asset assigned to incorrect email
         bad.append(asset)
     else:
       unassigned.append(asset)
@@ -153,26 +175,38 @@ def sort_assignments(assets):
   result['total_unassigned'] = len(unassigned)
   result['total_all'] = len(good) + len(bad) + len(unassigned)
 
-  with open('assets_assigned.json', 'w') as f:
-    json.dump(result, f, indent=2)
-  print(f'Saved assets sorted by assignment to assets_assigned.json')
-
-  return None
+  return result
 
 # ==========================================================================
 
-def main():
+def main(assets=None, jamf=None):
+  """Join AS checked out assets to Jamf and save each asset's category
+
+  Args:
+    assets (list): checked out Asset records, read from the store if None
+    jamf (dict): Jamf responses, read from the response files if None
+
+  Returns:
+    dict: {'assets': assets.json content, 'assigned': assets_assigned.json content}
+  """
   # start
-  add_jamf_ids()
-  add_jamf_users()
+  store = get_store()
+  index = build_jamf_index(jamf if jamf is not None else load_jamf())
+  store.replace_jamf_devices(jamf_device_rows(index))
 
+  # single pass join: resolve Jamf record, id and user for each asset
   in_jamf = []
   not_in_jamf = []
-  for asset in ASSETSONAR_DATA:
-    sn = asset['serial_no']
-    if get_jamf_computer(sn) or get_jamf_device(sn): # sn grabbed from AS exists in Jamf
+  for asset in (assets if assets is not None else store.assets('checked_out')):
+    sn = asset.serial_no
+    computer = get_jamf_computer(sn, index)
+    device = None if computer else get_jamf_device(sn, index)
+    if computer or device: # sn grabbed from AS exists in Jamf
+      asset.jamf_id = (computer or device).id
+      asset.jamf_user_data = get_jamf_user(sn, index)
       in_jamf.append(asset)
     else:
+      print(f'sn {sn} not found in Jamf')
       not_in_jamf.append(asset)
 
   result = {}
@@ -182,20 +216,26 @@ def main():
   result['total_not_in_jamf'] = len(not_in_jamf)
   result['total_all'] = len(in_jamf) + len(not_in_jamf)
 
-  # print(result)
-  with open('assets.json', 'w') as f:
-    json.dump(result, f, indent=2)
-  print(f'Saved all checked out assets to assets.json')
+  # sort by assignment and save every asset's category as the reconcile outcome
+  assigned = sort_assignments(result)
+  outcomes = []
+  for category in ('correct_user', 'wrong_user', 'unassigned'):
+    outcomes.extend(AuditOutcome.of(asset, category, asset) for asset in assigned[category])
+  outcomes.extend(AuditOutcome.of(asset, 'not_in_jamf', asset) for asset in not_in_jamf)
+  store.replace_outcomes('reconcile', outcomes)
+  print(f'Saved {len(outcomes)} reconciled assets to {store.path}')
 
-  # generate assets_assigned.json
-  sort_assignments(result)
+  export_json('assets.json', result, indent=2)
+  export_json('assets_assigned.json', assigned, indent=2)
 
   # done
   print('Done')
+  return {'assets': result, 'assigned': assigned}
 
 # ==========================================================================
 
 if __name__ == '__main__':
   print(f'\n\n--- parse_responses.py ---')
   urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-  main()
+  with METRICS.stage('parse_responses'):
+    main()
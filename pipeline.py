@@ -0,0 +1,192 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import sys
+import time
+import traceback
+from metrics import METRICS
+from runlock import RunLock
+from store import get_store
+
+# single-process orchestrator for the whole audit
+# runs the stages as a dependency graph: independent stages (the Jamf and
+# AssetSonar fetches) run in parallel and results are handed over in memory
+
+# ==========================================================================
+
+def stage_query_jamf(results, options):
+  import query_jamf
+  return query_jamf.main(write_files=options.artifacts)
+
+def stage_query_assetsonar(results, options):
+  import query_assetsonar
+  return query_assetsonar.main()
+
+def stage_load_members(results, options):
+  from members import DIRECTORY
+  DIRECTORY.load()
+  return None
+
+def stage_parse_responses(results, options):
+  import parse_responses
+  return parse_responses.main(results['query_assetsonar'], results['query_jamf'])
+
+def stage_retire_assets(results, options):
+  import retire_assets
+  if options.resume:
+    return retire_assets.main(resume=True)
+  return retire_assets.main(results['parse_responses']['assets']['not_in_jamf'])
+
+def stage_audit_users(results, options):
+  import audit_users
+  if options.resume:
+    return audit_users.main(resume=True)
+  return audit_users.main(results['parse_responses']['assigned'])
+
+def stage_auto_checkout(results, options):
+  import auto_checkout
+  return auto_checkout.main()
+
+def stage_generate_report(results, options):
+  import generate_report
+  os.makedirs('reports', exist_ok=True)
+  if options.resume:
+    return generate_report.main(no_jamf_user=results['audit_users']['no_jamf_user'])
+  return generate_report.main(results['parse_responses']['assets']['assets_in_jamf'],
+                              results['audit_users']['no_jamf_user'])
+
+
+# stage -> (dependencies, runner)
+# auto_checkout waits for retire_assets / audit_users because both check assets
+# in before retiring / checking them out again, and it must not grab them in between
+STAGES = {
+  'query_jamf': ((), stage_query_jamf),
+  'query_assetsonar': ((), stage_query_assetsonar),
+  'load_members': ((), stage_load_members),
+  'parse_responses': (('query_jamf', 'query_assetsonar'), stage_parse_responses),
+  'retire_assets': (('parse_responses',), stage_retire_assets),
+  'audit_users': (('parse_responses', 'load_members'), stage_audit_users),
+  'auto_checkout': (('retire_assets', 'audit_users'), stage_auto_checkout),
+  'generate_report': (('audit_users',), stage_generate_report),
+}
+
+# stages that fetch and reconcile; --resume reuses their output from the store
+FETCH_STAGES = ('query_jamf', 'query_assetsonar', 'parse_responses')
+
+# ==========================================================================
+
+def resume_stages(stages=STAGES):
+  """Drop the fetch stages so an interrupted run continues from the store
+
+  Args:
+    stages (dict): stage -> (dependencies, runner)
+
+  Returns:
+    dict: the remaining stages with fetch dependencies removed
+  """
+  return {name: (tuple(d for d in deps if d not in FETCH_STAGES), runner)
+          for name, (deps, runner) in stages.items() if name not in FETCH_STAGES}
+
+
+def run(stages=STAGES, options=None, workers=4):
+  """Run stages as soon as their dependencies finish
+
+  Args:
+    stages (dict): stage -> (dependencies, runner(results, options))
+    options (argparse.Namespace): command line options passed to every runner
+    workers (int): max stages running at once
+
+  Returns:
+    tuple: (results by stage, wall time by stage, failed stages)
+  """
+  results = {}
+  timings = {}
+  failed = set()
+  pending = dict(stages)
+  running = {}
+  started = {}
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    while pending or running:
+      # skip stages whose dependencies failed
+      for name, (deps, _) in list(pending.items()):
+        if any(d in failed for d in deps):
+          print(f'Skipping {name}: dependency failed', file=sys.stderr)
+          failed.add(name)
+          del pending[name]
+      # start every stage whose dependencies are done
+      for name, (deps, runner) in list(pending.items()):
+        if all(d in results for d in deps):
+          started[name] = time.perf_counter()
+          running[pool.submit(runner, results, options)] = name
+          del pending[name]
+      if not running:
+        break
+
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        name = running.pop(future)
+        timings[name] = time.perf_counter() - started[name]
+        try:
+          results[name] = future.result()
+        except Exception:
+          print(f'Stage {name} failed:\n{traceback.format_exc()}', file=sys.stderr)
+          failed.add(name)
+        METRICS.stage_done(name, timings[name], name not in failed)
+
+  return results, timings, failed
+
+
+def print_timings(timings, total):
+  """Print per-stage wall time
+
+  Args:
+    timings (dict): stage -> seconds
+    total (float): whole run wall time in seconds
+
+  Returns:
+    None
+  """
+  print('\n--- stage wall time ---')
+  for name in STAGES:
+    if name in timings:
+      print(f'{name:<20} {timings[name]:>9.2f}s')
+  print(f'{"total":<20} {total:>9.2f}s')
+  return None
+
+# ==========================================================================
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Run the full AssetSonar / Jamf audit in one process')
+  parser.add_argument('--artifacts', action='store_true',
+                      help='also write the intermediate JSON files (response_jamf_*.json, assets.json, ...)')
+  parser.add_argument('--workers', type=int, default=4, help='max stages running at once')
+  parser.add_argument('--resume', action='store_true',
+                      help='continue an interrupted run from the store without re-fetching, see checkpoint.py')
+  options = parser.parse_args(argv)
+
+  if options.artifacts:
+    import store
+    store.EXPORT_JSON = True
+
+  METRICS.claim_textfile()
+  start = time.perf_counter()
+  stages = resume_stages() if options.resume else STAGES
+  # waits for the webhook daemon to finish the event it is on, see daemon.py
+  with RunLock():
+    try:
+      _, timings, failed = run(stages, options, options.workers)
+    finally:
+      get_store().finish_audit() # even a failed run may have rewritten the snapshot
+  METRICS.stage_done('pipeline', time.perf_counter() - start, not failed)
+  print_timings(timings, time.perf_counter() - start)
+  if failed:
+    print(f'Failed stages: {", ".join(sorted(failed))}', file=sys.stderr)
+    return 1
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  print(f'\n\n--- pipeline.py ---')
+  sys.exit(main())
@@ -0,0 +1,69 @@
+from dotenv import load_dotenv
+import os
+
+# mutation planner: decide which AssetSonar calls an asset actually needs
+# from its status in the already-fetched snapshot, so no call is made that
+# is redundant (checkin of an available asset) or can't finish (checkin
+# before a checkout whose user can't be resolved)
+
+# ==========================================================================
+
+load_dotenv()
+# only enable these if the tenant accepts the call on a checked out asset;
+# each saves the checkin round trip before it
+CHECKOUT_TRANSFERS = os.getenv('ASSETSONAR_CHECKOUT_TRANSFERS', '0') == '1' # checkout.api reassigns a checked out asset
+RETIRE_CHECKED_OUT = os.getenv('ASSETSONAR_RETIRE_CHECKED_OUT', '0') == '1' # retire.api accepts a checked out asset
+
+# markers recorded instead of an API response for steps that were not sent
+NOT_NEEDED = 'NOT_NEEDED'
+NOT_ATTEMPTED = 'NOT_ATTEMPTED'
+NO_USER = 'NO_USER'
+
+# ==========================================================================
+
+def plan_reassign(status, user_id):
+  """Plan moving an asset to another user
+
+  Args:
+    status (str): asset status in the snapshot, None if unknown
+    user_id (int): AS member id to check out to, None if it couldn't be resolved
+
+  Returns:
+    list: steps to run in order, e.g. ['checkin', 'checkout']; empty if nothing can be done
+  """
+  if user_id is None:
+    return [] # a checkin alone would just leave the asset unassigned
+  if status == 'available' or CHECKOUT_TRANSFERS:
+    return ['checkout']
+  return ['checkin', 'checkout']
+
+
+def plan_checkout(status, user_id):
+  """Plan checking out an available asset
+
+  Args:
+    status (str): asset status in the snapshot, None if unknown
+    user_id (int): AS member id, None if it couldn't be resolved
+
+  Returns:
+    list: ['checkout'] or empty
+  """
+  if user_id is None or (status == 'checked_out' and not CHECKOUT_TRANSFERS):
+    return []
+  return ['checkout']
+
+
+def plan_retire(status):
+  """Plan retiring an asset
+
+  Args:
+    status (str): asset status in the snapshot, None if unknown
+
+  Returns:
+    list: steps to run in order, e.g. ['checkin', 'retire']
+  """
+  if status == 'retired':
+    return []
+  if status == 'available' or RETIRE_CHECKED_OUT:
+    return ['retire']
+  return ['checkin', 'retire']
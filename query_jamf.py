@@ -0,0 +1,220 @@
+import json
+import os
+import snapshot
+import sys
+from httpcache import get_cache
+from jamf import JamfClient, JamfError, stream_pages, write_json_atomic
+from jsonstream import iter_array, project
+from metrics import METRICS
+from parse_responses import JAMF_FIELDS
+
+# query jamf for computer and device data
+# writes the same four response_jamf_*.json files query_jamf.sh used to,
+# but fetches every page instead of only the first 2000 records
+# the files get whole records; what main() hands to parse_responses.py is cut
+# down to JAMF_FIELDS page by page, so the full HARDWARE / USER_AND_LOCATION
+# payloads are never all in memory at once
+
+# ==========================================================================
+
+COMPUTERS_INVENTORY = 'api/v1/computers-inventory'
+MOBILE_DEVICES_DETAIL = 'api/v2/mobile-devices/detail'
+CLASSIC_MOBILE_DEVICES = 'JSSResource/mobiledevices'
+
+# RSQL filters for delta sync: anything that reported inventory or checked in since the high-water mark
+COMPUTER_CHANGED_FILTER = 'general.reportDate>="{since}",general.lastContactTime>="{since}"'
+DEVICE_CHANGED_FILTER = 'lastInventoryUpdateDate>="{since}"'
+
+JAMF_FILES = [
+  'response_jamf_computers.json',
+  'response_jamf_devices.json',
+  'response_jamf_computer_users.json',
+  'response_jamf_device_users.json',
+]
+
+# ==========================================================================
+
+def current_computer_ids(client):
+  """Get the id of every computer in Jamf, so delta runs notice deleted ones
+
+  The computers-inventory endpoint can't drop sections, so this asks for the
+  small GENERAL section and keeps only the ids of each page.
+
+  Args:
+    client (JamfClient): Jamf client
+
+  Returns:
+    set: computer ids, None if fewer came back than Jamf's totalCount
+  """
+  ids = set()
+  total = 0
+  for total, page in client.iter_pages(COMPUTERS_INVENTORY, {'section': 'GENERAL', 'sort': 'id:asc'}):
+    ids.update(computer['id'] for computer in page)
+  if len(ids) < total:
+    # never drop computers on the strength of an incomplete list
+    print(f'Warning: got {len(ids)} computer ids but Jamf reported totalCount {total}, not dropping deleted computers',
+          file=sys.stderr)
+    return None
+  return ids
+
+
+def save_inventory(client, path, params, filename, key, fields, since=None, changed_filter=None, write=True, present=None):
+  """Fetch a paginated inventory endpoint, in full or as a delta merged into the snapshot
+
+  Args:
+    client (JamfClient): Jamf client
+    path (str): Jamf Pro API path
+    params (dict): query parameters
+    filename (str): response file
+    key (callable): record -> unique id, used to merge deltas
+    fields (dict): fields to keep in the returned records, see parse_responses.JAMF_FIELDS
+    since (str): ISO-8601 high-water mark, None for a full fetch
+    changed_filter (str): RSQL filter template taking {since}
+    write (bool): save the response file; deltas always need it
+    present (set): ids of every record still in Jamf; on a delta, snapshot records missing from it are dropped
+
+  Returns:
+    dict: {'totalCount': n, 'results': [...]} with records projected to fields
+  """
+  if since is None:
+    results = []
+    if write:
+      stream_pages(client, path, params, filename, collect=results, fields=fields)
+    else:
+      for _, page in client.iter_pages(path, params):
+        results.extend(project(record, fields) for record in page)
+    return {'totalCount': len(results), 'results': results}
+
+  delta = []
+  for _, results in client.iter_pages(path, {**params, 'filter': changed_filter.format(since=since)}):
+    delta.extend(results)
+  removed = []
+  if present is not None:
+    with open(filename, 'r') as f:
+      removed = [k for k in map(key, iter_array(f, 'results')) if k not in present]
+  data = snapshot.merge_file(filename, delta, key, 'results', removed=removed, fields=fields)
+  print(f'{filename}: merged {len(delta)} changed records, dropped {len(removed)} deleted ones')
+  return data
+
+
+def save_computers(client, since=None, write=True, present=None):
+  """Get all computers from Jamf with hardware data
+
+  Args:
+    client (JamfClient): Jamf client
+    since (str): only fetch computers changed since this time
+    write (bool): save response_jamf_computers.json
+    present (set): ids of every computer in Jamf, see current_computer_ids()
+
+  Returns:
+    dict: computers-inventory response, projected to JAMF_FIELDS
+  """
+  data = save_inventory(client, COMPUTERS_INVENTORY, {'section': 'HARDWARE', 'sort': 'id:asc'},
+                        'response_jamf_computers.json', lambda c: c['id'], JAMF_FIELDS['computers'][1],
+                        since, COMPUTER_CHANGED_FILTER, write, present)
+  print(f'--- Jamf computers fetched - total: {len(data["results"])} ---')
+  return data
+
+
+def save_computer_users(client, since=None, write=True, present=None):
+  """Get all computers from Jamf with user + location data
+
+  Args:
+    client (JamfClient): Jamf client
+    since (str): only fetch computers changed since this time
+    write (bool): save response_jamf_computer_users.json
+    present (set): ids of every computer in Jamf, see current_computer_ids()
+
+  Returns:
+    dict: computers-inventory response, projected to JAMF_FIELDS
+  """
+  # sort on id so records can't shift between pages while we paginate
+  data = save_inventory(client, COMPUTERS_INVENTORY, {'section': 'USER_AND_LOCATION', 'sort': 'id:asc'},
+                        'response_jamf_computer_users.json', lambda c: c['id'], JAMF_FIELDS['computer_users'][1],
+                        since, COMPUTER_CHANGED_FILTER, write, present)
+  print(f'--- Jamf computer users fetched - total: {len(data["results"])} ---')
+  return data
+
+
+def save_devices(client, write=True):
+  """Get all mobile devices from Jamf (classic API, unpaginated)
+
+  Args:
+    client (JamfClient): Jamf client
+    write (bool): save response_jamf_devices.json
+
+  Returns:
+    dict: JSSResource/mobiledevices response, projected to JAMF_FIELDS
+  """
+  data = client.get_json(CLASSIC_MOBILE_DEVICES)
+  if write:
+    write_json_atomic('response_jamf_devices.json', lambda f: json.dump(data, f))
+  key, fields = JAMF_FIELDS['devices']
+  devices = [project(device, fields) for device in data.get(key, [])]
+  print(f'--- Jamf mobile devices fetched - total: {len(devices)} ---')
+  return {key: devices}
+
+
+def save_device_users(client, since=None, write=True):
+  """Get all mobile devices from Jamf with user + location data
+
+  Args:
+    client (JamfClient): Jamf client
+    since (str): only fetch mobile devices changed since this time
+    write (bool): save response_jamf_device_users.json
+
+  Returns:
+    dict: mobile-devices/detail response, projected to JAMF_FIELDS
+  """
+  data = save_inventory(client, MOBILE_DEVICES_DETAIL, {'section': 'USER_AND_LOCATION', 'sort': 'mobileDeviceId:asc'},
+                        'response_jamf_device_users.json', lambda d: d['mobileDeviceId'], JAMF_FIELDS['device_users'][1],
+                        since, DEVICE_CHANGED_FILTER, write)
+  print(f'--- Jamf mobile users fetched - total: {len(data["results"])} ---')
+  return data
+
+# ==========================================================================
+
+def main(write_files=True):
+  """Fetch the Jamf inventory
+
+  Args:
+    write_files (bool): save the response_jamf_*.json files; always on in incremental mode
+      since they are the snapshot deltas merge into
+
+  Returns:
+    dict: computers, devices, computer_users and device_users responses, projected to JAMF_FIELDS
+  """
+  # start
+  client = JamfClient(cache=get_cache())
+  full, since = snapshot.plan('jamf', all(os.path.exists(f) for f in JAMF_FILES))
+  write = write_files or snapshot.INCREMENTAL_SYNC
+  started = snapshot.now()
+  try:
+    print(f'Jamf Pro version: {client.get_json("api/v1/jamf-pro-version").get("version")}')
+    jamf = {}
+    # deltas only carry changed computers, so deleted ones are found by comparing ids
+    computer_ids = current_computer_ids(client) if since else None
+    jamf['computers'] = save_computers(client, since, write, computer_ids)
+    jamf['devices'] = save_devices(client, write) # classic endpoint has no filter, and is how we notice deleted mobile devices
+    jamf['computer_users'] = save_computer_users(client, since, write, computer_ids)
+    jamf['device_users'] = save_device_users(client, since, write)
+  finally:
+    # kill api access token
+    client.invalidate_token()
+  if write:
+    snapshot.mark('jamf', started, full)
+    print(f'Jamf responses saved to {", ".join(JAMF_FILES)}')
+  print('Done')
+  return jamf
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  print(f'\n\n--- query_jamf.py ---')
+  try:
+    with METRICS.stage('query_jamf'):
+      main()
+  except JamfError as e:
+    # previous response files are left untouched, so nothing downstream sees a partial inventory
+    print(f'Jamf query failed: {e}', file=sys.stderr)
+    sys.exit(1)
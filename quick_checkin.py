@@ -1,68 +1,215 @@
 import csv
 import json
-from dotenv import load_dotenv
-import os
-import requests
+import sys
+import threading
+import time
+from assetsonar import AssetSonarError, get_client
+from metrics import METRICS
+from mutations import run_mutations
+from records import Asset
+from store import get_store
 import urllib3
 
+# check in a list of assets by serial number, e.g. a lab of returned devices
+# the CSV is streamed and every serial is looked up in an index of the store's
+# snapshot; serials the snapshot doesn't know are looked up live in AssetSonar
+# the snapshot only supplies the asset id: its status can be stale (assets get
+# checked out after it was taken), so every serial found is checked in
+# check-ins run concurrently and every serial gets a row in RESULTS_FILE,
+# including ones that were not found or failed
+
 # ==========================================================================
 
-with open('to_checkin.csv', 'r') as f:
-  reader = csv.reader(f)
-  SERIALS = [row[0] for row in reader if row]
+CHECKIN_FILE = 'to_checkin.csv'           # one serial number per row
+RESULTS_FILE = 'assets_quick_checkin.csv' # one result row per serial number
+RESULT_COLUMNS = ['Serial Number', 'Asset ID', 'Device Name', 'Result', 'HTTP Status', 'Detail']
 
-with open('assets.json', 'r') as f:
-  ASSETS = json.load(f)
+# ==========================================================================
 
-load_dotenv()
-ASSETSONAR_TOKEN = os.getenv('COMPANY_TOKEN')
-ASSETSONAR_SUBDOMAIN = os.getenv('COMPANY_SUBDOMAIN')
-BASE_URL = f'https://{ASSETSONAR_SUBDOMAIN}.assetsonar.com'
+def read_serials(filename=CHECKIN_FILE):
+  """Stream the serial numbers to check in
+
+  Args:
+    filename (str): CSV file, serial number in the first column
+
+  Yields:
+    str: serial numbers as written
+  """
+  with open(filename, 'r', newline='') as f:
+    for row in csv.reader(f):
+      if row:
+        yield row[0]
+
+
+def unique_serials(serials):
+  """Normalise serial numbers and drop blanks and repeats, keeping the first occurrence
+
+  Args:
+    serials (iterable): serial numbers
+
+  Yields:
+    str: upper-cased serial numbers
+  """
+  seen = set()
+  for sn in serials:
+    sn = sn.strip().upper()
+    if sn and sn not in seen:
+      seen.add(sn)
+      yield sn
+
+
+def index_assets(store):
+  """Index the snapshot's checked out and available assets by serial number
+
+  Args:
+    store (Store): state store
+
+  Returns:
+    dict: serial number -> Asset
+  """
+  index = {}
+  for status in ('available', 'checked_out'): # checked_out wins if a serial is in both
+    for asset in store.assets(status):
+      index[asset.serial_no.upper()] = asset
+  return index
 
-# ==========================================================================
 
 def checkin_asset(id):
-  endpoint = f'assets/{id}/checkin.api'
-  url = f'{BASE_URL}/{endpoint}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'checkin_values[location_id]': 30681, # location == society office
-  }
-
-  response = requests.put(url, headers=headers, params=params, timeout=30, verify=False)
-  return response.status_code, response.json()
+  return get_client().checkin_asset(id)
+
+
+def lookup_asset(serial):
+  """Look up a serial number the snapshot doesn't know, live in AssetSonar
+
+  Args:
+    serial (str): serial number
+
+  Returns:
+    tuple: (serial number, Asset or None, error message or None)
+  """
+  try:
+    found = get_client().find_asset(serial)
+  except AssetSonarError as e:
+    return serial, None, str(e)
+  return serial, Asset.from_api(found, 'assigned_to_user_email') if found else None, None
 
 # ==========================================================================
 
-def main():
-  # start
+class Progress:
+  """Progress bar on stderr, ticked by the check-in workers"""
 
+  def __init__(self, total, width=30):
+    self.total = total
+    self.width = width
+    self.done = 0
+    self.failed = 0
+    self.drawn = 0
+    self.tty = sys.stderr.isatty() # launchd logs get the summary line only
+    self.lock = threading.Lock()
+
+  def tick(self, ok):
+    with self.lock:
+      self.done += 1
+      self.failed += not ok
+      if self.tty and (self.done == self.total or time.monotonic() - self.drawn >= 0.1):
+        self.draw('\r')
+
+  def draw(self, start=''):
+    filled = self.width * self.done // max(1, self.total)
+    print(f'{start}Checking in [{"#" * filled}{"." * (self.width - filled)}] {self.done}/{self.total}, '
+          f'{self.failed} failed', end='', file=sys.stderr, flush=True)
+    self.drawn = time.monotonic()
+
+  def close(self):
+    if not self.tty:
+      self.draw()
+    print(file=sys.stderr)
+
+
+class ResultWriter:
+  """Thread-safe CSV writer for the per-serial results, flushed as rows come in"""
+
+  def __init__(self, f):
+    self.f = f
+    self.writer = csv.writer(f)
+    self.lock = threading.Lock()
+    self.counts = {}
+    self.writer.writerow(RESULT_COLUMNS)
+
+  def write(self, serial, asset, result, status_code=None, detail=None):
+    with self.lock:
+      self.writer.writerow([serial, asset.asset_id if asset else '', asset.name if asset else '', result,
+                            status_code or '', json.dumps(detail) if isinstance(detail, dict) else detail or ''])
+      self.f.flush()
+      self.counts[result] = self.counts.get(result, 0) + 1
+
+# ==========================================================================
+
+def main(filename=CHECKIN_FILE, serials=None, results_file=RESULTS_FILE):
+  """Check in assets by serial number
+
+  Args:
+    filename (str): CSV file read when no serials are given
+    serials (list): serial numbers
+    results_file (str): per-serial result CSV to write
+
+  Returns:
+    dict: result -> number of serials
+  """
+  # start
+  store = get_store()
+  index = index_assets(store)
   checked_in = {'all': []}
 
-  for sn in SERIALS:
-    sn = sn.upper()
-    this_asset = {'serial_no': sn}
-    asset = next((a for a in ASSETS['assets_in_jamf'] if a['serial_no'] == sn), None)
-    if asset:
-      status_code, response_json = checkin_asset(asset['asset_id'])
-      if 200 <= status_code < 300:
-        print(f'Checked in asset {sn}: {response_json}')
-        this_asset['name'] = asset['name']
-        this_asset['checkin_response'] = response_json
-        checked_in['all'].append(this_asset)
-  checked_in['total'] = len(checked_in['all'])
+  with open(results_file, 'w', newline='') as f:
+    results = ResultWriter(f)
+    to_checkin = []
+    missing = []
+    for sn in unique_serials(serials or read_serials(filename)):
+      asset = index.get(sn)
+      if asset is None:
+        missing.append(sn)
+      else:
+        to_checkin.append(asset)
 
+    if missing:
+      print(f'{len(missing)} serial numbers not in the snapshot, looking them up in AssetSonar')
+      for sn, asset, error in run_mutations(missing, lookup_asset, key=lambda sn: sn):
+        if asset is not None:
+          to_checkin.append(asset)
+        else:
+          results.write(sn, None, 'lookup_failed' if error else 'not_found', detail=error)
+
+    progress = Progress(len(to_checkin))
+    def checkin(asset):
+      status_code, response_json = checkin_asset(asset.asset_id)
+      ok = status_code is not None and 200 <= status_code < 300
+      results.write(asset.serial_no, asset, 'checked_in' if ok else 'failed', status_code, response_json)
+      progress.tick(ok)
+      return ok, response_json
+
+    done = []
+    for asset, (ok, response_json) in zip(to_checkin, run_mutations(to_checkin, checkin)):
+      if ok:
+        done.append(asset)
+        checked_in['all'].append({'serial_no': asset.serial_no, 'name': asset.name, 'checkin_response': response_json})
+    progress.close()
+
+  # keep the snapshot current for the other stages
+  store.merge_assets('available', done)
+  checked_in['total'] = len(checked_in['all'])
   with open('assets_quick_checkin.json', 'w') as f:
     json.dump(checked_in, f, indent=2)
 
+  print(', '.join(f'{n} {result}' for result, n in sorted(results.counts.items())) or 'Nothing to check in')
+  print(f'Results saved to {results_file}')
   print('Done')
   # done
+  return results.counts
 
 # ==========================================================================
 
 if __name__ == '__main__':
   urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-  main()
+  with METRICS.stage('quick_checkin'):
+    main()
@@ -0,0 +1,194 @@
+import sys
+
+# compact typed records shared by every stage
+# slotted classes instead of ad-hoc dicts: tens of thousands of assets and
+# devices cost a fraction of the memory, repeated strings (emails,
+# manufacturers, roles) are interned, and the AssetSonar / Jamf field
+# extraction lives in one place instead of being copied between scripts
+
+# ==========================================================================
+
+def intern_str(value):
+  """Intern a string so repeated values share one object
+
+  Args:
+    value: any value, only str is interned
+
+  Returns:
+    value, interned if it is a str
+  """
+  return sys.intern(value) if isinstance(value, str) else value
+
+
+def to_json(value):
+  """json.dump default hook for records
+
+  Args:
+    value: object json can't serialise natively
+
+  Returns:
+    dict: the record as a plain dict
+  """
+  if isinstance(value, Record):
+    return value.to_dict()
+  raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+# ==========================================================================
+
+class Record:
+  """Base for slotted records; subclasses list their fields in __slots__"""
+
+  __slots__ = ()
+  INTERNED = () # fields whose strings are interned
+  NESTED = {}   # field -> record class, for to_dict / from_dict
+
+  def __init__(self, **fields):
+    interned = self.INTERNED
+    for name in self.__slots__:
+      value = fields.get(name)
+      setattr(self, name, intern_str(value) if name in interned else value)
+
+  def __repr__(self):
+    fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+    return f'{type(self).__name__}({fields})'
+
+  def __eq__(self, other):
+    return type(self) is type(other) and all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+  def to_dict(self):
+    """Convert to a plain dict, e.g. for JSON export or the store
+
+    Returns:
+      dict: field -> value, nested records converted too
+    """
+    data = {}
+    for name in self.__slots__:
+      value = getattr(self, name)
+      data[name] = value.to_dict() if isinstance(value, Record) else value
+    return data
+
+  @classmethod
+  def from_dict(cls, data):
+    """Build a record from a plain dict, ignoring unknown keys
+
+    Args:
+      data (dict): e.g. decoded JSON or a store row
+
+    Returns:
+      Record: new record
+    """
+    fields = {name: data.get(name) for name in cls.__slots__}
+    for name, nested in cls.NESTED.items():
+      if isinstance(fields[name], dict):
+        fields[name] = nested.from_dict(fields[name])
+    return cls(**fields)
+
+# ==========================================================================
+
+class JamfUser(Record):
+  """Jamf userAndLocation, normalised across the computer and mobile APIs"""
+
+  __slots__ = ('username', 'real_name', 'email')
+  INTERNED = ('email',)
+
+  @classmethod
+  def from_api(cls, user_data):
+    """Build from a Jamf userAndLocation record
+
+    Args:
+      user_data (dict): computers-inventory or mobile-devices/detail userAndLocation
+
+    Returns:
+      JamfUser: user, email None if Jamf has none
+    """
+    return cls(username=user_data.get('username') or '',
+               real_name=user_data.get('realName') or user_data.get('realname') or '',
+               email=user_data.get('email') or user_data.get('emailAddress') or None)
+
+
+class Asset(Record):
+  """AssetSonar asset, joined to Jamf by parse_responses.py"""
+
+  __slots__ = ('asset_id', 'serial_no', 'name', 'assigned_email', 'manufacturer', 'jamf_id', 'jamf_user_data')
+  INTERNED = ('assigned_email', 'manufacturer')
+  NESTED = {'jamf_user_data': JamfUser}
+
+  @classmethod
+  def from_api(cls, asset, email_field):
+    """Build from a filter.api asset
+
+    Args:
+      asset (dict): AssetSonar asset
+      email_field (str): field holding the user email, e.g. assigned_to_user_email or candidate_email
+
+    Returns:
+      Asset: compact asset, None if it has no serial number
+    """
+    serial_number = asset.get('bios_serial_number')
+    if not serial_number:
+      return None
+    return cls(asset_id=asset.get('sequence_num'), serial_no=serial_number,
+               name=asset.get('name', 'Unknown Device'), assigned_email=asset.get(email_field),
+               manufacturer=asset.get('manufacturer'))
+
+  def jamf_email(self):
+    """Get the Jamf user's email
+
+    Returns:
+      str: email or None if there is no Jamf user or email
+    """
+    return self.jamf_user_data.email if self.jamf_user_data else None
+
+
+class JamfComputer(Record):
+  """Jamf computer from api/v1/computers-inventory"""
+
+  __slots__ = ('id', 'serial_no', 'name')
+
+  @classmethod
+  def from_api(cls, computer):
+    return cls(id=str(computer['id']), serial_no=computer['hardware']['serialNumber'],
+               name=(computer.get('general') or {}).get('name'))
+
+
+class JamfMobileDevice(Record):
+  """Jamf mobile device from JSSResource/mobiledevices"""
+
+  __slots__ = ('id', 'serial_no', 'name')
+
+  @classmethod
+  def from_api(cls, device):
+    return cls(id=str(device['id']), serial_no=device['serial_number'], name=device.get('name'))
+
+
+class Member(Record):
+  """AssetSonar member from members.api"""
+
+  __slots__ = ('id', 'name', 'email', 'EGY', 'role')
+  INTERNED = ('email', 'EGY', 'role')
+
+  @classmethod
+  def from_api(cls, user):
+    return cls(id=user['id'], name=user['full_name'], email=user['email'], EGY=user.get('EGY'),
+               role=user['role_name'])
+
+
+class AuditOutcome(Record):
+  """One asset's result in a pipeline stage, saved to the store's audit_outcomes table"""
+
+  __slots__ = ('asset_id', 'serial_no', 'category', 'data')
+  INTERNED = ('category',)
+
+  @classmethod
+  def of(cls, asset, category, data):
+    """Build an outcome for an asset
+
+    Args:
+      asset (Asset): asset the outcome is for
+      category (str): outcome category, e.g. wrong_user, retired, skipped
+      data (Asset | dict): outcome data, e.g. the asset itself or a mutation record
+
+    Returns:
+      AuditOutcome: outcome
+    """
+    return cls(asset_id=asset.asset_id, serial_no=asset.serial_no, category=category, data=data)
@@ -1,23 +1,16 @@
-import json
-from dotenv import load_dotenv
-import os
-import requests
-from datetime import datetime
+import argparse
+from assetsonar import get_client
+from checkpoint import Checkpoint
+import journal
+from metrics import METRICS
+import planner
+from records import Asset, AuditOutcome
+from store import export_json, get_store
 
 # find and retire from AS all assets that are not in Jamf
 
 # ==========================================================================
 
-with open('assets.json', 'r') as f:
-  ASSETS = json.load(f)
-
-load_dotenv()
-ASSETSONAR_TOKEN = os.getenv('COMPANY_TOKEN')
-ASSETSONAR_SUBDOMAIN = os.getenv('COMPANY_SUBDOMAIN')
-BASE_URL = f'https://{ASSETSONAR_SUBDOMAIN}.assetsonar.com'
-
-# ==========================================================================
-
 def checkin_asset(id):
   """Check in an asset in AssetSonar
 
@@ -25,20 +18,9 @@ def checkin_asset(id):
     id (str): AS id of the asset to check in
 
   Returns:
-    dict: API response
+    tuple: (status code, API response)
   """
-  endpoint = f'assets/{id}/checkin.api'
-  url = f'{BASE_URL}/{endpoint}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'checkin_values[location_id]': 30681, # location == society office
-  }
-
-  response = requests.put(url, headers=headers, params=params, timeout=30, verify=False)
-  return response.json()
+  return get_client().checkin_asset(id)
 
 
 def retire_asset(id):
@@ -48,57 +30,101 @@ def retire_asset(id):
     id (str): AS id of the asset to retire
 
   Returns:
-    dict: API response
+    tuple: (status code, API response)
   """
-  endpoint = f'assets/{id}/retire.api'
-  url = f'{BASE_URL}/{endpoint}'
-  headers = {
-    'token': ASSETSONAR_TOKEN,
-    'Content-Type': 'application/x-www-form-urlencoded' # As per curl, though params are used for GET
-  }
-  params = {
-    'fixed_asset[retired_on]': datetime.today().strftime('%m/%d/%Y'),
-    'fixed_asset[retire_reason_id]': 101650, # reason == deleted from jamf
-  }
-
-  response = requests.put(url, headers=headers, params=params, timeout=30, verify=False)
-  return response.json()
+  return get_client().retire_asset(id)
 
 # ==========================================================================
 
-def main():
-  # start
-  retired = []
-  for asset in ASSETS['not_in_jamf']:
-    # skip non-apple assets since they arent in jamf
-    if asset['manufacturer'] != 'Apple':
-      print(f"Skipping non-Apple asset: {asset['serial_no']}")
-      continue
-    this_asset = {}
+def checkin_and_retire(asset, status=None):
+  """Retire a not-in-Jamf asset, checking it in first if needed
 
-    # checkin
-    response = checkin_asset(asset['asset_id'])
-    print(f'\nChecked in asset {asset['serial_no']}: {response}')
-    this_asset['checkin_response'] = response
+  Args:
+    asset (Asset): not_in_jamf asset from parse_responses.py
+    status (str): asset status in the snapshot, see planner.plan_retire()
 
-    # retire
-    response = retire_asset(asset['asset_id'])
-    print(f'Retired asset {asset['serial_no']}: {response}')
+  Returns:
+    dict: retiree record
+  """
+  steps = planner.plan_retire(status)
+  this_asset = {'checkin_response': planner.NOT_NEEDED, 'retire_response': planner.NOT_NEEDED}
+  codes = []
+
+  # checkin
+  if 'checkin' in steps:
+    code, response = checkin_asset(asset.asset_id)
+    print(f'\nChecked in asset {asset.serial_no}: {response}')
+    this_asset['checkin_response'] = response
+    codes.append(code)
+    if not journal.succeeded(code):
+      this_asset['retire_response'] = planner.NOT_ATTEMPTED
+
+  # retire
+  if 'retire' in steps and journal.succeeded(*codes):
+    code, response = retire_asset(asset.asset_id)
+    print(f'Retired asset {asset.serial_no}: {response}')
     this_asset['retire_response'] = response
+    codes.append(code)
+
+  # record retiree asset
+  this_asset['serial_no'] = asset.serial_no
+  this_asset['name'] = asset.name or 'Unknown'
+  this_asset['ok'] = journal.succeeded(*codes)
+  return this_asset
+
+# ==========================================================================
+
+def main(not_in_jamf=None, resume=False, shard=None):
+  """Checkin and retire every Apple asset that is not in Jamf
 
-    # record retiree asset
-    this_asset['serial_no'] = asset['serial_no']
-    this_asset['name'] = asset.get('name', 'Unknown')
-    retired.append(this_asset)
+  Args:
+    not_in_jamf (list): assets not in Jamf, read from the store if None
+    resume (bool): skip assets an interrupted run already finished, see checkpoint.py
+    shard (shards.Shard): only retire this shard's assets, see shards.py
 
-  with open('assets_retired.json', 'w') as f:
-    json.dump(retired, f, indent=2)
+  Returns:
+    list: retiree records
+  """
+  # start
+  store = get_store()
+  if not_in_jamf is None:
+    not_in_jamf = list(map(Asset.from_dict, store.outcomes('reconcile', 'not_in_jamf')))
+  if shard is not None:
+    not_in_jamf = shard.select(not_in_jamf)
+  to_retire = []
+  for asset in not_in_jamf:
+    # skip non-apple assets since they arent in jamf
+    if asset.manufacturer != 'Apple':
+      print(f"Skipping non-Apple asset: {asset.serial_no}")
+      continue
+    to_retire.append(asset)
+  # don't keep retrying retirements that failed recently
+  to_retire, skipped = journal.split_settled('retire', to_retire, store)
+  statuses = store.asset_statuses()
+  checkpoint = Checkpoint(shard.name('retire_assets') if shard else 'retire_assets', resume)
+  retire = lambda asset: checkin_and_retire(asset, statuses.get(asset.asset_id))
+  to_retire, retired = checkpoint.run('retire', to_retire, shard.guard(retire) if shard else retire)
+  journal.record('retire', to_retire, retired, store)
+
+  outcomes = [AuditOutcome.of(asset, 'retired', record) for asset, record in zip(to_retire, retired)]
+  outcomes.extend(AuditOutcome.of(asset, 'skipped', record) for asset, record in skipped)
+  if shard is not None:
+    store.merge_outcomes('retire', outcomes)
+  else:
+    store.replace_outcomes('retire', outcomes)
+    export_json('assets_retired.json', retired, indent=2)
   print(f'Retired {len(retired)} assets')
-  print(f'List saved to assets_retired.json')
+  print(f'List saved to {store.path}')
+  checkpoint.finish()
   print('Done')
+  return retired
 
 # ==========================================================================
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Retire Apple assets that are not in Jamf')
+  parser.add_argument('--resume', action='store_true', help='continue an interrupted run, skipping assets it finished')
+  options = parser.parse_args()
   print(f'\n\n--- retire_assets.py ---')
-  main()
+  with METRICS.stage('retire_assets'):
+    main(resume=options.resume)
@@ -3,19 +3,21 @@
 LOG_DIR="./logs"
 LOG_FILE="$LOG_DIR/$(date '+%Y-%m-%d_%H-%M-%S').log"
 mkdir -p "$LOG_DIR"
-ls -1t "$LOG_DIR" | tail -n +7 | xargs -I {} rm -f "$LOG_DIR/{}"
+# keep the last 6 runs: a .log and a .jsonl metrics event log each
+ls -1t "$LOG_DIR" | tail -n +13 | xargs -I {} rm -f "$LOG_DIR/{}"
+export METRICS_EVENTS="${LOG_FILE%.log}.jsonl"
 
 PROJECT="$PWD"
 VENV="$PROJECT/.venv/bin/python3"
 
 echo "Script start @ $(date)" >> "$LOG_FILE"
 
-sh query_jamf.sh >> "$LOG_FILE" 2>&1
-$VENV query_assetsonar.py >> "$LOG_FILE" 2>&1
-$VENV parse_responses.py >> "$LOG_FILE" 2>&1
-$VENV retire_assets.py >> "$LOG_FILE" 2>&1
-$VENV audit_users.py >> "$LOG_FILE" 2>&1
-$VENV auto_checkout.py >> "$LOG_FILE" 2>&1
-sh report.sh >> "$LOG_FILE" 2>&1
+REPORT_DIR="./reports"
+mkdir -p "$REPORT_DIR"
+# keep the last 6 runs: a report and a delta report each, older runs stay in the audit history
+ls -1t "$REPORT_DIR" | tail -n +13 | xargs -I {} rm -f "$REPORT_DIR/{}"
+
+# every stage in one process, see pipeline.py
+$VENV pipeline.py >> "$LOG_FILE" 2>&1
 
 echo -e "\nScript end @ $(date)" >> "$LOG_FILE"
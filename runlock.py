@@ -0,0 +1,75 @@
+from dotenv import load_dotenv
+import fcntl
+import os
+
+# advisory lockfile shared by the scheduled full audit (pipeline.py) and the
+# webhook daemon (daemon.py) so their AssetSonar mutations never overlap
+# flock is released by the OS if the holder dies, so a crash never leaves a stale lock
+
+# ==========================================================================
+
+load_dotenv()
+LOCK_FILE = os.getenv('ASAUDIT_LOCK', 'asaudit.lock')
+
+# ==========================================================================
+
+class RunLock:
+  """Exclusive flock on LOCK_FILE"""
+
+  def __init__(self, path=LOCK_FILE):
+    self.path = path
+    self.file = None
+
+  def acquire(self, blocking=True):
+    """Take the lock
+
+    Args:
+      blocking (bool): wait for the holder to finish instead of giving up
+
+    Returns:
+      bool: True if the lock is now held
+    """
+    if self.file is not None:
+      return True
+    f = open(self.path, 'a+')
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+      f.close()
+      return False
+    # holder's pid, for whoever finds the lock taken
+    f.seek(0)
+    f.truncate()
+    f.write(f'{os.getpid()}\n')
+    f.flush()
+    self.file = f
+    return True
+
+  def release(self):
+    if self.file is None:
+      return None
+    fcntl.flock(self.file, fcntl.LOCK_UN)
+    self.file.close()
+    self.file = None
+    return None
+
+  def holder(self):
+    """Get the pid written by the current holder
+
+    Returns:
+      str: pid or None if unknown
+    """
+    try:
+      with open(self.path) as f:
+        return f.read().strip() or None
+    except OSError:
+      return None
+
+  def __enter__(self):
+    if not self.acquire(blocking=False):
+      print(f'Waiting for {self.path}, held by pid {self.holder()}')
+      self.acquire()
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
@@ -0,0 +1,372 @@
+import argparse
+from dotenv import load_dotenv
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zlib
+from assetsonar import RATE_BURST, RATE_LIMIT, TokenBucket, get_client
+from concurrency import CONCURRENCY_MAX, CONCURRENCY_START, AdaptiveLimit
+from metrics import METRICS
+from runlock import RunLock
+from store import get_store
+
+# sharded mutation stages for fleets where one process is too slow
+# assets are split into shards by a stable hash of their serial number, so all
+# of one asset's mutations (retire, reassign / assign, auto checkout) land in
+# the same shard and still run in order
+# the coordinator fetches and reconciles once, then opens a run in the store's
+# shard_leases table; workers claim a shard at a time with an expiring lease,
+# run the three mutation stages for it and mark it done. A worker keeps its
+# lease alive while it works, and if it dies the lease runs out and another
+# worker takes the shard over, resuming from the dead worker's checkpoint (see
+# checkpoint.py) and the mutation journal. A worker that can't renew its lease
+# in time stops before its next asset and leaves the shard unfinished, so it
+# never starts an asset after the lease could have passed to someone else; only
+# the assets it had in flight at that moment can be repeated by the new owner
+# every worker runs on the coordinator's host, in the same directory: the
+# checkpoints a taken-over shard resumes from are local files, and the store's
+# WAL mode needs shared memory, which SQLite can't provide over a network filesystem
+#
+#   python3 shards.py start --shards 16 --workers 4   # fetch, reconcile, run 4 local workers, report
+#   python3 shards.py work                            # join the current run from another terminal
+#   python3 shards.py status
+
+# ==========================================================================
+
+load_dotenv()
+SHARD_COUNT = int(os.getenv('ASAUDIT_SHARDS', 16))
+LEASE_SECONDS = float(os.getenv('ASAUDIT_LEASE_SECONDS', 300)) # renewed every third of this while a shard runs
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+MUTATION_OUTCOMES = ('retire', 'reassign', 'autocheckout')
+
+# ==========================================================================
+
+def shard_of(serial, shards):
+  """Get the shard a serial number belongs to
+
+  crc32 rather than hash(), which is salted per process
+
+  Args:
+    serial (str): asset serial number
+    shards (int): number of shards
+
+  Returns:
+    int: shard index
+  """
+  return zlib.crc32(serial.encode()) % shards
+
+
+class LeaseLost(Exception):
+  """Raised between assets once a worker no longer holds its shard's lease"""
+
+
+class Shard:
+  """One slice of the asset set"""
+
+  def __init__(self, index, count, lease=None):
+    self.index = index
+    self.count = count
+    self.lease = lease
+
+  def __contains__(self, asset):
+    return shard_of(asset.serial_no, self.count) == self.index
+
+  def __str__(self):
+    return f'{self.index + 1}/{self.count}'
+
+  def select(self, assets):
+    return [asset for asset in assets if asset in self]
+
+  def name(self, stage):
+    # per-shard checkpoint file, see checkpoint.py
+    return f'{stage}.shard{self.index}of{self.count}'
+
+  def guard(self, task):
+    """Make a run_mutations() task stop the shard once its lease is lost
+
+    Args:
+      task (callable): takes one asset, returns its result record
+
+    Returns:
+      callable: task that raises LeaseLost instead of starting an asset without the lease
+    """
+    def guarded(asset):
+      if self.lease is not None and not self.lease.held():
+        raise LeaseLost(f'lost the lease on shard {self}')
+      return task(asset)
+    return guarded
+
+
+class Lease:
+  """Keeps a claimed shard's lease alive from a background thread"""
+
+  def __init__(self, store, job, shard, owner=WORKER_ID, seconds=LEASE_SECONDS, claimed=None):
+    self.store = store
+    self.job = job
+    self.shard = shard
+    self.owner = owner
+    self.seconds = seconds
+    # when the lease runs out as far as this worker knows: never later than the
+    # store's expiry, since it is counted from before the claim / renewal was sent
+    self.expires = (claimed or time.monotonic()) + seconds
+    self.lost = threading.Event()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.renew, name=f'lease-{shard}', daemon=True)
+
+  def held(self):
+    return not self.lost.is_set() and time.monotonic() < self.expires
+
+  def renew(self):
+    while not self.stopped.wait(self.seconds / 3):
+      sent = time.monotonic()
+      try:
+        renewed = self.store.renew_lease(self.job, self.shard, self.owner, self.seconds)
+      except sqlite3.Error as e:
+        # e.g. the store stayed locked; try again next round, held() runs out if it keeps failing
+        print(f'Could not renew the lease on shard {self.shard + 1}: {e}', file=sys.stderr)
+        continue
+      if not renewed:
+        print(f'Lost the lease on shard {self.shard + 1}, another worker took it over', file=sys.stderr)
+        self.lost.set()
+        return None
+      self.expires = sent + self.seconds
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.thread.join()
+
+# ==========================================================================
+
+def run_shard(shard, resume=False):
+  """Run the mutation stages for one shard's assets
+
+  Args:
+    shard (Shard): shard to handle
+    resume (bool): the shard was taken over from a worker whose lease expired
+
+  Returns:
+    None
+  """
+  import audit_users
+  import auto_checkout
+  import retire_assets
+  store = get_store()
+  with METRICS.stage('retire_assets'):
+    retire_assets.main(resume=resume, shard=shard)
+  with METRICS.stage('audit_users'):
+    audit_users.main(resume=resume, shard=shard)
+  with METRICS.stage('auto_checkout'):
+    _, outcomes = auto_checkout.checkout_available(store.assets('available'), shard)
+    store.merge_outcomes('autocheckout', outcomes)
+  return None
+
+
+def work(job=None, owner=WORKER_ID, seconds=LEASE_SECONDS):
+  """Claim and run shards until every shard of the run is done
+
+  Args:
+    job (str): run id, defaults to the run the coordinator opened last
+    owner (str): worker id recorded on the lease
+    seconds (float): lease length
+
+  Returns:
+    int: exit status, 1 if a shard failed
+  """
+  store = get_store()
+  job = job or store.get_meta('shard_job')
+  if job is None:
+    print('No sharded run to join, start one with: python3 shards.py start', file=sys.stderr)
+    return 1
+  handled = 0
+  while True:
+    claimed = time.monotonic()
+    claim = store.claim_shard(job, owner, seconds)
+    if claim is None:
+      leases = store.shard_leases(job)
+      held = [lease['expires_at'] for lease in leases if lease['done_at'] is None]
+      if not held:
+        break
+      # others are still working; wait to take over any lease that runs out
+      time.sleep(min(5, max(0.1, min(held) - time.time())))
+      continue
+
+    lease = Lease(store, job, claim['shard'], owner, seconds, claimed)
+    shard = Shard(claim['shard'], claim['shards'], lease)
+    taken_over = claim['attempts'] > 0
+    print(f'{owner}: shard {shard}' + (' (taking over an expired lease)' if taken_over else ''))
+    start = time.perf_counter()
+    try:
+      with lease:
+        run_shard(shard, resume=taken_over)
+      if not store.finish_shard(job, shard.index, owner):
+        raise LeaseLost(f'lost the lease on shard {shard}')
+    except LeaseLost as e:
+      # never finished: nothing is in flight any more, so hand the shard back
+      # unless another worker already took it, and let the next owner resume it
+      print(f'{owner}: {e}, stopped and left it to the next worker', file=sys.stderr)
+      store.release_shard(job, shard.index, owner)
+      METRICS.count('shards_lost_total')
+      continue
+    except Exception:
+      print(f'Shard {shard} failed:\n{traceback.format_exc()}', file=sys.stderr)
+      store.release_shard(job, shard.index, owner)
+      return 1
+    METRICS.count('shards_done_total')
+    handled += 1
+    print(f'{owner}: shard {shard} done in {time.perf_counter() - start:.2f}s')
+  print(f'{owner}: all shards of {job} done, {handled} handled here')
+  return 0
+
+
+def budget_share(workers):
+  """Split the AssetSonar request budget evenly between worker processes
+
+  Every process has its own token bucket and adaptive limit, so each worker
+  gets a share of them, or N workers would send N times ASSETSONAR_RATE_LIMIT.
+
+  Args:
+    workers (int): worker processes, the coordinator included
+
+  Returns:
+    dict: ASSETSONAR_* setting -> one worker's value
+  """
+  return {
+    'ASSETSONAR_RATE_LIMIT': RATE_LIMIT / workers, # 0 still disables
+    'ASSETSONAR_RATE_BURST': max(1, RATE_BURST // workers),
+    'ASSETSONAR_CONCURRENCY_START': max(1, CONCURRENCY_START // workers),
+    'ASSETSONAR_CONCURRENCY_MAX': max(1, CONCURRENCY_MAX // workers),
+  }
+
+
+def take_share(share):
+  # the coordinator's client already exists from the fetch, which had the whole budget to itself
+  client = get_client()
+  client.bucket = TokenBucket(share['ASSETSONAR_RATE_LIMIT'], share['ASSETSONAR_RATE_BURST'])
+  client.limit = AdaptiveLimit(share['ASSETSONAR_CONCURRENCY_START'], maximum=share['ASSETSONAR_CONCURRENCY_MAX'])
+  return None
+
+
+def fetch(options):
+  """Fetch and reconcile once for the whole run, including available assets for auto checkout
+
+  Returns:
+    bool: True if every fetch stage succeeded
+  """
+  import pipeline
+
+  def stage_available(results, options):
+    import auto_checkout
+    return auto_checkout.get_available_assets()
+
+  stages = {name: pipeline.STAGES[name] for name in ('query_jamf', 'query_assetsonar', 'load_members', 'parse_responses')}
+  stages['available_assets'] = ((), stage_available)
+  began = time.perf_counter()
+  _, timings, failed = pipeline.run(stages, options)
+  pipeline.print_timings(timings, time.perf_counter() - began)
+  if failed:
+    print(f'Failed stages: {", ".join(sorted(failed))}', file=sys.stderr)
+  return not failed
+
+
+def start(options):
+  """Fetch and reconcile, open a sharded run, work it with local workers and write the report
+
+  Returns:
+    int: exit status
+  """
+  store = get_store()
+  METRICS.claim_textfile() # helpers only log events, the run's totals come from here
+  with RunLock():
+    try:
+      if not fetch(options):
+        return 1
+      job = f'{time.strftime("%Y-%m-%d_%H-%M-%S")}-{os.getpid()}'
+      store.clear_outcomes(MUTATION_OUTCOMES) # each shard merges its own back in
+      store.open_job(job, options.shards)
+      print(f'Opened sharded run {job} with {options.shards} shards')
+
+      # this process is one of the workers, so a run always finishes even if every helper dies
+      # helpers read their share of the request budget from the environment
+      share = budget_share(options.workers)
+      env = {**os.environ, **{name: str(value) for name, value in share.items()}}
+      helpers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work', '--job', job,
+                                   '--lease', str(options.lease)], env=env)
+                 for _ in range(options.workers - 1)]
+      take_share(share)
+      status = work(job, seconds=options.lease)
+      for helper in helpers:
+        status = helper.wait() or status
+      if status:
+        return status
+
+      import generate_report
+      os.makedirs('reports', exist_ok=True)
+      with METRICS.stage('generate_report'):
+        generate_report.main()
+    finally:
+      store.finish_audit() # the webhook daemon reindexes the next time it takes the lock
+  return 0
+
+
+def print_status(job=None):
+  store = get_store()
+  job = job or store.get_meta('shard_job')
+  if job is None:
+    print('No sharded run has been started', file=sys.stderr)
+    return 1
+  now = time.time()
+  leases = store.shard_leases(job)
+  print(f'{job}: {sum(lease["done_at"] is not None for lease in leases)}/{len(leases)} shards done')
+  for lease in leases:
+    if lease['done_at'] is not None:
+      state = 'done'
+    elif lease['owner'] and lease['expires_at'] > now:
+      state = f'leased by {lease["owner"]} for {lease["expires_at"] - now:.0f}s'
+    elif lease['owner']:
+      state = f'expired, was {lease["owner"]}'
+    else:
+      state = 'waiting'
+    print(f'  shard {lease["shard"] + 1:>3}/{lease["shards"]}  {state}  ({lease["attempts"]} claims)')
+  return 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Run the mutation stages sharded over several worker processes')
+  commands = parser.add_subparsers(dest='command', required=True)
+  start_parser = commands.add_parser('start', help='fetch, reconcile, work the shards and write the report')
+  start_parser.add_argument('--shards', type=int, default=SHARD_COUNT, help='shards to split the assets into')
+  start_parser.add_argument('--workers', type=int, default=1, help='worker processes on this host, this one included')
+  start_parser.add_argument('--lease', type=float, default=LEASE_SECONDS, help='lease length in seconds')
+  start_parser.add_argument('--artifacts', action='store_true', help='also write the intermediate JSON files')
+  work_parser = commands.add_parser('work', help='claim and run shards of the current run until all are done')
+  work_parser.add_argument('--job', help='run id, defaults to the latest')
+  work_parser.add_argument('--lease', type=float, default=LEASE_SECONDS, help='lease length in seconds')
+  status_parser = commands.add_parser('status', help='show the shards of the current run')
+  status_parser.add_argument('--job', help='run id, defaults to the latest')
+  options = parser.parse_args(argv)
+
+  if options.command == 'start':
+    # fetch stages read these like pipeline.py's options
+    options.resume = False
+    if options.artifacts:
+      import store
+      store.EXPORT_JSON = True
+    return start(options)
+  if options.command == 'work':
+    return work(options.job, seconds=options.lease)
+  return print_status(options.job)
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,132 @@
+import json
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+import os
+from jamf import write_json_atomic
+from jsonstream import iter_array, project
+
+# incremental delta sync for the Jamf and AssetSonar snapshots
+# the Jamf response_jamf_*.json files and the store's AssetSonar tables are the
+# snapshot: delta runs fetch only records changed since the last high-water
+# mark and merge them in, so parse_responses.py reads them unchanged
+
+# ==========================================================================
+
+load_dotenv()
+INCREMENTAL_SYNC = os.getenv('INCREMENTAL_SYNC', '0') == '1'
+FULL_SYNC_DAYS = float(os.getenv('FULL_SYNC_DAYS', 7)) # full resync at least this often
+SYNC_OVERLAP = int(os.getenv('SYNC_OVERLAP', 600))     # seconds re-fetched before the high-water mark
+SNAPSHOT_STATE = 'snapshot_state.json'
+
+# ==========================================================================
+
+def now():
+  """Get the current UTC time
+
+  Returns:
+    datetime: timezone-aware now
+  """
+  return datetime.now(timezone.utc)
+
+
+def load_state():
+  """Load high-water marks for every source
+
+  Returns:
+    dict: source -> {'last_sync': iso, 'last_full': iso}
+  """
+  try:
+    with open(SNAPSHOT_STATE, 'r') as f:
+      return json.load(f)
+  except (OSError, json.JSONDecodeError):
+    return {}
+
+
+def plan(source, present):
+  """Decide whether a source needs a full resync or can fetch a delta
+
+  Args:
+    source (str): snapshot source name, e.g. jamf
+    present (bool): whether the snapshot data exists to merge into
+
+  Returns:
+    tuple: (full (bool), since (str ISO-8601 UTC or None))
+  """
+  if not INCREMENTAL_SYNC:
+    return True, None
+  state = load_state().get(source)
+  if not state or not present:
+    return True, None
+
+  last_full = datetime.fromisoformat(state['last_full'])
+  if now() - last_full >= timedelta(days=FULL_SYNC_DAYS):
+    print(f'{source}: last full sync {state["last_full"]}, running full resync')
+    return True, None
+
+  since = datetime.fromisoformat(state['last_sync']) - timedelta(seconds=SYNC_OVERLAP)
+  print(f'{source}: fetching changes since {since.isoformat()}')
+  return False, since.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def mark(source, started, full):
+  """Record a successful sync; call only after the snapshot files are written
+
+  Args:
+    source (str): snapshot source name
+    started (datetime): when the fetch started, becomes the new high-water mark
+    full (bool): whether this was a full resync
+
+  Returns:
+    None
+  """
+  state = load_state()
+  entry = state.get(source, {})
+  entry['last_sync'] = started.isoformat()
+  if full or 'last_full' not in entry:
+    entry['last_full'] = started.isoformat()
+  state[source] = entry
+  with open(SNAPSHOT_STATE, 'w') as f:
+    json.dump(state, f, indent=2, sort_keys=True)
+  return None
+
+
+def merge_file(filename, delta, key, container, removed=(), fields=None):
+  """Merge changed records into a snapshot response file, streaming it record by record
+
+  Only the record being copied is held as a dict tree, plus the delta and
+  the projected records handed back.
+
+  Args:
+    filename (str): snapshot response file, {container: [...], 'totalCount': n}
+    delta (list): changed records, replace any snapshot record with the same key
+    key (callable): record -> unique id
+    container (str): list key inside the file, e.g. results
+    removed (iterable): ids to drop even if absent from delta (e.g. status changed)
+    fields (dict): fields to keep in the returned records, see jsonstream.project()
+
+  Returns:
+    dict: {container: merged records, projected to fields, 'totalCount': n}
+  """
+  updates = {key(r): r for r in delta}
+  drop = set(removed) - set(updates)
+  merged = []
+
+  def write(out):
+    # existing order kept, new records appended
+    out.write(f'{{{json.dumps(container)}: [')
+    def add(record):
+      if merged:
+        out.write(',\n')
+      json.dump(record, out)
+      merged.append(record if fields is None else project(record, fields))
+    with open(filename, 'r') as f:
+      for record in iter_array(f, container):
+        k = key(record)
+        if k not in drop:
+          add(updates.pop(k, record))
+    for record in updates.values():
+      add(record)
+    out.write(f'],\n"totalCount": {len(merged)}}}\n')
+
+  write_json_atomic(filename, write)
+  return {container: merged, 'totalCount': len(merged)}
@@ -0,0 +1,519 @@
+import json
+from dotenv import load_dotenv
+import os
+import sqlite3
+import threading
+import time
+from records import Asset, Member, to_json
+
+# embedded SQLite state store shared by every stage
+# replaces the whole-file JSON handoff (response_assetsonar.json, assets.json,
+# assets_assigned.json, response_members.json, assets_no_jamf_user.json,
+# assets_retired.json) with indexed tables; JSON export is kept as an option
+
+# ==========================================================================
+
+load_dotenv()
+STORE_FILE = os.getenv('ASAUDIT_DB', 'asaudit.db')
+EXPORT_JSON = os.getenv('EXPORT_JSON', '0') == '1' # also write the legacy JSON files
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS assetsonar_assets (
+  asset_id INTEGER PRIMARY KEY,
+  serial_no TEXT NOT NULL,
+  name TEXT,
+  assigned_email TEXT,
+  manufacturer TEXT,
+  status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_assets_serial ON assetsonar_assets (serial_no);
+CREATE INDEX IF NOT EXISTS idx_assets_status ON assetsonar_assets (status);
+
+CREATE TABLE IF NOT EXISTS jamf_devices (
+  serial_no TEXT PRIMARY KEY,
+  jamf_id TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  username TEXT,
+  real_name TEXT,
+  email TEXT
+);
+
+CREATE TABLE IF NOT EXISTS members (
+  id INTEGER PRIMARY KEY,
+  email TEXT,
+  email_key TEXT,
+  name TEXT,
+  egy TEXT,
+  role TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_members_email ON members (email_key);
+
+CREATE TABLE IF NOT EXISTS audit_outcomes (
+  stage TEXT NOT NULL,
+  asset_id INTEGER NOT NULL,
+  serial_no TEXT NOT NULL,
+  category TEXT NOT NULL,
+  data TEXT NOT NULL,
+  recorded_at REAL NOT NULL,
+  PRIMARY KEY (stage, asset_id)
+);
+CREATE INDEX IF NOT EXISTS idx_outcomes_category ON audit_outcomes (stage, category);
+CREATE INDEX IF NOT EXISTS idx_outcomes_serial ON audit_outcomes (serial_no);
+
+CREATE TABLE IF NOT EXISTS mutation_journal (
+  action TEXT NOT NULL,
+  serial_no TEXT NOT NULL,
+  asset_id INTEGER,
+  as_email TEXT,
+  jamf_email TEXT,
+  ok INTEGER NOT NULL,
+  result TEXT,
+  attempted_at REAL NOT NULL,
+  PRIMARY KEY (action, serial_no)
+);
+CREATE INDEX IF NOT EXISTS idx_journal_emails ON mutation_journal (as_email, jamf_email);
+
+CREATE TABLE IF NOT EXISTS shard_leases (
+  job TEXT NOT NULL,
+  shard INTEGER NOT NULL,
+  shards INTEGER NOT NULL,
+  owner TEXT,
+  expires_at REAL NOT NULL DEFAULT 0,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  done_at REAL,
+  PRIMARY KEY (job, shard)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+'''
+
+ASSET_COLUMNS = ('asset_id', 'serial_no', 'name', 'assigned_email', 'manufacturer')
+
+# ==========================================================================
+
+class Store:
+  """SQLite-backed state shared between pipeline stages"""
+
+  def __init__(self, path=STORE_FILE):
+    self.path = path
+    # mutation workers read through the same connection, so serialise access ourselves
+    # sharded workers in other processes write too, so wait out their transactions (see shards.py)
+    self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    self.conn.row_factory = sqlite3.Row
+    self.lock = threading.RLock()
+    with self.lock:
+      self.conn.execute('PRAGMA journal_mode=WAL')
+      self.conn.executescript(SCHEMA)
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
+
+  # --- meta ---
+
+  def get_meta(self, key, default=None):
+    """Get a value from the key/value meta table
+
+    Args:
+      key (str): meta key
+      default: returned if the key is unset
+
+    Returns:
+      str: stored value or default
+    """
+    with self.lock:
+      row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else default
+
+  def set_meta(self, key, value):
+    with self.lock, self.conn:
+      self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+  def finish_audit(self):
+    # bumped at the end of every full audit run, so the webhook daemon knows to reindex
+    with self.lock, self.conn:
+      self.conn.execute("INSERT INTO meta (key, value) VALUES ('audit_generation', '1') "
+                        "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+  def audit_generation(self):
+    return int(self.get_meta('audit_generation', 0))
+
+  # --- AssetSonar assets ---
+
+  def replace_assets(self, status, assets):
+    """Replace every asset with a status, e.g. after a full fetch
+
+    Args:
+      status (str): AS asset status, e.g. checked_out or available
+      assets (list): Asset records from query_assetsonar / auto_checkout
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM assetsonar_assets WHERE status = ?', (status,))
+      self.insert_assets(status, assets)
+    return None
+
+  def merge_assets(self, status, assets, removed=()):
+    """Upsert changed assets and drop ones that left a status, e.g. after a delta fetch
+
+    Args:
+      status (str): AS asset status
+      assets (list): changed Asset records
+      removed (iterable): asset ids changed in any status, dropped unless in assets
+
+    Returns:
+      None
+    """
+    keep = {a.asset_id for a in assets}
+    with self.lock, self.conn:
+      self.conn.executemany('DELETE FROM assetsonar_assets WHERE asset_id = ? AND status = ?',
+                            [(i, status) for i in removed if i not in keep])
+      self.insert_assets(status, assets)
+    return None
+
+  def insert_assets(self, status, assets):
+    self.conn.executemany(
+      'INSERT OR REPLACE INTO assetsonar_assets (asset_id, serial_no, name, assigned_email, manufacturer, status) '
+      'VALUES (?, ?, ?, ?, ?, ?)',
+      [(a.asset_id, a.serial_no, a.name, a.assigned_email, a.manufacturer, status) for a in assets])
+
+  def assets(self, status):
+    """Get every asset with a status
+
+    Args:
+      status (str): AS asset status
+
+    Returns:
+      list: Asset records ordered by asset id
+    """
+    with self.lock:
+      rows = self.conn.execute(
+        'SELECT asset_id, serial_no, name, assigned_email, manufacturer FROM assetsonar_assets '
+        'WHERE status = ? ORDER BY asset_id', (status,)).fetchall()
+    return [Asset(**r) for r in map(dict, rows)]
+
+  def asset_statuses(self):
+    """Get the snapshot status of every asset
+
+    Returns:
+      dict: asset id -> status, e.g. checked_out or available
+    """
+    with self.lock:
+      rows = self.conn.execute('SELECT asset_id, status FROM assetsonar_assets').fetchall()
+    return {r['asset_id']: r['status'] for r in rows}
+
+  def count_assets(self, status):
+    with self.lock:
+      return self.conn.execute('SELECT COUNT(*) FROM assetsonar_assets WHERE status = ?', (status,)).fetchone()[0]
+
+  # --- Jamf devices ---
+
+  def replace_jamf_devices(self, devices):
+    """Replace the Jamf device table
+
+    Args:
+      devices (list): dicts with serial_no, jamf_id, kind, username, real_name, email
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM jamf_devices')
+      self.conn.executemany(
+        'INSERT OR IGNORE INTO jamf_devices (serial_no, jamf_id, kind, username, real_name, email) '
+        'VALUES (:serial_no, :jamf_id, :kind, :username, :real_name, :email)', devices)
+    return None
+
+  def jamf_device(self, serial):
+    """Get a Jamf device by serial number
+
+    Args:
+      serial (str): device serial number
+
+    Returns:
+      dict: Jamf device row or None
+    """
+    with self.lock:
+      row = self.conn.execute('SELECT * FROM jamf_devices WHERE serial_no = ?', (serial,)).fetchone()
+    return dict(row) if row else None
+
+  # --- members ---
+
+  def replace_members(self, members):
+    """Replace the member table
+
+    Args:
+      members (list): Member records
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM members')
+      self.conn.executemany(
+        'INSERT OR REPLACE INTO members (id, email, email_key, name, egy, role) VALUES (?, ?, ?, ?, ?, ?)',
+        [(m.id, m.email, (m.email or '').strip().lower() or None, m.name, m.EGY, m.role) for m in members])
+      self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                        ('members_refreshed_at', str(time.time())))
+    return None
+
+  def members(self):
+    """Get every member
+
+    Returns:
+      list: Member records
+    """
+    with self.lock:
+      rows = self.conn.execute('SELECT id, name, email, egy, role FROM members ORDER BY id').fetchall()
+    return [Member(id=r['id'], name=r['name'], email=r['email'], EGY=r['egy'], role=r['role']) for r in rows]
+
+  def members_refreshed_at(self):
+    """Get when members were last pulled from members.api
+
+    Returns:
+      float: epoch seconds, 0 if never
+    """
+    return float(self.get_meta('members_refreshed_at', 0))
+
+  # --- audit outcomes ---
+
+  def replace_outcomes(self, stage, outcomes):
+    """Replace every outcome recorded by a stage
+
+    Args:
+      stage (str): pipeline stage, e.g. reconcile, retire, reassign
+      outcomes (list): AuditOutcome records
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM audit_outcomes WHERE stage = ?', (stage,))
+      self.insert_outcomes(stage, outcomes)
+    return None
+
+  def merge_outcomes(self, stage, outcomes):
+    """Upsert a stage's outcomes, keeping the rest, e.g. when each shard of a sharded run saves its own
+
+    Args:
+      stage (str): pipeline stage
+      outcomes (list): AuditOutcome records
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.insert_outcomes(stage, outcomes)
+    return None
+
+  def insert_outcomes(self, stage, outcomes):
+    now = time.time()
+    self.conn.executemany(
+      'INSERT OR REPLACE INTO audit_outcomes (stage, asset_id, serial_no, category, data, recorded_at) '
+      'VALUES (?, ?, ?, ?, ?, ?)',
+      [(stage, o.asset_id, o.serial_no, o.category, json.dumps(o.data, default=to_json), now) for o in outcomes])
+
+  def clear_outcomes(self, stages):
+    with self.lock, self.conn:
+      self.conn.executemany('DELETE FROM audit_outcomes WHERE stage = ?', [(s,) for s in stages])
+
+  def outcomes(self, stage, category=None):
+    """Get outcome data recorded by a stage
+
+    Args:
+      stage (str): pipeline stage
+      category (str): only this category, None for all
+
+    Returns:
+      list: decoded outcome data in insertion order, plain dicts; see Asset.from_dict()
+    """
+    query = 'SELECT data FROM audit_outcomes WHERE stage = ?'
+    args = [stage]
+    if category is not None:
+      query += ' AND category = ?'
+      args.append(category)
+    with self.lock:
+      rows = self.conn.execute(query + ' ORDER BY rowid', args).fetchall()
+    return [json.loads(r['data']) for r in rows]
+
+  def outcome_serials(self, stage, category):
+    """Get the serial numbers of a stage's outcomes in one category
+
+    Args:
+      stage (str): pipeline stage
+      category (str): outcome category
+
+    Returns:
+      set: serial numbers
+    """
+    with self.lock:
+      rows = self.conn.execute('SELECT serial_no FROM audit_outcomes WHERE stage = ? AND category = ?',
+                               (stage, category)).fetchall()
+    return {r['serial_no'] for r in rows}
+
+  # --- mutation journal ---
+
+  def journal_entries(self, action):
+    """Get the last attempt of a mutation for every serial number
+
+    Args:
+      action (str): mutation, e.g. reassign, autocheckout, retire
+
+    Returns:
+      dict: serial number -> journal row (asset_id, as_email, jamf_email, ok, result, attempted_at)
+    """
+    with self.lock:
+      rows = self.conn.execute('SELECT * FROM mutation_journal WHERE action = ?', (action,)).fetchall()
+    return {r['serial_no']: dict(r) for r in rows}
+
+  def record_attempts(self, action, attempts):
+    """Record the latest attempt of a mutation, replacing earlier ones for the same serial number
+
+    Args:
+      action (str): mutation
+      attempts (list): dicts with serial_no, asset_id, as_email, jamf_email, ok, result
+
+    Returns:
+      None
+    """
+    now = time.time()
+    with self.lock, self.conn:
+      self.conn.executemany(
+        'INSERT OR REPLACE INTO mutation_journal (action, serial_no, asset_id, as_email, jamf_email, ok, result, attempted_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [(action, a['serial_no'], a.get('asset_id'), a.get('as_email'), a.get('jamf_email'),
+          int(bool(a['ok'])), json.dumps(a.get('result')), now) for a in attempts])
+    return None
+
+  # --- shard leases ---
+
+  def open_job(self, job, shards):
+    """Start a sharded run with every shard unclaimed, dropping earlier runs' leases
+
+    Args:
+      job (str): run id
+      shards (int): number of shards
+
+    Returns:
+      None
+    """
+    with self.lock, self.conn:
+      self.conn.execute('DELETE FROM shard_leases')
+      self.conn.executemany('INSERT INTO shard_leases (job, shard, shards) VALUES (?, ?, ?)',
+                            [(job, i, shards) for i in range(shards)])
+      self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('shard_job', job))
+    return None
+
+  def claim_shard(self, job, owner, seconds):
+    """Lease an unfinished shard nobody holds, or whose holder's lease expired
+
+    Args:
+      job (str): run id
+      owner (str): worker id
+      seconds (float): lease length
+
+    Returns:
+      dict: shard, shards and attempts (earlier claims), None if no shard is free
+    """
+    now = time.time()
+    with self.lock:
+      # IMMEDIATE takes the write lock up front, so two workers can't pick the same row
+      self.conn.execute('BEGIN IMMEDIATE')
+      try:
+        row = self.conn.execute(
+          'SELECT shard, shards, attempts FROM shard_leases WHERE job = ? AND done_at IS NULL AND expires_at < ? '
+          'ORDER BY attempts, shard LIMIT 1', (job, now)).fetchone()
+        if row is not None:
+          self.conn.execute('UPDATE shard_leases SET owner = ?, expires_at = ?, attempts = attempts + 1 '
+                            'WHERE job = ? AND shard = ?', (owner, now + seconds, job, row['shard']))
+        self.conn.commit()
+      except BaseException:
+        self.conn.rollback()
+        raise
+    return dict(row) if row else None
+
+  def renew_lease(self, job, shard, owner, seconds):
+    """Extend a held lease
+
+    Returns:
+      bool: False if the lease was lost to another worker
+    """
+    with self.lock, self.conn:
+      cursor = self.conn.execute(
+        'UPDATE shard_leases SET expires_at = ? WHERE job = ? AND shard = ? AND owner = ? AND done_at IS NULL',
+        (time.time() + seconds, job, shard, owner))
+    return cursor.rowcount == 1
+
+  def finish_shard(self, job, shard, owner):
+    """Mark a held shard done
+
+    Returns:
+      bool: False if the lease was lost to another worker
+    """
+    with self.lock, self.conn:
+      cursor = self.conn.execute(
+        'UPDATE shard_leases SET done_at = ? WHERE job = ? AND shard = ? AND owner = ? AND done_at IS NULL',
+        (time.time(), job, shard, owner))
+    return cursor.rowcount == 1
+
+  def release_shard(self, job, shard, owner):
+    # give an unfinished shard straight back, e.g. after an error, instead of waiting for the lease to expire
+    with self.lock, self.conn:
+      self.conn.execute('UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE job = ? AND shard = ? AND owner = ?',
+                        (job, shard, owner))
+
+  def shard_leases(self, job):
+    """Get every shard of a sharded run
+
+    Args:
+      job (str): run id
+
+    Returns:
+      list: dicts with shard, shards, owner, expires_at, attempts, done_at
+    """
+    with self.lock:
+      rows = self.conn.execute('SELECT shard, shards, owner, expires_at, attempts, done_at FROM shard_leases '
+                               'WHERE job = ? ORDER BY shard', (job,)).fetchall()
+    return [dict(r) for r in rows]
+
+# ==========================================================================
+
+def export_json(filename, data, **kwargs):
+  """Write a legacy JSON file when EXPORT_JSON is enabled
+
+  Args:
+    filename (str): JSON file to write
+    data: JSON-serialisable content, may contain records
+    kwargs: passed to json.dump
+
+  Returns:
+    None
+  """
+  if not EXPORT_JSON:
+    return None
+  with open(filename, 'w') as f:
+    json.dump(data, f, default=to_json, **kwargs)
+  print(f'Exported {filename}')
+  return None
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+def get_store():
+  """Get the process-wide store, opening it on first use
+
+  Returns:
+    Store: shared store
+  """
+  global _STORE
+  if _STORE is None:
+    with _STORE_LOCK:
+      if _STORE is None:
+        _STORE = Store()
+  return _STORE
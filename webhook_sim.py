@@ -0,0 +1,74 @@
+import argparse
+import random
+import sys
+import time
+import requests
+import fleet
+
+# local Jamf webhook simulator for testing daemon.py
+# posts Jamf Pro style webhook payloads for the given serials, or for random
+# serials of a fleet.py fleet (e.g. the one fake_api.py is serving)
+#
+#   python3 webhook_sim.py C02000000001 C02000000002
+#   python3 webhook_sim.py --random 50 --devices 5000 --rate 10 --event MobileDeviceEnrolled
+
+# ==========================================================================
+
+EVENT_IDS = {
+  'ComputerAdded': 1,
+  'ComputerInventoryCompleted': 3,
+  'MobileDeviceEnrolled': 9,
+  'MobileDeviceUnEnrolled': 12,
+}
+
+# ==========================================================================
+
+def payload(event, serial, jss_id=1):
+  """Build a webhook payload the way Jamf Pro sends it
+
+  Args:
+    event (str): webhook event, e.g. ComputerInventoryCompleted
+    serial (str): device serial number
+    jss_id (int): Jamf device id
+
+  Returns:
+    dict: webhook JSON
+  """
+  device = {'serialNumber': serial, 'jssID': jss_id, 'udid': f'{jss_id:032x}', 'deviceName': f'Device {jss_id}'}
+  if event == 'ComputerInventoryCompleted':
+    device = {'computer': device}
+  return {'webhook': {'id': EVENT_IDS.get(event, 0), 'name': f'asaudit {event}', 'webhookEvent': event},
+          'event': device}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Post simulated Jamf webhooks to daemon.py')
+  parser.add_argument('serials', nargs='*', help='serial numbers to send events for')
+  parser.add_argument('--url', default='http://127.0.0.1:8765/webhook')
+  parser.add_argument('--event', default='ComputerInventoryCompleted', help='webhook event name')
+  parser.add_argument('--random', type=int, default=0, help='also send this many random fleet serials')
+  parser.add_argument('--devices', type=int, default=5000, help='fleet size the random serials are drawn from')
+  parser.add_argument('--rate', type=float, default=0, help='events per second, 0 sends as fast as possible')
+  parser.add_argument('--auth', help='Authorization header, see DAEMON_AUTH')
+  options = parser.parse_args(argv)
+
+  serials = list(options.serials)
+  serials += [fleet.serial_number(random.randrange(options.devices)) for _ in range(options.random)]
+  if not serials:
+    parser.error('give serial numbers or --random')
+
+  headers = {'Authorization': options.auth} if options.auth else {}
+  session = requests.Session()
+  start = time.perf_counter()
+  for i, serial in enumerate(serials):
+    response = session.post(options.url, json=payload(options.event, serial, i + 1), headers=headers, timeout=10)
+    print(f'{options.event} {serial}: HTTP {response.status_code} {response.text}')
+    if options.rate:
+      time.sleep(max(0, (i + 1) / options.rate - (time.perf_counter() - start)))
+  print(f'Sent {len(serials)} events in {time.perf_counter() - start:.2f}s')
+  return 0
+
+# ==========================================================================
+
+if __name__ == '__main__':
+  sys.exit(main())